@@ -1,14 +1,32 @@
-from fastapi import FastAPI, HTTPException, Depends
+from fastapi import FastAPI, HTTPException, Depends, Header, Request, Response
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import StreamingResponse
+from starlette.concurrency import run_in_threadpool
 from pydantic import BaseModel
-from typing import List, Optional
-from sqlalchemy import desc
+from typing import Annotated, List, Optional
+from sqlalchemy import desc, func, or_, and_, select, literal, union_all, tuple_, cast, BigInteger, case, insert, update, delete
 from sqlalchemy.orm import Session
 try:
-    from backend.database import SessionLocal, Product, Variant, Order, OrderItem, Customer, DebtLog, engine, is_sqlite, Base
+    from backend.database import SessionLocal, Product, Variant, Order, OrderItem, Customer, DebtLog, Tombstone, StockReservation, engine, is_sqlite, optimize_sqlite, pool_stats
 except ImportError:
-    from database import SessionLocal, Product, Variant, Order, OrderItem, Customer, DebtLog, engine, is_sqlite, Base
-from sqlalchemy import text
-from datetime import datetime
+    from database import SessionLocal, Product, Variant, Order, OrderItem, Customer, DebtLog, Tombstone, StockReservation, engine, is_sqlite, optimize_sqlite, pool_stats
+try:
+    from backend.search import detect_search_backend, search_products, fill_search_names
+    from backend import catalog_cache, sync, events, serialization, migrations, idempotency, catalog_import, reservations
+except ImportError:
+    from search import detect_search_backend, search_products, fill_search_names
+    import catalog_cache
+    import migrations
+    import idempotency
+    import catalog_import
+    import reservations
+    import sync
+    import events
+    import serialization
+from datetime import datetime, timedelta
+import asyncio
+import base64
+import json
 
 
 class DebtLogCreate(BaseModel):
@@ -24,90 +42,14 @@ class DebtLogUpdate(BaseModel):
 class OrderDateUpdate(BaseModel):
     created_at: str  # YYYY-MM-DD HH:MM
 
-app = FastAPI()
-
-def ensure_created_ts_columns():
-    if not is_sqlite:
-        return  # Only needed for SQLite migration
-    try:
-        with engine.connect() as conn:
-            for table in ("orders", "debt_logs"):
-                info = conn.execute(text(f"PRAGMA table_info('{table}')")).fetchall()
-                cols = [r[1] for r in info]
-                if 'created_ts' not in cols:
-                    conn.execute(text(f"ALTER TABLE {table} ADD COLUMN created_ts INTEGER"))
-                conn.execute(text(f"UPDATE {table} SET created_ts = (CAST(strftime('%s', created_at) AS INTEGER) * 1000) + id WHERE created_ts IS NULL OR created_ts % 1000 == 0"))
-            conn.commit()
-    except Exception as e:
-        print("Warning: ensure_created_ts_columns failed:", e)
+app = FastAPI(default_response_class=serialization.FastJSONResponse)
+app.add_middleware(serialization.CompressionMiddleware)
 
-def ensure_is_draft_column():
-    """Add is_draft column to orders table if not exists"""
-    try:
-        with engine.connect() as conn:
-            if is_sqlite:
-                info = conn.execute(text("PRAGMA table_info('orders')")).fetchall()
-                cols = [r[1] for r in info]
-                if 'is_draft' not in cols:
-                    conn.execute(text("ALTER TABLE orders ADD COLUMN is_draft INTEGER DEFAULT 0"))
-                    conn.execute(text("UPDATE orders SET is_draft = 0 WHERE is_draft IS NULL"))
-                    conn.commit()
-            else:
-                # PostgreSQL
-                try:
-                    conn.execute(text("ALTER TABLE orders ADD COLUMN is_draft INTEGER DEFAULT 0"))
-                    conn.execute(text("UPDATE orders SET is_draft = 0 WHERE is_draft IS NULL"))
-                    conn.commit()
-                except:
-                    conn.rollback()
-                    # Column might already exist; still normalize NULL values
-                    try:
-                        conn.execute(text("UPDATE orders SET is_draft = 0 WHERE is_draft IS NULL"))
-                        conn.commit()
-                    except:
-                        pass
-    except Exception as e:
-        print("Warning: ensure_is_draft_column failed:", e)
-
-# Create tables (needed for first deploy on new DB)
-Base.metadata.create_all(bind=engine)
-ensure_created_ts_columns()
-ensure_is_draft_column()
-
-def ensure_status_column():
-    """Migrate orders table from is_draft to status column"""
-    try:
-        with engine.connect() as conn:
-            if is_sqlite:
-                info = conn.execute(text("PRAGMA table_info('orders')")).fetchall()
-                cols = [r[1] for r in info]
-                if 'status' not in cols:
-                    conn.execute(text("ALTER TABLE orders ADD COLUMN status VARCHAR DEFAULT 'completed'"))
-                    conn.execute(text("UPDATE orders SET status = 'pending' WHERE is_draft = 1"))
-                    conn.execute(text("UPDATE orders SET status = 'completed' WHERE is_draft = 0 OR is_draft IS NULL"))
-                    conn.commit()
-            else:
-                # PostgreSQL: try adding column (fails silently if already exists)
-                try:
-                    conn.execute(text("ALTER TABLE orders ADD COLUMN status VARCHAR DEFAULT 'completed'"))
-                    conn.commit()
-                except Exception:
-                    conn.rollback()
-                # Migrate existing data from is_draft
-                try:
-                    conn.execute(text(
-                        "UPDATE orders SET status = 'pending' WHERE is_draft = 1 AND (status IS NULL OR status = 'completed')"
-                    ))
-                    conn.execute(text(
-                        "UPDATE orders SET status = 'completed' WHERE (is_draft = 0 OR is_draft IS NULL) AND status IS NULL"
-                    ))
-                    conn.commit()
-                except Exception:
-                    conn.rollback()
-    except Exception as e:
-        print("Warning: ensure_status_column failed:", e)
-
-ensure_status_column()
+# create / upgrade the schema (also the first deploy on a new DB), see backend/migrations.py
+migrations.migrate(engine)
+fill_search_names(engine)
+detect_search_backend(engine)
+optimize_sqlite()
 
 # --- DEPENDENCY: KẾT NỐI DB ---
 def get_db():
@@ -117,6 +59,19 @@ def get_db():
     finally:
         db.close()
 
+def _run_in_session(fn, *args):
+    with SessionLocal() as db:
+        return fn(db, *args)
+
+async def run_db(fn, *args):
+    """
+    Run `fn(db, *args)` for an `async def` endpoint: in the threadpool on a regular session,
+    exactly like a plain `def` endpoint with Depends(get_db). Queries, ORM hydration and
+    serialization all stay off the event loop, so SSE streams and cache hits are never
+    blocked behind them (running them through AsyncSession.run_sync did exactly that).
+    """
+    return await run_in_threadpool(_run_in_session, fn, *args)
+
 # --- MODELS ---
 class CustomerCreate(BaseModel):
     name: str
@@ -129,6 +84,7 @@ class VariantUpdate(BaseModel):
     size: str
     price: int
     stock: int
+    stock_before: Optional[int] = None  # stock the editor loaded: only the difference is applied
 
 class ProductUpdate(BaseModel):
     name: str
@@ -141,6 +97,22 @@ class ProductCreate(BaseModel):
     image_path: str
     variants: List[VariantUpdate]
 
+class BulkVariant(BaseModel):
+    color: str
+    size: str
+    price: int
+    stock: Optional[int] = None  # None: keep the current stock
+
+class BulkProduct(BaseModel):
+    name: str
+    description: Optional[str] = None
+    image_path: Optional[str] = None
+    variants: List[BulkVariant]
+
+class BulkProductRequest(BaseModel):
+    products: List[BulkProduct]
+    prune_variants: bool = True  # delete variants of listed products that are not in the list
+
 class CartItem(BaseModel):
     variant_id: int
     quantity: int
@@ -159,30 +131,175 @@ class CustomerUpdate(BaseModel):
     phone: str
     debt: int 
 
+# order endpoints: a retry with the same key gets the first response back (backend/idempotency.py)
+IdempotencyKeyHeader = Annotated[Optional[str], Header(alias="Idempotency-Key")]
+
 # --- API SẢN PHẨM ---
+PARENT_IDS_PER_QUERY = 5000  # ids per `IN (...)` of the child-row query, well under the bind-parameter limits
+
+def _chunks(values, size):
+    values = list(values)
+    for start in range(0, len(values), size):
+        yield values[start:start + size]
+
+def load_catalog(db, product_query):
+    """
+    Products + their variants in 2 queries (one more per PARENT_IDS_PER_QUERY products).
+    Variants are fetched by the ids of the products already loaded: no per-product lazy
+    load, and the product query (search, ranking) is not run a second time — a product
+    created in between cannot show up in the variants only.
+    """
+    products = product_query.all()
+    variants_by_product = {p.id: [] for p in products}
+    for chunk in _chunks(variants_by_product, PARENT_IDS_PER_QUERY):
+        for v in db.query(Variant).filter(Variant.product_id.in_(chunk)).order_by(Variant.id):
+            variants_by_product[v.product_id].append(v)
+    return [serialize_product(p, variants_by_product[p.id]) for p in products]
+
+def serialize_product(p, variants):
+    """Build the catalog dict for one product; price range and total stock in a single pass."""
+    variant_list = []
+    min_p = max_p = None
+    total_stock = 0
+    for v in variants:
+        variant_list.append({"id": v.id, "color": v.color, "size": v.size, "price": v.price, "stock": v.stock})
+        total_stock += v.stock or 0
+        if v.price is not None:
+            min_p = v.price if min_p is None or v.price < min_p else min_p
+            max_p = v.price if max_p is None or v.price > max_p else max_p
+
+    price_range = "Hết hàng"
+    if min_p is not None:
+        price_range = f"{min_p:,} - {max_p:,}" if min_p != max_p else f"{min_p:,}"
+
+    return {
+        "id": p.id,
+        "name": p.name,
+        "image": p.image_path,
+        "price_range": price_range,
+        "total_stock": total_stock,
+        "variants": variant_list
+    }
+
+PRODUCT_SORTS = ("-id", "id", "name", "-name", "stock", "-stock")
+MAX_PAGE_LIMIT = 500
+
+def encode_cursor(sort, value, last_id):
+    raw = json.dumps([sort, value, last_id], ensure_ascii=False).encode("utf-8")
+    return base64.urlsafe_b64encode(raw).decode("ascii").rstrip("=")
+
+def decode_cursor(cursor, sort):
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        c_sort, value, last_id = json.loads(raw.decode("utf-8"))
+    except Exception:
+        raise HTTPException(status_code=400, detail="Cursor không hợp lệ")
+    if c_sort != sort:
+        raise HTTPException(status_code=400, detail="Cursor không khớp kiểu sắp xếp")
+    return value, int(last_id)
+
+def product_sort_key(query, sort):
+    """Return (query, sort expression, output field) for a /products sort key."""
+    field = sort.lstrip("-")
+    if field == "id":
+        return query, Product.id, "id"
+    if field == "name":
+        return query, func.coalesce(Product.name, ""), "name"
+    stock_sq = (
+        select(Variant.product_id, func.sum(Variant.stock).label("total_stock"))
+        .group_by(Variant.product_id)
+        .subquery()
+    )
+    query = query.outerjoin(stock_sq, stock_sq.c.product_id == Product.id)
+    return query, func.coalesce(stock_sq.c.total_stock, 0), "total_stock"
+
+def catalog_changed():
+    """Call after committing any product/variant/stock change: drops cached catalogs, notifies /events."""
+    catalog_cache.bump()
+    events.publish("stock.changed", {"catalog_version": catalog_cache.version})
+
+def order_event(event_type, order):
+    events.publish(event_type, {
+        "order_id": order.id,
+        "status": order.status,
+        "customer_name": order.customer_name,
+        "total_amount": order.total_amount,
+    })
+
 @app.get("/products")
-def get_products(search: str = "", db: Session = Depends(get_db)):
+async def get_products(
+    request: Request,
+    search: str = "",
+    limit: Optional[int] = None,
+    after: Optional[str] = None,
+    sort: str = "-id",
+):
+    """
+    `search` is accent-insensitive ("giay" finds "Giày"); unpaged results are ordered by relevance.
+    Without `limit` the whole catalog is returned as a list (old behaviour, used by existing clients).
+    With `limit` the response is one keyset page: {"data", "next_cursor", "limit", "sort"};
+    pass `next_cursor` back as `after` to get the following page.
+
+    Bodies are cached per catalog version, already compressed for the negotiated encoding;
+    send the ETag back as If-None-Match to get 304. A cache hit is answered on the event loop
+    without touching the database or a worker thread.
+    """
+    if sort not in PRODUCT_SORTS:
+        raise HTTPException(status_code=400, detail=f"sort phải là một trong {', '.join(PRODUCT_SORTS)}")
+
+    ver = catalog_cache.version
+    media_type = serialization.negotiated_type()
+    encoding = serialization.negotiated_encoding()
+    key = (media_type, encoding, search, limit, after, sort)
+    cached = catalog_cache.get(ver, key)
+    if cached is not None:
+        (body, content_encoding), etag = cached
+    else:
+        body, content_encoding = await run_db(render_products, search, limit, after, sort, media_type, encoding)
+        etag = catalog_cache.put(ver, key, (body, content_encoding))
+
+    if catalog_cache.etag_matches(request.headers.get("if-none-match"), etag):
+        return Response(status_code=304, headers={"ETag": etag})
+    headers = {"ETag": etag, "Vary": "Accept, Accept-Encoding"}
+    if content_encoding:
+        headers["Content-Encoding"] = content_encoding
+    return Response(content=body, media_type=media_type, headers=headers)
+
+def render_products(db, search, limit, after, sort, media_type, encoding=None):
+    """Serialized (and compressed) body for /products, built in the worker thread: (body, content coding)."""
+    body, _ = serialization.dumps(query_products(db, search, limit, after, sort), media_type)
+    return serialization.encode_body(body, encoding)
+
+def query_products(db, search, limit, after, sort):
     query = db.query(Product)
+    rank = None
     if search:
-        query = query.filter(Product.name.contains(search))
-    
-    products = query.order_by(desc(Product.id)).all()
-    results = []
-    for p in products:
-        prices = [v.price for v in p.variants]
-        price_range = "Hết hàng"
-        if prices:
-            min_p, max_p = min(prices), max(prices)
-            price_range = f"{min_p:,} - {max_p:,}" if min_p != max_p else f"{min_p:,}"
-        
-        results.append({
-            "id": p.id, 
-            "name": p.name, 
-            "image": p.image_path, 
-            "price_range": price_range,
-            "variants": [{"id": v.id, "color": v.color, "size": v.size, "price": v.price, "stock": v.stock} for v in p.variants]
-        })
-    return results
+        query, rank = search_products(query, search)
+
+    if limit is None:
+        order = (rank, desc(Product.id)) if rank is not None else (desc(Product.id),)
+        return load_catalog(db, query.order_by(*order))
+
+    limit = max(1, min(limit, MAX_PAGE_LIMIT))
+    descending = sort.startswith("-")
+    query, key, field = product_sort_key(query, sort)
+
+    if after:
+        value, last_id = decode_cursor(after, sort)
+        if descending:
+            query = query.filter(or_(key < value, and_(key == value, Product.id < last_id)))
+        else:
+            query = query.filter(or_(key > value, and_(key == value, Product.id > last_id)))
+
+    order = (desc(key), desc(Product.id)) if descending else (key, Product.id)
+    rows = load_catalog(db, query.order_by(*order).limit(limit + 1))
+
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        last = rows[-1]
+        next_cursor = encode_cursor(sort, last[field] or ("" if field == "name" else 0), last["id"])
+    return {"data": rows, "next_cursor": next_cursor, "limit": limit, "sort": sort}
 
 @app.post("/products")
 def create_product(p: ProductCreate, db: Session = Depends(get_db)):
@@ -194,6 +311,7 @@ def create_product(p: ProductCreate, db: Session = Depends(get_db)):
     for v in p.variants:
         db.add(Variant(product_id=new_prod.id, color=v.color, size=v.size, price=v.price, stock=v.stock))
     db.commit()
+    catalog_changed()
     return {"status": "ok"}
 
 @app.put("/products/{product_id}")
@@ -203,44 +321,105 @@ def update_product(product_id: int, p_data: ProductUpdate, db: Session = Depends
         raise HTTPException(status_code=404)
     product.name = p_data.name
     product.image_path = p_data.image_path
-    
-    # Logic update variants (giữ nguyên)
-    current_variants_map = {v.id: v for v in product.variants}
-    current_ids = set(current_variants_map.keys())
-    incoming_ids = {v.id for v in p_data.variants if v.id is not None}
-    to_delete_ids = current_ids - incoming_ids
-    for vid in to_delete_ids:
-        variant_to_delete = current_variants_map.get(vid)
-        if variant_to_delete:
-            db.delete(variant_to_delete)
-    for v_data in p_data.variants:
-        if v_data.id and v_data.id in current_ids:
-            var = current_variants_map[v_data.id] 
-            var.color = v_data.color
-            var.size = v_data.size
-            var.price = v_data.price
-            var.stock = v_data.stock
-        else:
-            new_var = Variant(
-                product_id=product.id, 
-                color=v_data.color, 
-                size=v_data.size, 
-                price=v_data.price, 
-                stock=v_data.stock
-            )
-            db.add(new_var)
+    changed, stock_kept = sync_variants(db, product_id, p_data.variants)
+    if changed:
+        product.row_version = sync.next_version(db)
     db.commit()
+    catalog_changed()
+    if stock_kept:
+        return {"status": "updated", "stock_kept": stock_kept}
     return {"status": "updated"}
 
+def sync_variants(db, product_id, incoming):
+    """
+    Make the variants of `product_id` match `incoming` (VariantUpdate list) with one SELECT,
+    then at most one INSERT, one UPDATE and one DELETE. A row is matched by id, else by
+    (color, size); unmatched rows are deleted. Stock is written as `stock + change` in SQL,
+    the change being `stock - stock_before` when the client sent what it loaded, so a sale
+    made while the product was being edited is not overwritten. A lowering is guarded like
+    reservations.reserve: when stock + change would drop below `reserved` (or below 0) the
+    variant keeps its stock, the rest of the edit is saved.
+    Returns (True if anything changed, [ids of the variants whose stock was kept]).
+    """
+    current = db.query(Variant.id, Variant.color, Variant.size, Variant.price, Variant.stock) \
+        .filter(Variant.product_id == product_id).all()
+    by_id = {row.id: row for row in current}
+    by_key = {(row.color, row.size): row for row in current}
+
+    matched, inserts, changes = set(), [], {}
+    for v in incoming:
+        row = by_id.get(v.id) if v.id in by_id and v.id not in matched else None
+        if row is None:
+            row = by_key.get((v.color, v.size))
+            if row is not None and row.id in matched:
+                row = None
+        if row is None:
+            inserts.append({"product_id": product_id, "color": v.color, "size": v.size, "price": v.price, "stock": v.stock})
+            continue
+        matched.add(row.id)
+        delta = v.stock - (v.stock_before if v.stock_before is not None else (row.stock or 0))
+        if (v.color, v.size, v.price) != (row.color, row.size, row.price) or delta:
+            changes[row.id] = (v, delta)
+    deletes = [row.id for row in current if row.id not in matched]
+    if not (inserts or changes or deletes):
+        return False, []
+
+    ver = sync.next_version(db)
+    if deletes:
+        sync.record_deletes(db, Variant, deletes)
+        reservations.drop_variants(db, deletes)
+        db.query(Variant).filter(Variant.id.in_(deletes)).delete(synchronize_session=False)
+    if changes:
+        db.execute(
+            update(Variant)
+            .where(Variant.id.in_(changes))
+            .values(
+                color=case({vid: v.color for vid, (v, _) in changes.items()}, value=Variant.id),
+                size=case({vid: v.size for vid, (v, _) in changes.items()}, value=Variant.id),
+                price=case({vid: v.price for vid, (v, _) in changes.items()}, value=Variant.id),
+                row_version=ver,
+            )
+            .execution_options(synchronize_session=False)
+        )
+    stock_kept = []
+    deltas = {vid: d for vid, (_, d) in changes.items() if d}
+    if deltas:
+        reservations.release_expired(db)
+        delta = case(deltas, value=Variant.id)
+        applied = set(db.execute(
+            update(Variant)
+            .where(Variant.id.in_(deltas),
+                   or_(delta > 0, func.coalesce(Variant.stock, 0) + delta >= func.coalesce(Variant.reserved, 0)))
+            .values(stock=func.coalesce(Variant.stock, 0) + delta)
+            .returning(Variant.id)
+            .execution_options(synchronize_session=False)
+        ).scalars().all())
+        stock_kept = [vid for vid in deltas if vid not in applied]
+    if inserts:
+        db.execute(insert(Variant), [{**row, "row_version": ver} for row in inserts])
+    return True, stock_kept
+
 @app.delete("/products/{product_id}")
 def delete_product(product_id: int, db: Session = Depends(get_db)):
     p = db.query(Product).filter(Product.id == product_id).first()
     if p:
+        variant_ids = [vid for (vid,) in db.query(Variant.id).filter(Variant.product_id == product_id)]
+        sync.record_deletes(db, Variant, variant_ids)
+        reservations.drop_variants(db, variant_ids)
         db.query(Variant).filter(Variant.product_id == product_id).delete()
         db.delete(p)
         db.commit()
+        catalog_changed()
     return {"status": "deleted"}
 
+@app.post("/products/bulk")
+def bulk_upsert_products(data: BulkProductRequest, db: Session = Depends(get_db)):
+    """Create/update many products by name and their variants by color/size (backend/catalog_import.py)."""
+    result = catalog_import.upsert_catalog(db, jsonable_encoder(data.products), prune_variants=data.prune_variants)
+    if result["created"] or result["updated"]:
+        catalog_changed()
+    return result
+
 # --- API KHÁCH HÀNG ---
 @app.post("/customers")
 def create_customer_manual(data: CustomerCreate, db: Session = Depends(get_db)):
@@ -265,7 +444,10 @@ def create_customer_manual(data: CustomerCreate, db: Session = Depends(get_db)):
         raise HTTPException(status_code=500, detail=str(e))
 
 @app.get("/customers")
-def get_customers(db: Session = Depends(get_db)):
+async def get_customers():
+    return await run_db(list_customers)
+
+def list_customers(db):
     custs = db.query(Customer).order_by(desc(Customer.id)).all()
     return [{"id": c.id, "name": c.name, "phone": c.phone, "debt": c.debt} for c in custs]
 
@@ -291,62 +473,144 @@ def delete_customer(customer_id: int, db: Session = Depends(get_db)):
     customer = db.query(Customer).filter(Customer.id == customer_id).first()
     if not customer:
         raise HTTPException(status_code=404, detail="Khách hàng không tồn tại")
+    order_ids = [oid for (oid,) in db.query(Order.id).filter(Order.customer_id == customer_id)]
+    sync.record_deletes(db, Order, order_ids)
+    reservations.release(db, order_ids)
     db.query(Order).filter(Order.customer_id == customer_id).delete(synchronize_session=False)
     db.delete(customer)
     db.commit()
     return {"detail": "Đã xóa khách hàng và toàn bộ lịch sử đơn hàng liên quan"}
 
-@app.get("/customers/{cid}/history")
-def get_customer_history(cid: int, db: Session = Depends(get_db)):
-    orders = db.query(Order).filter(Order.customer_id == cid).all()
-    history = []
-    
-    for o in orders:
-        # Lấy timestamp thực tế để sắp xếp
-        ts = int(o.created_ts) if (hasattr(o, 'created_ts') and o.created_ts) else int(o.created_at.timestamp() * 1000)
-        
-        # CHUẨN HÓA DỮ LIỆU ITEMS: Phải có variant_id thì UI mới sửa được
-        items_detail = []
-        for i in o.items:
-            items_detail.append({
+def epoch_ms(dt_column):
+    """SQL expression: DateTime column -> epoch milliseconds (same fallback the old Python sort used)."""
+    if is_sqlite:
+        return cast(func.strftime('%s', dt_column), BigInteger) * 1000
+    return cast(func.extract('epoch', dt_column) * 1000, BigInteger)
+
+def history_sort_ts(model):
+    return func.coalesce(func.nullif(model.created_ts, 0), epoch_ms(model.created_at))
+
+def serialize_history_order(o, items):
+    ts = int(o.created_ts) if o.created_ts else int(o.created_at.timestamp() * 1000)
+    return {
+        "type": "ORDER",
+        "date": o.created_at.strftime("%Y-%m-%d %H:%M"),
+        "sort_ts": ts,
+        "desc": f"Xuất đơn hàng #{o.id}",
+        "amount": o.total_amount,
+        "data": {
+            "id": o.id, # ID đơn hàng
+            "customer": o.customer_name,
+            "customer_name": o.customer_name,
+            "date": o.created_at.strftime("%d/%m %H:%M"),
+            "total_money": o.total_amount,
+            "total_qty": sum(i.quantity for i in items),
+            # CHUẨN HÓA DỮ LIỆU ITEMS: Phải có variant_id thì UI mới sửa được
+            "items": [{
                 "product_name": i.product_name,
                 "variant_id": i.variant_id,  # TRƯỜNG QUAN TRỌNG NHẤT
                 "variant_info": i.variant_info,
                 "quantity": i.quantity,
                 "price": i.price
-            })
-            
-        history.append({
-            "type": "ORDER",
-            "date": o.created_at.strftime("%Y-%m-%d %H:%M"),
-            "sort_ts": ts,
-            "desc": f"Xuất đơn hàng #{o.id}",
-            "amount": o.total_amount,
-            "data": {
-                "id": o.id, # ID đơn hàng
-                "customer": o.customer_name,
-                "customer_name": o.customer_name,
-                "date": o.created_at.strftime("%d/%m %H:%M"),
-                "total_money": o.total_amount,
-                "total_qty": sum(i.quantity for i in o.items),
-                "items": items_detail # Danh sách item đầy đủ ID
-            }
-        })
-    
-    logs = db.query(DebtLog).filter(DebtLog.customer_id == cid).all()
-    for l in logs:
-        ts_log = int(l.created_ts) if (hasattr(l, 'created_ts') and l.created_ts) else int(l.created_at.timestamp() * 1000)
-        history.append({
-            "type": "LOG",
-            "date": l.created_at.strftime("%Y-%m-%d %H:%M"),
-            "sort_ts": ts_log,
-            "desc": l.note,
-            "amount": l.change_amount,
-            "data": None,
-            "log_id": l.id
-        })
-        
-    return sorted(history, key=lambda x: x['sort_ts'], reverse=True)
+            } for i in items]
+        }
+    }
+
+def serialize_history_log(l):
+    ts_log = int(l.created_ts) if l.created_ts else int(l.created_at.timestamp() * 1000)
+    return {
+        "type": "LOG",
+        "date": l.created_at.strftime("%Y-%m-%d %H:%M"),
+        "sort_ts": ts_log,
+        "desc": l.note,
+        "amount": l.change_amount,
+        "data": None,
+        "log_id": l.id
+    }
+
+@app.get("/customers/{cid}/history")
+async def get_customer_history(
+    cid: int,
+    limit: Optional[int] = None,
+    before_ts: Optional[int] = None,
+    before_key: Optional[str] = None,
+    from_date: Optional[str] = None,
+    to_date: Optional[str] = None,
+):
+    return await run_db(customer_history, cid, limit, before_ts, before_key, from_date, to_date)
+
+def customer_history(db, cid, limit=None, before_ts=None, before_key=None, from_date=None, to_date=None):
+    """
+    Orders + debt logs of a customer, newest first, merged and ordered in SQL.
+    - `from_date` / `to_date` (YYYY-MM-DD, inclusive) filter on the displayed date.
+    - Without `limit`: plain list (old behaviour). With `limit`: {"data", "next_before_ts", "next_before_key"};
+      pass both back as `before_ts` / `before_key` for the next page.
+    Order items are loaded in one query, only for orders on the returned page.
+    """
+    def in_range(model):
+        conds = [model.customer_id == cid]
+        try:
+            if from_date:
+                conds.append(model.created_at >= datetime.strptime(from_date, "%Y-%m-%d"))
+            if to_date:
+                conds.append(model.created_at < datetime.strptime(to_date, "%Y-%m-%d") + timedelta(days=1))
+        except ValueError:
+            raise HTTPException(status_code=400, detail="Ngày phải có dạng YYYY-MM-DD")
+        return conds
+
+    entries = union_all(
+        select(literal("ORDER").label("kind"), Order.id.label("row_id"), history_sort_ts(Order).label("sort_ts"))
+        .where(*in_range(Order)),
+        select(literal("LOG").label("kind"), DebtLog.id.label("row_id"), history_sort_ts(DebtLog).label("sort_ts"))
+        .where(*in_range(DebtLog)),
+    ).subquery()
+
+    page_q = select(entries.c.kind, entries.c.row_id, entries.c.sort_ts)
+    if before_ts is not None:
+        if before_key:
+            try:
+                b_kind, b_id = before_key.split(":")
+                b_id = int(b_id)
+            except ValueError:
+                raise HTTPException(status_code=400, detail="before_key không hợp lệ")
+            page_q = page_q.where(
+                tuple_(entries.c.sort_ts, entries.c.kind, entries.c.row_id) < tuple_(before_ts, b_kind, b_id)
+            )
+        else:
+            page_q = page_q.where(entries.c.sort_ts < before_ts)
+    page_q = page_q.order_by(desc(entries.c.sort_ts), desc(entries.c.kind), desc(entries.c.row_id))
+    if limit is not None:
+        limit = max(1, min(limit, MAX_PAGE_LIMIT))
+        page_q = page_q.limit(limit + 1)
+
+    page = db.execute(page_q).all()
+    has_more = limit is not None and len(page) > limit
+    if has_more:
+        page = page[:limit]
+
+    order_ids = [r.row_id for r in page if r.kind == "ORDER"]
+    log_ids = [r.row_id for r in page if r.kind == "LOG"]
+    orders = {o.id: o for o in db.query(Order).filter(Order.id.in_(order_ids))} if order_ids else {}
+    logs = {l.id: l for l in db.query(DebtLog).filter(DebtLog.id.in_(log_ids))} if log_ids else {}
+    items_by_order = {oid: [] for oid in order_ids}
+    if order_ids:
+        for i in db.query(OrderItem).filter(OrderItem.order_id.in_(order_ids)).order_by(OrderItem.id):
+            items_by_order[i.order_id].append(i)
+
+    history = [
+        serialize_history_order(orders[r.row_id], items_by_order[r.row_id]) if r.kind == "ORDER"
+        else serialize_history_log(logs[r.row_id])
+        for r in page
+    ]
+    if limit is None:
+        return history
+
+    last = page[-1] if has_more else None
+    return {
+        "data": history,
+        "next_before_ts": last.sort_ts if last else None,
+        "next_before_key": f"{last.kind}:{last.row_id}" if last else None,
+    }
 
 
 @app.post("/customers/{cid}/history")
@@ -450,16 +714,106 @@ def update_order_date(order_id: int, data: OrderDateUpdate, db: Session = Depend
         db.rollback()
         raise HTTPException(status_code=500, detail=str(e))
 
+# --- STOCK: SET-BASED, RACE-FREE ---
+
+def _quantities(lines):
+    """Sum quantities per variant: [(variant_id, quantity, product_name)] -> {variant_id: qty}"""
+    needed = {}
+    for variant_id, quantity, _ in lines:
+        if variant_id:
+            needed[variant_id] = needed.get(variant_id, 0) + (quantity or 0)
+    return needed
+
+def _stamp_variants(db, variant_ids):
+    """row_version for /sync: bulk UPDATEs bypass the ORM hook (variants are stamped in the UPDATE itself)."""
+    db.query(Product).filter(
+        Product.id.in_(select(Variant.product_id).where(Variant.id.in_(variant_ids)))
+    ).update({Product.row_version: sync.next_version(db)}, synchronize_session=False)
+
+def take_stock(db, lines, short_detail, held=None):
+    """
+    Deduct stock for `lines` = [(variant_id, quantity, product_name)]:
+    one SELECT of every variant involved, then one guarded UPDATE
+    `stock = stock - q WHERE id IN (...) AND stock - reserved + h >= q`. Two checkouts racing for the last
+    pairs cannot both pass: the loser's UPDATE matches fewer rows and gets 409. Stock reserved for
+    other orders is not taken; `held` = {variant_id: h} is what this order had reserved itself
+    (reservations.take, which already released expired holds; otherwise they are released here).
+    `short_detail(product_name, available)` is the 400 message when the stock is simply not there,
+    or the variant was deleted.
+    The caller's rollback undoes everything on error.
+    """
+    needed = _quantities(lines)
+    if not needed:
+        return
+    if held is None:
+        reservations.release_expired(db)
+    held = {vid: qty for vid, qty in (held or {}).items() if vid in needed}
+    available = reservations.available_stock(db, needed)
+    for variant_id, _, name in lines:
+        if variant_id and variant_id not in available:
+            raise HTTPException(status_code=400, detail=short_detail(name, 0))
+        if variant_id and available[variant_id] + held.get(variant_id, 0) < needed[variant_id]:
+            raise HTTPException(status_code=400,
+                                detail=short_detail(name, available.get(variant_id, 0) + held.get(variant_id, 0)))
+
+    qty = case(needed, value=Variant.id)
+    values = {"stock": Variant.stock - qty, "row_version": sync.next_version(db)}
+    own = literal(0)
+    if held:
+        own = case(held, value=Variant.id, else_=0)
+        values["reserved"] = func.coalesce(Variant.reserved, 0) - own
+    updated = db.execute(
+        update(Variant)
+        .where(Variant.id.in_(needed), Variant.stock - func.coalesce(Variant.reserved, 0) + own >= qty)
+        .values(**values)
+        .execution_options(synchronize_session=False)
+    ).rowcount
+    if updated != len(needed):
+        raise HTTPException(status_code=409, detail="Tồn kho vừa thay đổi bởi đơn khác, vui lòng thử lại")
+    _stamp_variants(db, list(needed))
+
+def restore_stock(db, lines):
+    """Put stock back for `lines` (undoing an order) in one UPDATE."""
+    needed = _quantities(lines)
+    if not needed:
+        return
+    qty = case(needed, value=Variant.id)
+    db.execute(
+        update(Variant)
+        .where(Variant.id.in_(needed))
+        .values(stock=func.coalesce(Variant.stock, 0) + qty, row_version=sync.next_version(db))
+        .execution_options(synchronize_session=False)
+    )
+    _stamp_variants(db, list(needed))
+
+def cart_lines(cart):
+    return [(item.variant_id, item.quantity, item.product_name) for item in cart]
+
+def insert_items(db, order_id, cart):
+    """All order lines in one multi-row INSERT."""
+    if not cart:
+        return
+    db.execute(insert(OrderItem), [
+        {
+            "order_id": order_id,
+            "product_name": item.product_name,
+            "variant_id": item.variant_id,
+            "variant_info": f"{item.color}-{item.size}",
+            "quantity": item.quantity,
+            "price": item.price,
+        }
+        for item in cart
+    ])
+
 # --- API CHECKOUT & ORDERS ---
 @app.post("/checkout")
-def checkout(data: CheckoutRequest, db: Session = Depends(get_db)):
+def checkout(data: CheckoutRequest, db: Session = Depends(get_db), idempotency_key: IdempotencyKeyHeader = None):
+    return idempotency.run(db, idempotency_key, "POST /checkout", data, lambda: create_order(db, data))
+
+def create_order(db: Session, data: CheckoutRequest):
     try:
         total = sum([item.quantity * item.price for item in data.cart])
-        for item in data.cart:
-            variant = db.query(Variant).filter(Variant.id == item.variant_id).first()
-            if not variant or variant.stock < item.quantity:
-                raise HTTPException(status_code=400, detail=f"SP {item.product_name} thiếu hàng")
-            variant.stock -= item.quantity
+        take_stock(db, cart_lines(data.cart), lambda name, stock: f"SP {name} thiếu hàng")
 
         c_name = data.customer_name.strip() # Cắt khoảng trắng đầu cuối
         customer = None
@@ -473,7 +827,8 @@ def checkout(data: CheckoutRequest, db: Session = Depends(get_db)):
                 db.add(customer)
                 db.flush()
             
-            customer.debt += total
+            # computed in SQL, so concurrent orders for the same customer add up
+            customer.debt = Customer.debt + total
         new_order = Order(
             total_amount=total,
             customer_name=customer.name if customer else "Khách lẻ",
@@ -485,123 +840,421 @@ def checkout(data: CheckoutRequest, db: Session = Depends(get_db)):
         new_order.created_ts = int(datetime.utcnow().timestamp() * 1000)
         db.add(new_order)
         db.flush()
-        
-        for item in data.cart:
-            db.add(OrderItem(
-                order_id=new_order.id, 
-                product_name=item.product_name, 
-                variant_id=item.variant_id,
-                variant_info=f"{item.color}-{item.size}", 
-                quantity=item.quantity, 
-                price=item.price
-            ))
-            
+        insert_items(db, new_order.id, data.cart)
+
         db.commit()
+        catalog_changed()
         return {"status": "success"}
+    except HTTPException:
+        raise
     except Exception as e:
         db.rollback()
         raise HTTPException(status_code=500, detail=str(e))
 
 @app.put("/orders/{order_id}")
-def update_order_api(order_id: int, data: CheckoutRequest, db: Session = Depends(get_db)):
+def update_order_api(order_id: int, data: CheckoutRequest, db: Session = Depends(get_db),
+                     idempotency_key: IdempotencyKeyHeader = None):
+    return idempotency.run(db, idempotency_key, f"PUT /orders/{order_id}", data, lambda: update_order(db, order_id, data))
+
+def _add_debt(db, customer_id, amount):
+    """customer.debt += amount in SQL (concurrent orders add up); stamped for /sync."""
+    if not customer_id or not amount:
+        return
+    db.execute(
+        update(Customer)
+        .where(Customer.id == customer_id)
+        .values(debt=func.coalesce(Customer.debt, 0) + amount, row_version=sync.next_version(db))
+        .execution_options(synchronize_session=False)
+    )
+
+def _line_key(variant_id, product_name, variant_info, price):
+    return (variant_id, product_name, variant_info, price)
+
+def diff_order_lines(old_items, cart):
+    """
+    Match the stored lines of an order with the new cart by (variant, name, color-size, price).
+    Returns (quantity updates [{"id", "quantity"}], ids to delete, cart items to insert).
+    Lines that did not change are in none of them.
+    """
+    old_by_key = {}
+    for item in old_items:
+        old_by_key.setdefault(_line_key(item.variant_id, item.product_name, item.variant_info, item.price), []).append(item)
+    updates, inserts = [], []
+    for new in cart:
+        matches = old_by_key.get(_line_key(new.variant_id, new.product_name, f"{new.color}-{new.size}", new.price))
+        if not matches:
+            inserts.append(new)
+            continue
+        old = matches.pop(0)
+        if old.quantity != new.quantity:
+            updates.append({"id": old.id, "quantity": new.quantity})
+    deletes = [item.id for items in old_by_key.values() for item in items]
+    return updates, deletes, inserts
+
+def update_order(db: Session, order_id: int, data: CheckoutRequest):
+    """
+    Amend a completed order by difference: only lines that changed are written, stock moves
+    by the net quantity per variant and the debt by the net amount.
+    """
     try:
         old_order = db.query(Order).filter(Order.id == order_id).first()
         if not old_order:
             raise HTTPException(status_code=404, detail="Không tìm thấy đơn hàng")
         if old_order.status != 'completed':
             raise HTTPException(status_code=400, detail="Chỉ có thể sửa đơn hàng đã hoàn thành")
-        
-        # 1. Hoàn tác đơn cũ
-        for item in old_order.items:
-            if item.variant_id:
-                var = db.query(Variant).filter(Variant.id == item.variant_id).first()
-                if var:
-                    var.stock += item.quantity
-        
-        if old_order.customer_id:
-            cust = db.query(Customer).filter(Customer.id == old_order.customer_id).first()
-            if cust:
-                cust.debt -= old_order.total_amount
 
-        # 2. Xóa chi tiết đơn cũ
-        db.query(OrderItem).filter(OrderItem.order_id == order_id).delete()
-
-        # 3. Áp dụng đơn mới
+        old_items = db.query(OrderItem).filter(OrderItem.order_id == order_id).all()
+
+        # 1. Tồn kho: chỉ phần chênh lệch theo từng biến thể
+        delta = _quantities([(i.variant_id, i.quantity, i.product_name) for i in old_items])
+        for variant_id, qty in _quantities(cart_lines(data.cart)).items():
+            delta[variant_id] = delta.get(variant_id, 0) - qty
+        names = {i.variant_id: i.product_name for i in old_items}
+        names.update({i.variant_id: i.product_name for i in data.cart})
+        restore_stock(db, [(vid, d, names[vid]) for vid, d in delta.items() if d > 0])
+        take_stock(db, [(vid, -d, names[vid]) for vid, d in delta.items() if d < 0],
+                   lambda name, stock: f"SP {name} không đủ hàng để cập nhật")
+
+        # 2. Chi tiết đơn: chỉ sửa/xóa/thêm các dòng thay đổi
+        updates, deletes, inserts = diff_order_lines(old_items, data.cart)
+        if updates:
+            db.execute(update(OrderItem), updates)
+        if deletes:
+            db.query(OrderItem).filter(OrderItem.id.in_(deletes)).delete(synchronize_session=False)
+        insert_items(db, old_order.id, inserts)
+
+        # 3. Công nợ: chênh lệch tổng tiền (đổi khách → trả lại khách cũ, cộng khách mới)
         total_new = sum([item.quantity * item.price for item in data.cart])
-        
-        for item in data.cart:
-            variant = db.query(Variant).filter(Variant.id == item.variant_id).first()
-            if not variant or variant.stock < item.quantity:
-                raise HTTPException(status_code=400, detail=f"SP {item.product_name} không đủ hàng để cập nhật")
-            variant.stock -= item.quantity
-
         c_name = data.customer_name.strip()
-        customer = None
-        if c_name:
+        if c_name and c_name == old_order.customer_name and old_order.customer_id:
+            customer_id = old_order.customer_id
+        elif c_name:
             customer = db.query(Customer).filter(Customer.name == c_name).first()
             if not customer:
                 customer = Customer(name=c_name, phone=data.customer_phone, debt=0)
                 db.add(customer)
                 db.flush()
-            customer.debt += total_new
-        
+            customer_id = customer.id
+        else:
+            customer_id = None
+        if customer_id == old_order.customer_id:
+            _add_debt(db, customer_id, total_new - (old_order.total_amount or 0))
+        else:
+            _add_debt(db, old_order.customer_id, -(old_order.total_amount or 0))
+            _add_debt(db, customer_id, total_new)
+
         old_order.customer_name = c_name if c_name else "Khách lẻ"
-        old_order.customer_id = customer.id if customer else None
+        old_order.customer_id = customer_id
         old_order.total_amount = total_new
         now_dt = datetime.now()
         old_order.created_at = now_dt
         old_order.created_ts = int(now_dt.timestamp() * 1000)
 
-        for item in data.cart:
-            db.add(OrderItem(
-                order_id=old_order.id,
-                product_name=item.product_name,
-                variant_id=item.variant_id,
-                variant_info=f"{item.color}-{item.size}",
-                quantity=item.quantity,
-                price=item.price
-            ))
-
         db.commit()
+        if delta and any(delta.values()):
+            catalog_changed()
+        order_event("order.updated", old_order)
         return {"status": "updated"}
+    except HTTPException:
+        raise
     except Exception as e:
         db.rollback()
         raise HTTPException(status_code=500, detail=str(e))
 
-@app.get("/orders")
-def get_orders(page: int = 1, limit: int = 20, db: Session = Depends(get_db)):
-    skip = (page - 1) * limit
-    total = db.query(Order).filter(Order.status == 'completed').count()
-    orders = db.query(Order).filter(Order.status == 'completed').order_by(desc(Order.id)).offset(skip).limit(limit).all()
-    
-    result = []
-    for o in orders:
-        items_list = []
-        calc_qty = 0
-        if o.items:
-            for i in o.items:
-                calc_qty += i.quantity
-                items_list.append({
-                    "product_name": i.product_name,
-                    "variant_id": i.variant_id,
-                    "variant_info": i.variant_info,
-                    "quantity": i.quantity,
-                    "price": i.price
-                })
-        
-        amt = getattr(o, "total_amount", getattr(o, "total_money", 0))
-        result.append({
-            "id": o.id,
-            "created_at": o.created_at.strftime("%Y-%m-%d %H:%M"),
-            "customer_name": o.customer_name or "Khách lẻ",
-            "total_amount": amt,
-            "total_qty": calc_qty,
-            "items": items_list
+# --- BULK ORDER IMPORT ---
+BULK_ORDER_LIMIT = 50000
+BULK_CHUNK_SIZE = 500      # orders per transaction
+LOOKUP_CHUNK_SIZE = 500    # ids / names per IN (...) lookup
+
+class BulkOrder(CheckoutRequest):
+    created_at: Optional[datetime] = None  # default: now
+
+class BulkOrderRequest(BaseModel):
+    orders: List[BulkOrder]
+    deduct_stock: bool = False  # historical sales are usually already out of the counted stock
+
+def _order_time(created_at):
+    """(naive local datetime, epoch ms) for an imported order."""
+    if created_at is None:
+        created_at = datetime.now()
+    elif created_at.tzinfo is not None:
+        created_at = created_at.astimezone().replace(tzinfo=None)
+    return created_at, int(created_at.timestamp() * 1000)
+
+def _customers_by_name(db, lowered_names):
+    """{lower(name): (id, name)} in one query per LOOKUP_CHUNK_SIZE names."""
+    found = {}
+    for chunk in _chunks(lowered_names, LOOKUP_CHUNK_SIZE):
+        rows = db.query(Customer.id, Customer.name).filter(func.lower(Customer.name).in_(chunk))
+        for cid, name in rows:
+            found.setdefault(name.lower(), (cid, name))
+    return found
+
+def _validate_bulk(db, orders, deduct_stock):
+    """Per-order error message (or None), checked for the whole set at once."""
+    errors = [None] * len(orders)
+    for idx, order in enumerate(orders):
+        if not order.cart:
+            errors[idx] = "Đơn hàng không có sản phẩm"
+        elif any(item.quantity <= 0 or item.price < 0 for item in order.cart):
+            errors[idx] = "Số lượng phải > 0 và đơn giá >= 0"
+
+    variant_ids = {item.variant_id for idx, o in enumerate(orders) if errors[idx] is None for item in o.cart}
+    stock = {}  # available to promise: stock reserved for open orders is not sold again
+    for chunk in _chunks(variant_ids, LOOKUP_CHUNK_SIZE):
+        stock.update(reservations.available_stock(db, chunk))
+
+    for idx, order in enumerate(orders):
+        if errors[idx] is not None:
+            continue
+        missing = next((item for item in order.cart if item.variant_id not in stock), None)
+        if missing is not None:
+            errors[idx] = f"Không tìm thấy biến thể #{missing.variant_id} ({missing.product_name})"
+            continue
+        if deduct_stock:
+            # orders are taken in request order: the first ones get the stock
+            needed = _quantities(cart_lines(order.cart))
+            short = next((item for item in order.cart if (stock[item.variant_id] or 0) < needed[item.variant_id]), None)
+            if short is not None:
+                errors[idx] = f"SP {short.product_name} thiếu hàng"
+                continue
+            for variant_id, qty in needed.items():
+                stock[variant_id] = (stock[variant_id] or 0) - qty
+    return errors
+
+def _import_chunk(db, chunk, customers, deduct_stock):
+    """Insert one chunk of (index, order) in the current transaction. Returns the new order ids."""
+    ver = sync.next_version(db)
+
+    new_names = {}
+    for _, order in chunk:
+        c_name = order.customer_name.strip()
+        if c_name and c_name.lower() not in customers:
+            new_names.setdefault(c_name.lower(), {"name": c_name, "phone": order.customer_phone, "debt": 0, "row_version": ver})
+    if new_names:
+        db.execute(insert(Customer), list(new_names.values()))
+        customers.update(_customers_by_name(db, list(new_names)))
+
+    order_rows, debts = [], {}
+    for _, order in chunk:
+        total = sum(item.quantity * item.price for item in order.cart)
+        customer = customers.get(order.customer_name.strip().lower()) if order.customer_name.strip() else None
+        created_at, created_ts = _order_time(order.created_at)
+        order_rows.append({
+            "customer_name": customer[1] if customer else "Khách lẻ",
+            "customer_id": customer[0] if customer else None,
+            "total_amount": total,
+            "created_at": created_at,
+            "created_ts": created_ts,
+            "is_draft": 0,
+            "status": "completed",
+            "row_version": ver,
+        })
+        if customer:
+            debts[customer[0]] = debts.get(customer[0], 0) + total
+
+    order_ids = db.execute(
+        insert(Order).returning(Order.id, sort_by_parameter_order=True), order_rows
+    ).scalars().all()
+    db.execute(insert(OrderItem), [
+        {
+            "order_id": order_id,
+            "product_name": item.product_name,
+            "variant_id": item.variant_id,
+            "variant_info": f"{item.color}-{item.size}",
+            "quantity": item.quantity,
+            "price": item.price,
+        }
+        for order_id, (_, order) in zip(order_ids, chunk)
+        for item in order.cart
+    ])
+
+    if debts:
+        db.execute(
+            update(Customer)
+            .where(Customer.id.in_(debts))
+            .values(debt=func.coalesce(Customer.debt, 0) + case(debts, value=Customer.id), row_version=ver)
+            .execution_options(synchronize_session=False)
+        )
+    if deduct_stock:
+        take_stock(db, [line for _, order in chunk for line in cart_lines(order.cart)],
+                   lambda name, stock: f"SP {name} thiếu hàng")
+    return order_ids
+
+def import_orders(db: Session, orders, deduct_stock=False):
+    """
+    Write many completed orders: validation and customer/variant lookups are done
+    for the whole set, then BULK_CHUNK_SIZE orders per transaction with multi-row
+    INSERTs (orders, items, new customers) and one UPDATE for the debts (and stock).
+    A failing chunk is rolled back alone; each order gets its own result.
+    """
+    errors = _validate_bulk(db, orders, deduct_stock)
+    results = [
+        {"index": idx, "status": "error", "detail": error} if error else None
+        for idx, error in enumerate(errors)
+    ]
+    valid = [(idx, order) for idx, order in enumerate(orders) if errors[idx] is None]
+    customers = _customers_by_name(db, {o.customer_name.strip().lower() for _, o in valid if o.customer_name.strip()})
+    db.rollback()  # end the read transaction: each chunk is its own short write
+
+    for chunk in _chunks(valid, BULK_CHUNK_SIZE):
+        try:
+            order_ids = _import_chunk(db, chunk, customers, deduct_stock)
+            db.commit()
+        except Exception as e:
+            db.rollback()
+            # customers inserted by this chunk are gone with it
+            customers = _customers_by_name(db, list(customers))
+            detail = e.detail if isinstance(e, HTTPException) else str(e)
+            for idx, _ in chunk:
+                results[idx] = {"index": idx, "status": "error", "detail": detail}
+            continue
+        for order_id, (idx, _) in zip(order_ids, chunk):
+            results[idx] = {"index": idx, "status": "created", "order_id": order_id}
+
+    created = sum(1 for r in results if r["status"] == "created")
+    if created and deduct_stock:
+        catalog_changed()
+    return {"created": created, "failed": len(results) - created, "results": results}
+
+@app.post("/orders/bulk")
+def bulk_import_orders(data: BulkOrderRequest, db: Session = Depends(get_db)):
+    """Import many completed orders (e.g. historical sales from a spreadsheet) in one request."""
+    if len(data.orders) > BULK_ORDER_LIMIT:
+        raise HTTPException(status_code=400, detail=f"Tối đa {BULK_ORDER_LIMIT} đơn mỗi lần nhập")
+    return import_orders(db, data.orders, data.deduct_stock)
+
+def fetch_orders_with_items(db, order_query):
+    """
+    [(order, items)] in 2 queries (one more per PARENT_IDS_PER_QUERY orders): items are fetched
+    by the ids of the orders already loaded, so an order committed in between cannot shift the window.
+    """
+    orders = order_query.all()
+    items_by_order = {o.id: [] for o in orders}
+    for chunk in _chunks(items_by_order, PARENT_IDS_PER_QUERY):
+        for i in db.query(OrderItem).filter(OrderItem.order_id.in_(chunk)).order_by(OrderItem.id):
+            items_by_order[i.order_id].append(i)
+    return [(o, items_by_order[o.id]) for o in orders]
+
+def load_orders(db, order_query):
+    return [serialize_order(o, items) for o, items in fetch_orders_with_items(db, order_query)]
+
+def serialize_order(o, items):
+    items_list = []
+    calc_qty = 0
+    for i in items:
+        calc_qty += i.quantity or 0
+        items_list.append({
+            "product_name": i.product_name,
+            "variant_id": i.variant_id,
+            "variant_info": i.variant_info,
+            "quantity": i.quantity,
+            "price": i.price
         })
-    return {"data": result, "total": total, "page": page, "limit": limit}
+    return {
+        "id": o.id,
+        "created_at": o.created_at.strftime("%Y-%m-%d %H:%M") if o.created_at else "",
+        "customer_name": o.customer_name or "Khách lẻ",
+        "customer_id": o.customer_id,
+        "total_amount": o.total_amount,
+        "total_qty": calc_qty,
+        "status": o.status,
+        "items": items_list
+    }
+
+# (sync version, count) — every write bumps the sync version, so a matching version means no write happened
+_completed_count_cache = (None, 0)
+
+def completed_orders_total(db):
+    global _completed_count_cache
+    ver = sync.current_version(db)
+    cached_ver, total = _completed_count_cache
+    if cached_ver != ver:
+        total = db.query(func.count(Order.id)).filter(Order.status == 'completed').scalar() or 0
+        _completed_count_cache = (ver, total)
+    return total
+
+@app.get("/orders")
+async def get_orders(
+    page: int = 1,
+    limit: int = 20,
+    before_id: Optional[int] = None,
+    after_id: Optional[int] = None,
+):
+    return await run_db(list_orders, page, limit, before_id, after_id)
+
+def list_orders(db, page=1, limit=20, before_id=None, after_id=None):
+    """
+    Completed orders, newest first.
+    - Page mode (default): `page` + `limit` (OFFSET, kept for existing clients).
+    - Keyset mode: `before_id` → the `limit` orders older than that id; `after_id` → the `limit`
+      orders right after it (newer). Use `next_before_id` / `prev_after_id` from the response.
+    `total` is cached and only recounted after a write.
+    """
+    limit = max(1, min(limit, MAX_PAGE_LIMIT))
+    query = db.query(Order).filter(Order.status == 'completed')
+    if before_id is not None:
+        query = query.filter(Order.id < before_id).order_by(desc(Order.id)).limit(limit)
+    elif after_id is not None:
+        query = query.filter(Order.id > after_id).order_by(Order.id).limit(limit)
+    else:
+        query = query.order_by(desc(Order.id)).offset((page - 1) * limit).limit(limit)
+
+    rows = fetch_orders_with_items(db, query)
+    if after_id is not None and before_id is None:
+        rows.reverse()
+    result = [serialize_order(o, items) for o, items in rows]
+
+    return {
+        "data": result,
+        "total": completed_orders_total(db),
+        "page": page if before_id is None and after_id is None else None,
+        "limit": limit,
+        "next_before_id": result[-1]["id"] if result else None,
+        "prev_after_id": result[0]["id"] if result else None,
+    }
+
+@app.get("/stats/pool")
+def get_pool_stats():
+    """Connection pool usage of the engine."""
+    return {"sync": pool_stats(engine)}
+
+@app.get("/stats/summary")
+async def get_stats_summary(recent: int = 5):
+    return await run_db(stats_summary, recent)
+
+def stats_summary(db, recent=5):
+    """Dashboard numbers in one small response: one aggregate query + the latest completed orders."""
+    def count(col, *where):
+        return select(func.count(col)).where(*where).scalar_subquery()
+
+    row = db.execute(select(
+        count(Product.id).label("products"),
+        count(Variant.id).label("variants"),
+        count(Customer.id).label("customers"),
+        select(func.coalesce(func.sum(Customer.debt), 0)).scalar_subquery().label("total_debt"),
+        count(Order.id, Order.status == 'pending').label("pending"),
+        count(Order.id, Order.status == 'accepted').label("accepted"),
+    )).one()
+
+    recent = max(0, min(recent, 50))
+    recent_q = db.query(Order).filter(Order.status == 'completed').order_by(desc(Order.id)).limit(recent)
+    return {
+        "total_products": row.products,
+        "total_variants": row.variants,
+        "total_customers": row.customers,
+        "total_debt": int(row.total_debt or 0),
+        "total_orders": completed_orders_total(db),
+        "pending_orders": row.pending,
+        "accepted_orders": row.accepted,
+        "recent_orders": load_orders(db, recent_q) if recent else [],
+    }
 
 @app.delete("/orders/{order_id}")
-def delete_order_only(order_id: int, db: Session = Depends(get_db)):
+def delete_order_only(order_id: int, db: Session = Depends(get_db), idempotency_key: IdempotencyKeyHeader = None):
+    return idempotency.run(db, idempotency_key, f"DELETE /orders/{order_id}", None, lambda: delete_order(db, order_id))
+
+def delete_order(db: Session, order_id: int):
     order = db.query(Order).filter(Order.id == order_id).first()
     if not order:
         raise HTTPException(status_code=404, detail="Hóa đơn không tồn tại")
@@ -609,11 +1262,7 @@ def delete_order_only(order_id: int, db: Session = Depends(get_db)):
         raise HTTPException(status_code=400, detail="Chỉ có thể xóa/hoàn tác đơn hàng đã hoàn thành")
     try:
         # 1) Restore variant stock from items
-        for item in order.items:
-            if item.variant_id:
-                var = db.query(Variant).filter(Variant.id == item.variant_id).first()
-                if var:
-                    var.stock = (var.stock or 0) + (item.quantity or 0)
+        restore_stock(db, [(i.variant_id, i.quantity, i.product_name) for i in order.items])
 
         # 2) Revert customer debt if linked
         if order.customer_id:
@@ -629,6 +1278,8 @@ def delete_order_only(order_id: int, db: Session = Depends(get_db)):
         db.query(OrderItem).filter(OrderItem.order_id == order_id).delete()
         db.delete(order)
         db.commit()
+        catalog_changed()
+        events.publish("order.deleted", {"order_id": order_id, "status": "deleted"})
         return {"detail": "Đã xóa hóa đơn và hoàn tác kho + công nợ"}
     except Exception as e:
         db.rollback()
@@ -640,10 +1291,20 @@ def delete_order_only(order_id: int, db: Session = Depends(get_db)):
 # ───────────────────────────────────────────────────────────────
 
 @app.post("/checkout/draft")
-def checkout_draft(data: CheckoutRequest, db: Session = Depends(get_db)):
+def checkout_draft(data: CheckoutRequest, db: Session = Depends(get_db), idempotency_key: IdempotencyKeyHeader = None):
+    return idempotency.run(db, idempotency_key, "POST /checkout/draft", data, lambda: create_draft(db, data))
+
+@app.post("/checkout/draft/approve")
+def checkout_draft_approved(data: CheckoutRequest, db: Session = Depends(get_db), idempotency_key: IdempotencyKeyHeader = None):
+    """Desktop staff flow: create the order already ACCEPTED (draft + approve in one call and one transaction)."""
+    return idempotency.run(db, idempotency_key, "POST /checkout/draft/approve", data,
+                           lambda: create_draft(db, data, approve=True))
+
+def create_draft(db: Session, data: CheckoutRequest, approve=False):
     """
-    Create a PENDING order from orderer app.
-    Stock and debt are NOT applied yet — waiting for staff accept → picker confirm.
+    Create a PENDING order from orderer app (ACCEPTED with `approve`: straight to the picker).
+    Its stock is reserved (backend/reservations.py); stock and debt are NOT applied yet —
+    waiting for staff accept → picker confirm.
     """
     try:
         total = sum([item.quantity * item.price for item in data.cart])
@@ -665,26 +1326,28 @@ def checkout_draft(data: CheckoutRequest, db: Session = Depends(get_db)):
             customer_name=customer.name if customer else "Khách lẻ",
             customer_id=customer.id if customer else None,
             is_draft=1,
-            status='pending'
+            status='accepted' if approve else 'pending'
         )
         new_order.created_ts = int(datetime.utcnow().timestamp() * 1000)
         db.add(new_order)
         db.flush()
-
-        for item in data.cart:
-            db.add(OrderItem(
-                order_id=new_order.id,
-                product_name=item.product_name,
-                variant_id=item.variant_id,
-                variant_info=f"{item.color}-{item.size}",
-                quantity=item.quantity,
-                price=item.price
-            ))
+        insert_items(db, new_order.id, data.cart)
+        short = reservations.reserve(db, {new_order.id: [(i.variant_id, i.quantity) for i in data.cart]})
 
         db.commit()
+        if approve:
+            order_event("order.approved", new_order)
+            return {
+                "status": "success",
+                "order_id": new_order.id,
+                "has_stock_conflict": bool(short),
+                "message": f"Đơn #{new_order.id} đã được tiếp nhận, chuyển cho picker soạn hàng"
+            }
+        order_event("order.created", new_order)
         return {
             "status": "success",
             "order_id": new_order.id,
+            "has_stock_conflict": bool(short),
             "message": "Đơn hàng đã gửi chờ staff tiếp nhận"
         }
     except Exception as e:
@@ -692,118 +1355,137 @@ def checkout_draft(data: CheckoutRequest, db: Session = Depends(get_db)):
         raise HTTPException(status_code=500, detail=str(e))
 
 
+def load_queue(db, status):
+    """
+    Orders in a queue status with their items and stock per item — 3 queries total:
+    orders, their items, and one row per order and variant with the variant's stock,
+    its reserved total and what this order holds of it (backend/reservations.py), expired holds left out.
+    A line is short when the stock not promised to other orders does not cover it.
+    """
+    order_query = db.query(Order).filter(Order.status == status).order_by(desc(Order.created_ts))
+    rows = fetch_orders_with_items(db, order_query)
+
+    stock, held = {}, {}
+    if any(i.variant_id for _, items in rows for i in items):
+        now = datetime.now()
+        for order_id, variant_id, current, reserved, own in (
+            db.query(OrderItem.order_id, Variant.id, Variant.stock, reservations.live_reserved(now), StockReservation.quantity)
+            .join(Order, Order.id == OrderItem.order_id)
+            .join(Variant, Variant.id == OrderItem.variant_id)
+            .outerjoin(StockReservation, and_(StockReservation.order_id == OrderItem.order_id,
+                                              StockReservation.variant_id == OrderItem.variant_id,
+                                              StockReservation.expires_at >= now))
+            .filter(Order.status == status)
+            .distinct()
+        ):
+            stock[variant_id] = (int(current or 0), int(reserved or 0))
+            held[(order_id, variant_id)] = int(own or 0)
+
+    result = []
+    for o, items in rows:
+        data = serialize_order(o, items)
+        needed = _quantities([(i.variant_id, i.quantity, i.product_name) for i in items])
+        has_stock_conflict = False
+        for item_dict, i in zip(data["items"], items):
+            current_stock = None
+            reserved = 0
+            enough_stock = True
+            if i.variant_id:
+                current_stock, reserved_total = stock.get(i.variant_id, (0, 0))
+                reserved = held.get((o.id, i.variant_id), 0)
+                available = current_stock - reserved_total + reserved
+                enough_stock = available >= needed[i.variant_id]
+                if not enough_stock:
+                    has_stock_conflict = True
+            item_dict["current_stock"] = current_stock
+            item_dict["reserved"] = reserved
+            item_dict["enough_stock"] = enough_stock
+        data["has_stock_conflict"] = has_stock_conflict
+        result.append(data)
+    return {"data": result, "count": len(result)}
+
+
 @app.get("/orders/pending")
-def get_pending_orders(db: Session = Depends(get_db)):
+async def get_pending_orders():
     """Get all PENDING orders (status='pending') for staff to accept/reject."""
     try:
-        orders = db.query(Order).filter(Order.status == 'pending').order_by(desc(Order.created_ts)).all()
-
-        result = []
-        for o in orders:
-            items_list = []
-            calc_qty = 0
-            has_stock_conflict = False
-            if o.items:
-                for i in o.items:
-                    calc_qty += i.quantity
-                    current_stock = None
-                    enough_stock = True
-                    if i.variant_id:
-                        var = db.query(Variant).filter(Variant.id == i.variant_id).first()
-                        current_stock = int(var.stock or 0) if var else 0
-                        enough_stock = current_stock >= int(i.quantity or 0)
-                        if not enough_stock:
-                            has_stock_conflict = True
-                    items_list.append({
-                        "product_name": i.product_name,
-                        "variant_id": i.variant_id,
-                        "variant_info": i.variant_info,
-                        "quantity": i.quantity,
-                        "price": i.price,
-                        "current_stock": current_stock,
-                        "enough_stock": enough_stock,
-                    })
-
-            result.append({
-                "id": o.id,
-                "created_at": o.created_at.strftime("%Y-%m-%d %H:%M") if o.created_at else "",
-                "customer_name": o.customer_name or "Khách lẻ",
-                "customer_id": o.customer_id,
-                "total_amount": o.total_amount,
-                "total_qty": calc_qty,
-                "status": o.status,
-                "has_stock_conflict": has_stock_conflict,
-                "items": items_list
-            })
-
-        return {"data": result, "count": len(result)}
+        return await run_db(load_queue, 'pending')
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
 
 @app.get("/orders/accepted")
-def get_accepted_orders(db: Session = Depends(get_db)):
+async def get_accepted_orders():
     """Get all ACCEPTED orders (status='accepted') for picker to confirm."""
     try:
-        orders = db.query(Order).filter(Order.status == 'accepted').order_by(desc(Order.created_ts)).all()
-
-        result = []
-        for o in orders:
-            items_list = []
-            calc_qty = 0
-            has_stock_conflict = False
-            if o.items:
-                for i in o.items:
-                    calc_qty += i.quantity
-                    current_stock = None
-                    enough_stock = True
-                    if i.variant_id:
-                        var = db.query(Variant).filter(Variant.id == i.variant_id).first()
-                        current_stock = int(var.stock or 0) if var else 0
-                        enough_stock = current_stock >= int(i.quantity or 0)
-                        if not enough_stock:
-                            has_stock_conflict = True
-                    items_list.append({
-                        "product_name": i.product_name,
-                        "variant_id": i.variant_id,
-                        "variant_info": i.variant_info,
-                        "quantity": i.quantity,
-                        "price": i.price,
-                        "current_stock": current_stock,
-                        "enough_stock": enough_stock,
-                    })
-
-            result.append({
-                "id": o.id,
-                "created_at": o.created_at.strftime("%Y-%m-%d %H:%M") if o.created_at else "",
-                "customer_name": o.customer_name or "Khách lẻ",
-                "customer_id": o.customer_id,
-                "total_amount": o.total_amount,
-                "total_qty": calc_qty,
-                "status": o.status,
-                "has_stock_conflict": has_stock_conflict,
-                "items": items_list
-            })
-
-        return {"data": result, "count": len(result)}
+        return await run_db(load_queue, 'accepted')
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
 
+class OrderStatusQuery(BaseModel):
+    ids: List[int]
+
+MAX_STATUS_IDS = 500
+
+def order_statuses(db, ids):
+    """
+    {id: status} for many orders in one indexed IN query. Orders that no longer exist
+    are reported as 'deleted' (rejected drafts and deleted invoices leave a tombstone),
+    or 'not_found' if there is no trace of them.
+    """
+    ids = list(dict.fromkeys(ids))
+    if len(ids) > MAX_STATUS_IDS:
+        raise HTTPException(status_code=400, detail=f"Tối đa {MAX_STATUS_IDS} đơn mỗi lần")
+    if not ids:
+        return {}
+    found = dict(db.query(Order.id, Order.status).filter(Order.id.in_(ids)).all())
+    missing = [i for i in ids if i not in found]
+    deleted = set()
+    if missing:
+        deleted = {rid for (rid,) in db.query(Tombstone.row_id).filter(
+            Tombstone.table_name == Order.__tablename__, Tombstone.row_id.in_(missing)
+        )}
+    return {
+        str(i): found[i] if i in found else ("deleted" if i in deleted else "not_found")
+        for i in ids
+    }
+
+
+@app.get("/orders/status")
+async def get_order_statuses(ids: str = ""):
+    """Bulk status for orderer polling: /orders/status?ids=1,2,3 → {"statuses": {"1": "pending", ...}}"""
+    try:
+        id_list = [int(x) for x in ids.split(",") if x.strip()]
+    except ValueError:
+        raise HTTPException(status_code=400, detail="ids phải là danh sách số")
+    return {"statuses": await run_db(order_statuses, id_list)}
+
+
+@app.post("/orders/status")
+async def post_order_statuses(data: OrderStatusQuery):
+    """Same as GET /orders/status, for id lists too long for a URL."""
+    return {"statuses": await run_db(order_statuses, data.ids)}
+
+
 @app.get("/orders/{order_id}/status")
-def get_order_status(order_id: int, db: Session = Depends(get_db)):
+async def get_order_status(order_id: int):
     """Lightweight status check for orderer polling. Returns 404 if deleted/rejected."""
-    order = db.query(Order).filter(Order.id == order_id).first()
-    if not order:
+    status = (await run_db(order_statuses, [order_id]))[str(order_id)]
+    if status in ("deleted", "not_found"):
         raise HTTPException(status_code=404, detail="Đơn hàng không tồn tại hoặc đã bị từ chối")
-    return {"id": order_id, "status": order.status}
+    return {"id": order_id, "status": status}
 
 
 @app.put("/orders/{order_id}/approve")
-def approve_order(order_id: int, db: Session = Depends(get_db)):
+def approve_order(order_id: int, db: Session = Depends(get_db), idempotency_key: IdempotencyKeyHeader = None):
+    return idempotency.run(db, idempotency_key, f"PUT /orders/{order_id}/approve", None, lambda: accept_order(db, order_id))
+
+def accept_order(db: Session, order_id: int):
     """
     Staff accepts a PENDING order → moves to ACCEPTED for picker.
-    Stock and debt are NOT changed yet (picker confirm handles that).
+    Its reservations are renewed (and retried for lines that had none);
+    stock and debt are NOT changed yet (picker confirm handles that).
     """
     try:
         order = db.query(Order).filter(Order.id == order_id).first()
@@ -815,7 +1497,9 @@ def approve_order(order_id: int, db: Session = Depends(get_db)):
 
         order.status = 'accepted'
         order.is_draft = 1  # keep is_draft consistent (still not finalized)
+        reservations.reserve(db, {order_id: [(i.variant_id, i.quantity) for i in order.items]})
         db.commit()
+        order_event("order.approved", order)
 
         return {
             "status": "success",
@@ -827,7 +1511,10 @@ def approve_order(order_id: int, db: Session = Depends(get_db)):
 
 
 @app.put("/orders/{order_id}/confirm")
-def confirm_order(order_id: int, db: Session = Depends(get_db)):
+def confirm_order(order_id: int, db: Session = Depends(get_db), idempotency_key: IdempotencyKeyHeader = None):
+    return idempotency.run(db, idempotency_key, f"PUT /orders/{order_id}/confirm", None, lambda: complete_order(db, order_id))
+
+def complete_order(db: Session, order_id: int):
     """
     Picker confirms delivery → applies to database:
     - Deduct stock from variants
@@ -842,47 +1529,45 @@ def confirm_order(order_id: int, db: Session = Depends(get_db)):
         if order.status != 'accepted':
             raise HTTPException(status_code=400, detail="Chỉ có thể xác nhận đơn hàng đã được tiếp nhận")
 
-        # 1) Check stock availability
-        for item in order.items:
-            if item.variant_id:
-                var = db.query(Variant).filter(Variant.id == item.variant_id).first()
-                if not var or var.stock < item.quantity:
-                    raise HTTPException(
-                        status_code=400,
-                        detail=f"SP {item.product_name} không đủ hàng ({var.stock if var else 0} tồn kho)"
-                    )
-
-        # 2) Deduct stock
-        for item in order.items:
-            if item.variant_id:
-                var = db.query(Variant).filter(Variant.id == item.variant_id).first()
-                if var:
-                    var.stock -= item.quantity
+        # 1-2) Check stock availability and deduct it (one guarded UPDATE), using up the order's reservation
+        take_stock(
+            db,
+            [(i.variant_id, i.quantity, i.product_name) for i in order.items],
+            lambda name, stock: f"SP {name} không đủ hàng ({stock} có thể bán)",
+            held=reservations.take(db, [order_id]),
+        )
 
         # 3) Add customer debt (do NOT create DebtLog here to avoid duplicate history with ORDER record)
         if order.customer_id:
             customer = db.query(Customer).filter(Customer.id == order.customer_id).first()
             if customer:
-                customer.debt += order.total_amount
+                customer.debt = Customer.debt + order.total_amount
 
         # 4) Mark as completed
         order.status = 'completed'
         order.is_draft = 0
         db.commit()
+        catalog_changed()
+        order_event("order.confirmed", order)
 
         return {
             "status": "success",
             "message": f"Đơn #{order_id} đã xác nhận hoàn thành và cập nhật kho + công nợ"
         }
+    except HTTPException:
+        raise
     except Exception as e:
         db.rollback()
         raise HTTPException(status_code=500, detail=str(e))
 
 
 @app.delete("/orders/{order_id}/reject")
-def reject_order(order_id: int, db: Session = Depends(get_db)):
+def reject_order(order_id: int, db: Session = Depends(get_db), idempotency_key: IdempotencyKeyHeader = None):
+    return idempotency.run(db, idempotency_key, f"DELETE /orders/{order_id}/reject", None, lambda: discard_order(db, order_id))
+
+def discard_order(db: Session, order_id: int):
     """
-    Staff rejects a PENDING order — deletes it completely.
+    Staff rejects a PENDING order — deletes it completely and releases its reservations.
     No stock/debt changes (nothing was applied yet).
     """
     try:
@@ -893,11 +1578,405 @@ def reject_order(order_id: int, db: Session = Depends(get_db)):
         if order.status != 'pending':
             raise HTTPException(status_code=400, detail="Chỉ có thể từ chối đơn đang chờ duyệt")
 
+        reservations.release(db, [order_id])
         db.query(OrderItem).filter(OrderItem.order_id == order_id).delete()
         db.delete(order)
         db.commit()
+        events.publish("order.rejected", {"order_id": order_id, "status": "rejected"})
 
         return {"status": "success", "message": f"Đơn #{order_id} đã bị từ chối và xóa"}
     except Exception as e:
         db.rollback()
-        raise HTTPException(status_code=500, detail=str(e))
\ No newline at end of file
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+# ───────────────────────────────────────────────────────────────
+# BATCH QUEUE ACTIONS: MANY ORDERS, ONE TRANSACTION
+# ───────────────────────────────────────────────────────────────
+
+MAX_BATCH_IDS = 500
+
+class OrderBatch(BaseModel):
+    ids: List[int]
+
+def _load_batch(db, ids, required_status, wrong_status_detail):
+    """
+    One SELECT for the batch. Returns ({id: order row} of the orders in `required_status`,
+    {id: outcome} for the ones that are missing or in another status).
+    """
+    ids = list(dict.fromkeys(ids))
+    if not ids:
+        raise HTTPException(status_code=400, detail="Thiếu danh sách đơn")
+    if len(ids) > MAX_BATCH_IDS:
+        raise HTTPException(status_code=400, detail=f"Tối đa {MAX_BATCH_IDS} đơn mỗi lần")
+    rows = {r.id: r for r in db.query(Order.id, Order.status, Order.customer_id, Order.customer_name, Order.total_amount)
+            .filter(Order.id.in_(ids))}
+    eligible, outcomes = {}, {}
+    for order_id in ids:
+        row = rows.get(order_id)
+        if row is None:
+            outcomes[order_id] = {"order_id": order_id, "ok": False, "detail": "Hóa đơn không tồn tại"}
+        elif row.status != required_status:
+            outcomes[order_id] = {"order_id": order_id, "ok": False, "detail": wrong_status_detail}
+        else:
+            eligible[order_id] = row
+    return ids, eligible, outcomes
+
+def _move_orders(db, order_ids, from_status, to_status, is_draft):
+    """UPDATE the status of `order_ids` still in `from_status`. Returns the ids actually moved."""
+    if not order_ids:
+        return set()
+    return set(db.execute(
+        update(Order)
+        .where(Order.id.in_(order_ids), Order.status == from_status)
+        .values(status=to_status, is_draft=is_draft, row_version=sync.next_version(db))
+        .returning(Order.id)
+        .execution_options(synchronize_session=False)
+    ).scalars().all())
+
+def _batch_result(ids, outcomes, moved, rows, status, event_type):
+    for order_id in moved:
+        outcomes[order_id] = {"order_id": order_id, "ok": True, "status": status}
+        row = rows[order_id]
+        events.publish(event_type, {"order_id": order_id, "status": status,
+                                    "customer_name": row.customer_name, "total_amount": row.total_amount})
+    results = [outcomes.get(order_id) or {"order_id": order_id, "ok": False, "detail": "Đơn vừa được xử lý bởi thao tác khác"}
+               for order_id in ids]
+    succeeded = sum(1 for r in results if r["ok"])
+    return {"succeeded": succeeded, "failed": len(results) - succeeded, "results": results}
+
+@app.post("/orders/batch/approve")
+def approve_orders(data: OrderBatch, db: Session = Depends(get_db), idempotency_key: IdempotencyKeyHeader = None):
+    return idempotency.run(db, idempotency_key, "POST /orders/batch/approve", data, lambda: accept_orders(db, data.ids))
+
+def accept_orders(db: Session, ids):
+    """
+    PENDING → ACCEPTED for every listed order that is pending: one SELECT, one UPDATE,
+    then their reservations are renewed/retried in list order for the whole batch at once.
+    """
+    try:
+        ids, rows, outcomes = _load_batch(db, ids, "pending", "Chỉ có thể tiếp nhận đơn đang chờ duyệt")
+        moved = _move_orders(db, list(rows), "pending", "accepted", 1)
+        if moved:
+            lines = {order_id: [] for order_id in ids if order_id in moved}
+            for order_id, variant_id, quantity in db.query(OrderItem.order_id, OrderItem.variant_id, OrderItem.quantity) \
+                    .filter(OrderItem.order_id.in_(list(moved))):
+                lines[order_id].append((variant_id, quantity))
+            reservations.reserve(db, lines)
+        db.commit()
+    except HTTPException:
+        raise
+    except Exception as e:
+        db.rollback()
+        raise HTTPException(status_code=500, detail=str(e))
+    return _batch_result(ids, outcomes, moved, rows, "accepted", "order.approved")
+
+@app.post("/orders/batch/confirm")
+def confirm_orders(data: OrderBatch, db: Session = Depends(get_db), idempotency_key: IdempotencyKeyHeader = None):
+    return idempotency.run(db, idempotency_key, "POST /orders/batch/confirm", data, lambda: complete_orders(db, data.ids))
+
+def complete_orders(db: Session, ids):
+    """
+    ACCEPTED → COMPLETED for a picker's whole run in one transaction: the items, reservations
+    and available stock of every order are read once, orders are served in list order while
+    stock lasts (the others stay accepted with their reason), then the confirmed orders'
+    reservations are taken and one guarded stock UPDATE, one debt UPDATE and one status UPDATE
+    cover all of them.
+    """
+    try:
+        ids, rows, outcomes = _load_batch(db, ids, "accepted", "Chỉ có thể xác nhận đơn hàng đã được tiếp nhận")
+        items = {}
+        if rows:
+            for item in db.query(OrderItem.order_id, OrderItem.variant_id, OrderItem.quantity, OrderItem.product_name) \
+                    .filter(OrderItem.order_id.in_(list(rows))):
+                items.setdefault(item.order_id, []).append((item.variant_id, item.quantity, item.product_name))
+        variant_ids = {line[0] for lines in items.values() for line in lines if line[0]}
+        available = reservations.available_stock(db, variant_ids)
+        held = reservations.holds(db, list(rows))
+
+        confirmed, lines = [], []
+        for order_id in ids:
+            if order_id not in rows:
+                continue
+            needed = _quantities(items.get(order_id, []))
+            own = held.get(order_id, {})
+            short = next(((vid, name) for vid, _, name in items.get(order_id, [])
+                          if vid and available.get(vid, 0) + own.get(vid, 0) < needed[vid]), None)
+            if short is not None:
+                vid, name = short
+                outcomes[order_id] = {"order_id": order_id, "ok": False,
+                                      "detail": f"SP {name} không đủ hàng ({available.get(vid, 0) + own.get(vid, 0)} có thể bán)"}
+                continue
+            for vid, qty in needed.items():
+                available[vid] = available.get(vid, 0) + own.get(vid, 0) - qty
+            confirmed.append(order_id)
+            lines.extend(items.get(order_id, []))
+
+        take_stock(db, lines, lambda name, left: f"SP {name} không đủ hàng ({left} có thể bán)",
+                   held=reservations.take(db, confirmed))
+        debts = {}
+        for order_id in confirmed:
+            row = rows[order_id]
+            if row.customer_id:
+                debts[row.customer_id] = debts.get(row.customer_id, 0) + (row.total_amount or 0)
+        if debts:
+            db.execute(
+                update(Customer)
+                .where(Customer.id.in_(debts))
+                .values(debt=func.coalesce(Customer.debt, 0) + case(debts, value=Customer.id),
+                        row_version=sync.next_version(db))
+                .execution_options(synchronize_session=False)
+            )
+        moved = _move_orders(db, confirmed, "accepted", "completed", 0)
+        if len(moved) != len(confirmed):
+            # another picker confirmed some of them meanwhile: stock and debt above would count them twice
+            db.rollback()
+            raise HTTPException(status_code=409, detail="Có đơn vừa được xác nhận bởi người khác, vui lòng tải lại và thử lại")
+        db.commit()
+    except HTTPException:
+        db.rollback()
+        raise
+    except Exception as e:
+        db.rollback()
+        raise HTTPException(status_code=500, detail=str(e))
+    if moved:
+        catalog_changed()
+    return _batch_result(ids, outcomes, moved, rows, "completed", "order.confirmed")
+
+@app.post("/orders/batch/reject")
+def reject_orders(data: OrderBatch, db: Session = Depends(get_db), idempotency_key: IdempotencyKeyHeader = None):
+    return idempotency.run(db, idempotency_key, "POST /orders/batch/reject", data, lambda: discard_orders(db, data.ids))
+
+def discard_orders(db: Session, ids):
+    """Delete every listed PENDING order and its items, releasing their reservations: one SELECT, two DELETEs."""
+    try:
+        ids, rows, outcomes = _load_batch(db, ids, "pending", "Chỉ có thể từ chối đơn đang chờ duyệt")
+        moved = set()
+        if rows:
+            still_pending = and_(Order.id.in_(list(rows)), Order.status == "pending")
+            # items first (foreign key), of the orders that are still pending at this point
+            db.query(OrderItem).filter(OrderItem.order_id.in_(select(Order.id).where(still_pending))) \
+                .delete(synchronize_session=False)
+            moved = set(db.execute(
+                delete(Order).where(still_pending).returning(Order.id).execution_options(synchronize_session=False)
+            ).scalars().all())
+            sync.record_deletes(db, Order, moved)
+            reservations.release(db, moved)
+        db.commit()
+    except HTTPException:
+        raise
+    except Exception as e:
+        db.rollback()
+        raise HTTPException(status_code=500, detail=str(e))
+    return _batch_result(ids, outcomes, moved, rows, "rejected", "order.rejected")
+
+
+# ───────────────────────────────────────────────────────────────
+# STOCK RESERVATIONS: AVAILABLE TO PROMISE
+# ───────────────────────────────────────────────────────────────
+
+MAX_AVAILABILITY_IDS = 500
+
+# holds of orders nobody handled while the server was down; later writes release them as they go
+try:
+    with SessionLocal() as _db:
+        reservations.release_expired(_db)
+        _db.commit()
+except Exception as e:
+    print("Warning: releasing expired reservations failed:", e)
+
+def stock_availability(db, ids):
+    """stock, reserved and stock - reserved per variant: one primary-key read."""
+    ids = list(dict.fromkeys(ids))
+    if len(ids) > MAX_AVAILABILITY_IDS:
+        raise HTTPException(status_code=400, detail=f"Tối đa {MAX_AVAILABILITY_IDS} biến thể mỗi lần")
+    if not ids:
+        return []
+    rows = db.query(Variant.id, Variant.stock, reservations.live_reserved()).filter(Variant.id.in_(ids)).all()
+    return [
+        {"variant_id": vid, "stock": stock or 0, "reserved": reserved or 0, "available": (stock or 0) - (reserved or 0)}
+        for vid, stock, reserved in rows
+    ]
+
+
+@app.get("/stock/available")
+async def get_stock_available(variant_ids: str = ""):
+    """Available-to-promise for the order screen: /stock/available?variant_ids=1,2,3"""
+    try:
+        id_list = [int(x) for x in variant_ids.split(",") if x.strip()]
+    except ValueError:
+        raise HTTPException(status_code=400, detail="variant_ids phải là danh sách số")
+    data = await run_db(stock_availability, id_list)
+    return {"data": data, "count": len(data)}
+
+
+# ───────────────────────────────────────────────────────────────
+# EVENTS: SERVER-SENT EVENTS INSTEAD OF POLLING
+# ───────────────────────────────────────────────────────────────
+
+SSE_HEARTBEAT_SECONDS = 15
+
+def format_sse(event):
+    payload = json.dumps(event["data"], ensure_ascii=False, separators=(",", ":"))
+    return f"id: {event['id']}\nevent: {event['type']}\ndata: {payload}\n\n"
+
+
+@app.get("/events")
+async def stream_events(request: Request, types: str = "", order_ids: str = ""):
+    """
+    SSE stream of order/stock changes. Filters (comma separated):
+    - `types`: e.g. `order.created,order.rejected` (default: all of events.EVENT_TYPES)
+    - `order_ids`: only order events about these orders (orderer following its drafts)
+    Reconnect with the `Last-Event-ID` header (or `last_event_id` query) to get missed events;
+    a `reset` event means they are gone and the client should reload its lists.
+    A comment line is sent every SSE_HEARTBEAT_SECONDS to keep proxies from closing the connection.
+    """
+    type_list = [t for t in types.split(",") if t]
+    unknown = set(type_list) - set(events.EVENT_TYPES)
+    if unknown:
+        raise HTTPException(status_code=400, detail=f"Loại sự kiện không hợp lệ: {', '.join(sorted(unknown))}")
+    try:
+        id_list = [int(x) for x in order_ids.split(",") if x]
+    except ValueError:
+        raise HTTPException(status_code=400, detail="order_ids phải là danh sách số")
+
+    last_event_id = request.headers.get("last-event-id") or request.query_params.get("last_event_id")
+    queue = asyncio.Queue()
+    sub = events.Subscriber(asyncio.get_running_loop(), queue, type_list, id_list)
+    backlog, reset = events.subscribe(sub, last_event_id)
+
+    async def stream():
+        last_seq = 0
+        try:
+            yield "retry: 3000\n\n"
+            if reset:
+                yield "event: reset\ndata: {}\n\n"
+            for event in backlog:
+                last_seq = event["seq"]
+                yield format_sse(event)
+            while True:
+                try:
+                    event = await asyncio.wait_for(queue.get(), timeout=SSE_HEARTBEAT_SECONDS)
+                except asyncio.TimeoutError:
+                    if await request.is_disconnected():
+                        break
+                    yield ": ping\n\n"
+                    continue
+                # may already have been sent as part of the backlog
+                if event["seq"] <= last_seq:
+                    continue
+                last_seq = event["seq"]
+                yield format_sse(event)
+        finally:
+            events.unsubscribe(sub)
+
+    return StreamingResponse(
+        stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+# ───────────────────────────────────────────────────────────────
+# SYNC: INCREMENTAL CHANGE FEED FOR CLIENTS
+# ───────────────────────────────────────────────────────────────
+
+try:
+    with SessionLocal() as _db:
+        sync.prune_tombstones(_db)
+except Exception as e:
+    print("Warning: prune_tombstones failed:", e)
+
+
+SYNC_TABLES = ("products", "customers", "orders")
+
+@app.get("/sync")
+async def sync_changes(since: Optional[str] = None, cursor: Optional[str] = None, limit: int = MAX_PAGE_LIMIT):
+    return await run_db(changes_since, since, cursor, limit)
+
+def changes_since(db, since=None, cursor=None, limit=MAX_PAGE_LIMIT):
+    """
+    Rows changed after `since` (the `token` of a previous /sync response).
+    No `since` (or a token older than the pruned tombstones) → full snapshot with "full": true;
+    the client should then replace its local copy instead of merging.
+    The full snapshot is paged: at most `limit` rows (products, then customers, then orders);
+    pass `next_cursor` back as `cursor` until it is null, then keep the `token` of the first page.
+    Products come in the /products format (with all variants); `deleted` lists removed ids per table.
+    """
+    limit = max(1, min(limit, MAX_PAGE_LIMIT))
+    deleted = {"products": [], "variants": [], "customers": [], "orders": []}
+    if cursor:
+        value, last_id = decode_cursor(cursor, "sync")
+        try:
+            token, table = int(value[0]), value[1]
+        except (TypeError, ValueError, IndexError):
+            raise HTTPException(status_code=400, detail="Cursor không hợp lệ")
+        if table not in SYNC_TABLES:
+            raise HTTPException(status_code=400, detail="Cursor không hợp lệ")
+        return sync_snapshot_page(db, token, table, last_id, limit, deleted)
+
+    # read the token first: anything committed after this shows up again next time (harmless)
+    token = sync.current_token(db)
+    since_v = None
+    if since:
+        try:
+            since_v = int(since)
+        except ValueError:
+            raise HTTPException(status_code=400, detail="Token không hợp lệ")
+        if since_v <= sync.pruned_version(db) or since_v > token:
+            since_v = None
+    if since_v is None:
+        return sync_snapshot_page(db, token, SYNC_TABLES[0], 0, limit, deleted)
+
+    for table_name, row_id in (
+        db.query(Tombstone.table_name, Tombstone.row_id).filter(Tombstone.row_version >= since_v)
+    ):
+        if table_name in deleted:
+            deleted[table_name].append(row_id)
+    return {
+        "token": str(token),
+        "full": False,
+        "products": load_catalog(db, db.query(Product).filter(Product.row_version >= since_v).order_by(desc(Product.id))),
+        "customers": [
+            serialize_sync_customer(c)
+            for c in db.query(Customer).filter(Customer.row_version >= since_v).order_by(desc(Customer.id))
+        ],
+        "orders": load_orders(db, db.query(Order).filter(Order.row_version >= since_v).order_by(desc(Order.id))),
+        "deleted": deleted,
+        "next_cursor": None,
+    }
+
+def serialize_sync_customer(c):
+    return {"id": c.id, "name": c.name, "phone": c.phone, "debt": c.debt}
+
+def sync_snapshot_page(db, token, table, last_id, limit, deleted):
+    """
+    One page of the full snapshot, keyset-paged by id (newest first) across SYNC_TABLES,
+    starting in `table` below `last_id` (0: from the top). Rows changed while the client
+    pages have row_version >= token, so the first incremental /sync sends them again.
+    """
+    models = {"products": Product, "customers": Customer, "orders": Order}
+    page = {name: [] for name in SYNC_TABLES}
+    next_cursor = None
+    for name in SYNC_TABLES[SYNC_TABLES.index(table):]:
+        left = limit - sum(len(rows) for rows in page.values())
+        if left == 0:
+            next_cursor = encode_cursor("sync", [str(token), name], 0)
+            break
+        model = models[name]
+        query = db.query(model)
+        if name == table and last_id:
+            query = query.filter(model.id < last_id)
+        query = query.order_by(desc(model.id)).limit(left + 1)
+        if name == "products":
+            rows = load_catalog(db, query)
+        elif name == "orders":
+            rows = load_orders(db, query)
+        else:
+            rows = [serialize_sync_customer(c) for c in query]
+        if len(rows) > left:
+            page[name] = rows[:left]
+            next_cursor = encode_cursor("sync", [str(token), name], page[name][-1]["id"])
+            break
+        page[name] = rows
+    return {"token": str(token), "full": True, **page, "deleted": deleted, "next_cursor": next_cursor}
@@ -0,0 +1,119 @@
+"""
+Online data backfills: an UPDATE applied in primary-key chunks.
+
+A single `UPDATE orders SET ... WHERE ...` over a big table holds the write
+lock until it finishes (on SQLite: the whole database), so checkouts stall.
+run_backfill() instead updates `batch_size` ids at a time, each chunk in its
+own short transaction, and sleeps between chunks so other writers get in.
+
+Progress (last id done, rows updated) is committed with each chunk in
+`backfill_progress`: an interrupted run picks up where it stopped; running a
+finished backfill again starts a new pass. Backfills must be idempotent —
+`where_sql` should only match rows that still need the fix.
+"""
+import os
+import time
+from datetime import datetime
+
+from sqlalchemy import text
+
+try:
+    from backend.database import BackfillProgress
+except ImportError:
+    from database import BackfillProgress
+
+BATCH_SIZE = int(os.environ.get("BACKFILL_BATCH_SIZE", "1000"))
+SLEEP_SECONDS = int(os.environ.get("BACKFILL_SLEEP_MS", "20")) / 1000
+REPORT_SECONDS = 5
+
+
+class Backfill:
+    """UPDATE `table` SET `set_sql` WHERE `where_sql`, keyed by the integer primary key `id`."""
+
+    def __init__(self, name, table, set_sql, where_sql="1 = 1", params=None):
+        self.name = name
+        self.table = table
+        self.set_sql = set_sql
+        self.where_sql = where_sql
+        self.params = params or {}
+
+
+def _progress(conn, name):
+    return conn.execute(
+        text("SELECT last_id, rows_updated, finished_at FROM backfill_progress WHERE name = :n"), {"n": name}
+    ).first()
+
+
+def is_unfinished(conn, name):
+    """True when a run of `name` was started and interrupted."""
+    row = _progress(conn, name)
+    return row is not None and row.finished_at is None
+
+
+def run_backfill(bind, backfill, batch_size=BATCH_SIZE, sleep=SLEEP_SECONDS, max_chunks=None, log=print):
+    """
+    Apply `backfill` chunk by chunk. `max_chunks` stops early (the run stays resumable).
+    Returns {"updated", "scanned", "chunks", "seconds", "finished"}.
+    """
+    BackfillProgress.__table__.create(bind=bind, checkfirst=True)
+    with bind.begin() as conn:
+        row = _progress(conn, backfill.name)
+        if row is None:
+            conn.execute(BackfillProgress.__table__.insert().values(
+                name=backfill.name, last_id=0, rows_updated=0, started_at=datetime.now()
+            ))
+            last_id, updated_before = 0, 0
+        elif row.finished_at is not None:
+            conn.execute(
+                text("UPDATE backfill_progress SET last_id = 0, rows_updated = 0, started_at = :now, "
+                     "updated_at = NULL, finished_at = NULL WHERE name = :n"),
+                {"now": datetime.now(), "n": backfill.name},
+            )
+            last_id, updated_before = 0, 0
+        else:
+            last_id, updated_before = row.last_id or 0, row.rows_updated or 0
+            log(f"[backfill {backfill.name}] resuming after id {last_id} ({updated_before} rows done)")
+
+    chunk_end = text(
+        f"SELECT MAX(id) FROM (SELECT id FROM {backfill.table} WHERE id > :lo ORDER BY id LIMIT :n) AS chunk"
+    )
+    update = text(
+        f"UPDATE {backfill.table} SET {backfill.set_sql} "
+        f"WHERE id > :lo AND id <= :hi AND ({backfill.where_sql})"
+    )
+    save = text("UPDATE backfill_progress SET last_id = :hi, rows_updated = rows_updated + :u, "
+                "updated_at = :now WHERE name = :n")
+
+    stats = {"updated": 0, "scanned": 0, "chunks": 0, "seconds": 0.0, "finished": False}
+    start = last_report = time.perf_counter()
+    while max_chunks is None or stats["chunks"] < max_chunks:
+        with bind.begin() as conn:
+            hi = conn.execute(chunk_end, {"lo": last_id, "n": batch_size}).scalar()
+            if hi is None:
+                conn.execute(
+                    text("UPDATE backfill_progress SET finished_at = :now, updated_at = :now WHERE name = :n"),
+                    {"now": datetime.now(), "n": backfill.name},
+                )
+                stats["finished"] = True
+                break
+            changed = conn.execute(update, {**backfill.params, "lo": last_id, "hi": hi}).rowcount or 0
+            conn.execute(save, {"hi": hi, "u": changed, "now": datetime.now(), "n": backfill.name})
+        stats["updated"] += changed
+        stats["scanned"] += hi - last_id
+        stats["chunks"] += 1
+        last_id = hi
+
+        now = time.perf_counter()
+        if now - last_report >= REPORT_SECONDS:
+            rate = stats["scanned"] / (now - start)
+            log(f"[backfill {backfill.name}] up to id {last_id}: {updated_before + stats['updated']} rows updated, "
+                f"{rate:.0f} ids/s")
+            last_report = now
+        if sleep:
+            time.sleep(sleep)
+
+    stats["seconds"] = time.perf_counter() - start
+    if stats["finished"] and (stats["chunks"] or updated_before):
+        log(f"[backfill {backfill.name}] done: {updated_before + stats['updated']} rows updated, "
+            f"{stats['chunks']} chunks in {stats['seconds']:.1f}s")
+    return stats
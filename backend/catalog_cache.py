@@ -0,0 +1,66 @@
+"""
+In-process cache for serialized /products responses.
+
+`version` is bumped by every endpoint that changes products, variants or stock
+(after its commit). Cached bodies are keyed by (version, request params), so a
+bump makes all old entries unreachable; they then age out of the LRU.
+The ETag includes a per-process boot id so two workers never hand out the same
+tag for different data.
+"""
+import hashlib
+import os
+import threading
+import uuid
+from collections import OrderedDict
+
+MAX_ENTRIES = int(os.environ.get("CATALOG_CACHE_SIZE", "64"))
+
+_lock = threading.Lock()
+_entries = OrderedDict()
+_boot_id = uuid.uuid4().hex[:8]
+version = 0
+
+
+def bump():
+    """Invalidate the catalog — call after committing any product/variant/stock change."""
+    global version
+    with _lock:
+        version += 1
+        _entries.clear()
+
+
+def make_etag(ver, key):
+    digest = hashlib.sha1(repr(key).encode("utf-8")).hexdigest()[:12]
+    return f'W/"{_boot_id}-{ver}-{digest}"'
+
+
+def get(ver, key):
+    """Return (body, etag) for `key` at catalog version `ver`, or None."""
+    with _lock:
+        hit = _entries.get((ver, key))
+        if hit is not None:
+            _entries.move_to_end((ver, key))
+        return hit
+
+
+def put(ver, key, body):
+    etag = make_etag(ver, key)
+    with _lock:
+        # a write landed while we were querying: the body may be stale, don't keep it
+        if ver != version:
+            return etag
+        _entries[(ver, key)] = (body, etag)
+        _entries.move_to_end((ver, key))
+        while len(_entries) > MAX_ENTRIES:
+            _entries.popitem(last=False)
+    return etag
+
+
+def etag_matches(if_none_match, etag):
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    # weak comparison: ignore W/ prefixes
+    tags = {t.strip().removeprefix("W/") for t in if_none_match.split(",")}
+    return etag.removeprefix("W/") in tags
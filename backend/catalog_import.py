@@ -0,0 +1,244 @@
+"""
+Bulk catalog upsert: products keyed by name, variants keyed by (color, size).
+
+Used by POST /products/bulk and runnable as a script:
+
+    python backend/catalog_import.py catalog.json [--keep-missing-variants]
+
+where catalog.json is a list of
+{"name", "description"?, "image_path"?, "variants": [{"color", "size", "price", "stock"?}]}.
+
+Products are processed CHUNK_SIZE at a time, each chunk in one transaction:
+two lookups (products by name, their variants), then multi-row INSERTs and
+UPDATEs by primary key for whatever differs, and one DELETE for variants no
+longer listed. Unchanged rows are not written at all, so re-sending the same
+catalog costs only the lookups. Bulk statements skip the ORM hooks, so rows are
+stamped for /sync and `search_name` is filled here.
+
+Omitted `description` / `image_path` / `stock` keep the current value (a new
+variant without stock starts at 0). A listed stock is applied as a change against
+the value read in the chunk, `stock = stock + (new - old)` in one guarded UPDATE:
+a sale that commits in between is not overwritten, and a variant whose stock would
+drop below what open orders hold keeps its stock and is listed in its product's
+`stock_kept` (the import itself goes through).
+"""
+import argparse
+import json
+import os
+import time
+
+from sqlalchemy import insert, update, delete, case, func, or_
+
+try:
+    from backend.database import SessionLocal, Product, Variant
+    from backend.search import normalize_text
+    from backend import sync, reservations
+except ImportError:
+    from database import SessionLocal, Product, Variant
+    from search import normalize_text
+    import sync
+    import reservations
+
+CHUNK_SIZE = int(os.environ.get("CATALOG_CHUNK_SIZE", "1000"))  # products per transaction
+
+
+def _chunks(values, size):
+    for start in range(0, len(values), size):
+        yield values[start:start + size]
+
+
+def _variant_key(v):
+    return (str(v["color"]).strip(), str(v["size"]).strip())
+
+
+def _validate(products):
+    """Per-product error message (or None). Later duplicates of a name are rejected."""
+    errors, seen = [], set()
+    for p in products:
+        name = str(p.get("name") or "").strip()
+        keys = [_variant_key(v) for v in p.get("variants") or []]
+        if not name:
+            errors.append("Thiếu tên sản phẩm")
+        elif name in seen:
+            errors.append(f"Sản phẩm '{name}' bị trùng trong danh sách")
+        elif len(keys) != len(set(keys)):
+            errors.append("Trùng màu/size trong cùng sản phẩm")
+        elif any(v.get("price") is None or v["price"] < 0 or (v.get("stock") or 0) < 0 for v in p.get("variants") or []):
+            errors.append("Giá và tồn kho phải >= 0")
+        else:
+            errors.append(None)
+        seen.add(name)
+    return errors
+
+
+def _apply_chunk(db, chunk, prune_variants, counts):
+    """
+    Upsert one chunk of (index, product) in the current transaction.
+    Returns {index: (status, product_id, [variant ids whose stock was kept])}.
+    """
+    names = [str(p["name"]).strip() for _, p in chunk]
+    existing = {}
+    for row in db.query(Product.id, Product.name, Product.description, Product.image_path) \
+            .filter(Product.name.in_(names)).order_by(Product.id):
+        existing.setdefault(row.name, row)  # duplicate names in the db: the oldest product is the one updated
+    current = {}
+    if existing:
+        for row in db.query(Variant.id, Variant.product_id, Variant.color, Variant.size, Variant.price, Variant.stock) \
+                .filter(Variant.product_id.in_([r.id for r in existing.values()])):
+            # keyed like the incoming rows: PUT /products/{id} stores color/size unstripped
+            key = (str(row.color or "").strip(), str(row.size or "").strip())
+            current.setdefault(row.product_id, {})[key] = row
+
+    ver = sync.next_version(db)
+    new = [(idx, p) for idx, p in chunk if str(p["name"]).strip() not in existing]
+    new_ids = []
+    if new:
+        new_ids = db.execute(insert(Product).returning(Product.id, sort_by_parameter_order=True), [
+            {
+                "name": str(p["name"]).strip(),
+                "description": p.get("description") or "",
+                "image_path": p.get("image_path") or "",
+                "search_name": normalize_text(str(p["name"]).strip()),
+                "row_version": ver,
+            }
+            for _, p in new
+        ]).scalars().all()
+    product_ids = {idx: pid for (idx, _), pid in zip(new, new_ids)}
+
+    product_updates, variant_inserts, variant_updates, variant_deletes = {}, [], [], []
+    stock_deltas, owner = {}, {}
+    results = {}
+    for idx, p in chunk:
+        name = str(p["name"]).strip()
+        row = existing.get(name)
+        pid = row.id if row else product_ids[idx]
+        changed = row is None
+        if row is not None:
+            fields = {k: p[k] for k in ("description", "image_path")
+                      if p.get(k) is not None and p[k] != getattr(row, k)}
+            if fields:
+                product_updates[pid] = fields
+                changed = True
+
+        have = current.get(pid, {})
+        wanted = set()
+        for v in p.get("variants") or []:
+            key = _variant_key(v)
+            wanted.add(key)
+            old = have.get(key)
+            if old is None:
+                variant_inserts.append({"product_id": pid, "color": key[0], "size": key[1], "price": v["price"],
+                                        "stock": v.get("stock") or 0, "row_version": ver})
+                changed = True
+                continue
+            delta = 0 if v.get("stock") is None else v["stock"] - (old.stock or 0)
+            if delta:
+                stock_deltas[old.id] = delta
+                owner[old.id] = idx
+            if v["price"] != old.price or delta:
+                variant_updates.append({"id": old.id, "price": v["price"], "row_version": ver})
+                changed = True
+        if prune_variants:
+            gone = [old.id for key, old in have.items() if key not in wanted]
+            if gone:
+                variant_deletes.extend(gone)
+                changed = True
+
+        if changed and row is not None:
+            # variants changed: the product is re-sent as a whole by /sync
+            product_updates.setdefault(pid, {})
+        results[idx] = ("created" if row is None else "updated" if changed else "unchanged", pid, [])
+
+    if product_updates:
+        # executemany UPDATE by primary key, grouped by the set of columns that changed
+        db.execute(update(Product), [
+            {"id": pid, **fields, "row_version": ver} for pid, fields in product_updates.items()
+        ])
+    if variant_inserts:
+        db.execute(insert(Variant), variant_inserts)
+    if variant_updates:
+        db.execute(update(Variant), variant_updates)
+    if stock_deltas:
+        # guarded like reservations.reserve: stock already promised to open orders is not removed
+        reservations.release_expired(db)
+        delta = case(stock_deltas, value=Variant.id)
+        applied = set(db.execute(
+            update(Variant)
+            .where(Variant.id.in_(stock_deltas),
+                   or_(delta > 0, func.coalesce(Variant.stock, 0) + delta >= func.coalesce(Variant.reserved, 0)))
+            .values(stock=func.coalesce(Variant.stock, 0) + delta)
+            .returning(Variant.id)
+            .execution_options(synchronize_session=False)
+        ).scalars().all())
+        for vid in stock_deltas:
+            if vid not in applied:
+                results[owner[vid]][2].append(vid)
+                counts["stock_kept"] += 1
+    if variant_deletes:
+        sync.record_deletes(db, Variant, variant_deletes)
+        reservations.drop_variants(db, variant_deletes)
+        db.execute(delete(Variant).where(Variant.id.in_(variant_deletes)).execution_options(synchronize_session=False))
+
+    counts["inserted"] += len(variant_inserts)
+    counts["updated"] += len(variant_updates)
+    counts["deleted"] += len(variant_deletes)
+    return results
+
+
+def upsert_catalog(db, products, prune_variants=True, chunk_size=CHUNK_SIZE):
+    """
+    Create/update `products` (list of dicts, see module docstring). With `prune_variants`,
+    variants of a listed product that are not in its list are deleted (like PUT /products/{id}).
+    A failing chunk is rolled back alone. Returns counts and one result per product
+    (with `stock_kept`: variants whose new stock was below what open orders hold).
+    """
+    errors = _validate(products)
+    results = [{"index": idx, "status": "error", "detail": e} if e else None for idx, e in enumerate(errors)]
+    valid = [(idx, p) for idx, p in enumerate(products) if errors[idx] is None]
+    counts = {"inserted": 0, "updated": 0, "deleted": 0, "stock_kept": 0}
+
+    for chunk in _chunks(valid, chunk_size):
+        chunk_counts = dict.fromkeys(counts, 0)
+        try:
+            done = _apply_chunk(db, chunk, prune_variants, chunk_counts)
+            db.commit()
+        except Exception as e:
+            db.rollback()
+            for idx, _ in chunk:
+                results[idx] = {"index": idx, "status": "error", "detail": str(e)}
+            continue
+        for key in counts:
+            counts[key] += chunk_counts[key]
+        for idx, (status, pid, kept) in done.items():
+            results[idx] = {"index": idx, "status": status, "product_id": pid}
+            if kept:
+                results[idx]["stock_kept"] = kept
+
+    summary = {s: sum(1 for r in results if r["status"] == s) for s in ("created", "updated", "unchanged")}
+    summary["failed"] = len(results) - sum(summary.values())
+    return {**summary, "variants": counts, "results": results}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Create/update products and variants from a JSON catalog.")
+    parser.add_argument("file", help="JSON list of products with their variants")
+    parser.add_argument("--keep-missing-variants", action="store_true",
+                        help="Do not delete variants that are not listed for their product")
+    parser.add_argument("--chunk-size", type=int, default=CHUNK_SIZE, help="Products per transaction")
+    args = parser.parse_args()
+
+    with open(args.file, encoding="utf-8") as f:
+        products = json.load(f)
+    start = time.perf_counter()
+    with SessionLocal() as db:
+        result = upsert_catalog(db, products, prune_variants=not args.keep_missing_variants, chunk_size=args.chunk_size)
+    print(f"{len(products)} products in {time.perf_counter() - start:.1f}s: "
+          f"{result['created']} created, {result['updated']} updated, {result['unchanged']} unchanged, "
+          f"{result['failed']} failed; variants {result['variants']}")
+    for r in result["results"]:
+        if r["status"] == "error":
+            print(f"  #{r['index']}: {r['detail']}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,6 +1,6 @@
 import os
 import sys
-from sqlalchemy import create_engine, Column, Integer, String, ForeignKey, DateTime, Float
+from sqlalchemy import create_engine, event, make_url, text, Column, Integer, String, ForeignKey, DateTime, Float, BigInteger, Index, Text
 from sqlalchemy.orm import sessionmaker, relationship, declarative_base
 from datetime import datetime
 
@@ -24,11 +24,129 @@ if not DATABASE_URL:
 
 is_sqlite = DATABASE_URL.startswith("sqlite")
 
+# SQLite profile: the desktop app embeds the API server and the UI threads write to the same
+# shop.db, so readers must not block the writer (WAL) and a writer must wait, not fail, on a lock.
+SQLITE_PRAGMAS = {
+    "journal_mode": "WAL",
+    "synchronous": "NORMAL",  # safe with WAL: only the last commits can be lost on power failure
+    "busy_timeout": int(os.environ.get("SQLITE_BUSY_TIMEOUT_MS", "10000")),
+    "cache_size": -1024 * int(os.environ.get("SQLITE_CACHE_MB", "32")),  # negative = KiB
+    "mmap_size": 1024 * 1024 * int(os.environ.get("SQLITE_MMAP_MB", "256")),
+    "temp_store": "MEMORY",
+}
+
+
+def apply_sqlite_pragmas(dbapi_connection, connection_record=None):
+    cursor = dbapi_connection.cursor()
+    try:
+        for name, value in SQLITE_PRAGMAS.items():
+            cursor.execute(f"PRAGMA {name} = {value}")
+    finally:
+        cursor.close()
+
+
+# PostgreSQL profile (Railway): the proxy drops idle connections, so every checkout is pinged
+# and connections are replaced before they get old. Pool sizes are per worker process.
+PG_POOL = {
+    "pool_size": int(os.environ.get("DB_POOL_SIZE", "5")),
+    "max_overflow": int(os.environ.get("DB_MAX_OVERFLOW", "10")),
+    "pool_timeout": int(os.environ.get("DB_POOL_TIMEOUT", "30")),
+    "pool_recycle": int(os.environ.get("DB_POOL_RECYCLE", "300")),
+    "pool_pre_ping": True,
+    # reuse the most recently returned connection: the rest of the pool can idle out and be recycled
+    "pool_use_lifo": True,
+}
+# TCP keepalives (libpq drivers): a connection dropped mid-request is noticed in ~1 minute, not hours
+PG_KEEPALIVES = {"keepalives": 1, "keepalives_idle": 30, "keepalives_interval": 10, "keepalives_count": 3}
+PG_CONNECT_TIMEOUT = int(os.environ.get("DB_CONNECT_TIMEOUT", "10"))
+# Prepared statements per connection for hot queries. They do not survive a transaction-mode
+# pgbouncer — set DB_STATEMENT_CACHE=0 there.
+PG_STATEMENT_CACHE = int(os.environ.get("DB_STATEMENT_CACHE", "256"))
+
+
+def engine_options(url):
+    """(url, create_engine kwargs) with the SQLite or PostgreSQL profile for `url`."""
+    if url.startswith("postgres://"):
+        # SQLAlchemy only knows the postgresql:// spelling
+        url = "postgresql://" + url[len("postgres://"):]
+    if url.startswith("sqlite"):
+        return url, {"connect_args": {"check_same_thread": False}}
+    if not url.startswith("postgresql"):
+        return url, {}
+
+    options = dict(PG_POOL)
+    driver = make_url(url).get_driver_name()
+    if driver == "psycopg":
+        # psycopg 3: server-side prepare after a query ran N times on a connection (None = never)
+        options["connect_args"] = {
+            **PG_KEEPALIVES, "connect_timeout": PG_CONNECT_TIMEOUT,
+            "prepare_threshold": 2 if PG_STATEMENT_CACHE else None,
+        }
+    else:
+        # psycopg2 cannot prepare server-side; SQLAlchemy's compiled-statement cache still applies
+        options["connect_args"] = {**PG_KEEPALIVES, "connect_timeout": PG_CONNECT_TIMEOUT}
+        options["query_cache_size"] = max(500, PG_STATEMENT_CACHE * 4)
+    return url, options
+
+
+_pool_counters = {}
+
+
+def create_db_engine(url):
+    url, options = engine_options(url)
+    new_engine = create_engine(url, **options)
+    if new_engine.dialect.name == "sqlite":
+        event.listen(new_engine, "connect", apply_sqlite_pragmas)
+    count_pool_events(new_engine)
+    return new_engine
+
+
+def count_pool_events(bind):
+    """Keep connect / checkout / invalidate counts for pool_stats()."""
+    counters = _pool_counters.setdefault(id(bind.pool), {"connects": 0, "checkouts": 0, "invalidated": 0})
+
+    def bump(name):
+        def listener(*args):
+            counters[name] += 1
+        return listener
+
+    event.listen(bind, "connect", bump("connects"))
+    event.listen(bind, "checkout", bump("checkouts"))
+    # pre-ping found a dead connection, or a query failed with a disconnect error
+    event.listen(bind, "invalidate", bump("invalidated"))
+
+
+def pool_stats(bind):
+    pool = bind.pool
+    stats = {"pool": type(pool).__name__, **_pool_counters.get(id(pool), {})}
+    if hasattr(pool, "checkedout"):
+        stats.update({
+            "size": pool.size(),
+            "checked_out": pool.checkedout(),
+            "checked_in": pool.checkedin(),
+            "overflow": pool.overflow(),
+        })
+    return stats
+
+
 Base = declarative_base()
-connect_args = {"check_same_thread": False} if is_sqlite else {}
-engine = create_engine(DATABASE_URL, connect_args=connect_args)
+engine = create_db_engine(DATABASE_URL)
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
+
+def optimize_sqlite(bind=engine):
+    """Refresh planner statistics at startup: full ANALYZE the first time, then PRAGMA optimize."""
+    if bind.dialect.name != "sqlite":
+        return
+    try:
+        with bind.connect() as conn:
+            analyzed = conn.execute(text("SELECT 1 FROM sqlite_master WHERE name = 'sqlite_stat1'")).first()
+            conn.execute(text("PRAGMA optimize" if analyzed else "ANALYZE"))
+            conn.commit()
+    except Exception as e:
+        print("Warning: optimize_sqlite failed:", e)
+
+
 # 1. Product & Variant (Giữ nguyên)
 class Product(Base):
     __tablename__ = "products"
@@ -36,6 +154,9 @@ class Product(Base):
     name = Column(String, index=True)
     description = Column(String, default="")
     image_path = Column(String, default="") 
+    # name lower-cased without diacritics, kept in sync by backend/search.py
+    search_name = Column(String)
+    row_version = Column(BigInteger, default=0, index=True)  # /sync change feed, see backend/sync.py
     variants = relationship("Variant", back_populates="product", cascade="all, delete-orphan")
 
 class Variant(Base):
@@ -46,6 +167,9 @@ class Variant(Base):
     size = Column(String)
     price = Column(Integer)
     stock = Column(Integer)
+    # units held by pending/accepted orders (sum of stock_reservations), see backend/reservations.py
+    reserved = Column(Integer, default=0)
+    row_version = Column(BigInteger, default=0, index=True)
     product = relationship("Product", back_populates="variants")
 
 # 2. Customer & Debt (MỚI)
@@ -55,12 +179,14 @@ class Customer(Base):
     name = Column(String, index=True, unique=True) # Tên là định danh duy nhất để gợi ý
     phone = Column(String, default="")
     debt = Column(Integer, default=0) # Tổng nợ hiện tại
+    row_version = Column(BigInteger, default=0, index=True)
     
     logs = relationship("DebtLog", back_populates="customer", cascade="all, delete-orphan")
     orders = relationship("Order", back_populates="customer_rel")
 
 class DebtLog(Base):
     __tablename__ = "debt_logs"
+    __table_args__ = (Index("ix_debt_logs_customer_ts", "customer_id", "created_ts"),)
     id = Column(Integer, primary_key=True, index=True)
     customer_id = Column(Integer, ForeignKey("customers.id"))
     change_amount = Column(Integer) # Số tiền thay đổi (+ hoặc -)
@@ -75,6 +201,7 @@ class DebtLog(Base):
 # 3. Order (Cập nhật liên kết)
 class Order(Base):
     __tablename__ = "orders"
+    __table_args__ = (Index("ix_orders_customer_ts", "customer_id", "created_ts"),)
     id = Column(Integer, primary_key=True, index=True)
     customer_name = Column(String) # Vẫn giữ để hiển thị nhanh
     customer_id = Column(Integer, ForeignKey("customers.id"), nullable=True) # Link vào hồ sơ khách
@@ -85,6 +212,7 @@ class Order(Base):
     is_draft = Column(Integer, default=0)  # 1 = PENDING (chờ duyệt), 0 = APPROVED (đã apply)
     # status: 'pending' | 'accepted' | 'completed'
     status = Column(String, default='completed')
+    row_version = Column(BigInteger, default=0, index=True)
 
     items = relationship("OrderItem", back_populates="order")
     customer_rel = relationship("Customer", back_populates="orders")
@@ -98,4 +226,56 @@ class OrderItem(Base):
     variant_info = Column(String)
     quantity = Column(Integer)
     price = Column(Integer)
-    order = relationship("Order", back_populates="items")
\ No newline at end of file
+    order = relationship("Order", back_populates="items")
+
+# 4. Change feed (/sync): version counter (SQLite; PostgreSQL uses transaction ids) + tombstones for deleted rows
+class SyncState(Base):
+    __tablename__ = "sync_state"
+    id = Column(Integer, primary_key=True)
+    version = Column(BigInteger, default=0)  # last row_version handed out
+    pruned_version = Column(BigInteger, default=0)  # tombstones up to here were pruned
+
+class Tombstone(Base):
+    __tablename__ = "tombstones"
+    id = Column(Integer, primary_key=True, index=True)
+    table_name = Column(String)
+    row_id = Column(Integer)
+    row_version = Column(BigInteger, index=True)
+    created_ts = Column(BigInteger, default=lambda: int(datetime.utcnow().timestamp() * 1000))
+
+# 5. Applied schema migrations, see backend/migrations.py
+class SchemaMigration(Base):
+    __tablename__ = "schema_migrations"
+    version = Column(Integer, primary_key=True)
+    name = Column(String)
+    applied_at = Column(DateTime, default=datetime.now)
+
+# 6. Progress of chunked data backfills, see backend/backfill.py
+class BackfillProgress(Base):
+    __tablename__ = "backfill_progress"
+    name = Column(String, primary_key=True)
+    last_id = Column(BigInteger, default=0)  # every id <= last_id has been processed
+    rows_updated = Column(BigInteger, default=0)
+    started_at = Column(DateTime)
+    updated_at = Column(DateTime)
+    finished_at = Column(DateTime)  # NULL while running or interrupted
+
+# 7. Idempotency-Key of retried order requests and the response sent, see backend/idempotency.py
+class IdempotencyKey(Base):
+    __tablename__ = "idempotency_keys"
+    key = Column(String, primary_key=True)
+    scope = Column(String)  # "POST /checkout/draft", "PUT /orders/12/confirm", ...
+    request_hash = Column(String)
+    status_code = Column(Integer)
+    response = Column(Text)  # NULL until the endpoint returned
+    created_at = Column(DateTime, default=datetime.now, index=True)
+
+# 8. Stock held by a pending/accepted order, one row per order and variant, see backend/reservations.py
+class StockReservation(Base):
+    __tablename__ = "stock_reservations"
+    id = Column(Integer, primary_key=True, index=True)
+    order_id = Column(Integer, index=True)
+    variant_id = Column(Integer)
+    quantity = Column(Integer)
+    created_at = Column(DateTime, default=datetime.now)
+    expires_at = Column(DateTime, index=True)  # released by the sweep after this
@@ -0,0 +1,100 @@
+"""
+In-process event bus behind the /events Server-Sent Events stream.
+
+Endpoints call publish() after their commit (from the threadpool or the event
+loop). Each connected client has an asyncio.Queue on the server loop; publish()
+hands events over with call_soon_threadsafe, so an idle client is just a
+parked coroutine — no polling, no DB work.
+
+The last BUFFER_SIZE events are kept for resume: a client reconnecting with
+Last-Event-ID gets everything it missed, or a "reset" event when the id is
+from another process / too old, meaning "refetch your lists".
+
+Events live in this process only — run a single worker (as on Railway today).
+"""
+import itertools
+import threading
+import time
+import uuid
+from collections import deque
+
+BUFFER_SIZE = 1000
+
+EVENT_TYPES = (
+    "order.created",
+    "order.approved",
+    "order.confirmed",
+    "order.rejected",
+    "order.updated",
+    "order.deleted",
+    "stock.changed",
+)
+
+_lock = threading.Lock()
+_seq = itertools.count(1)
+_buffer = deque(maxlen=BUFFER_SIZE)
+_subscribers = set()
+boot_id = uuid.uuid4().hex[:8]
+
+
+class Subscriber:
+    def __init__(self, loop, queue, types=None, order_ids=None):
+        self.loop = loop
+        self.queue = queue
+        self.types = set(types) if types else None
+        self.order_ids = set(order_ids) if order_ids else None
+
+    def wants(self, event):
+        if self.types is not None and event["type"] not in self.types:
+            return False
+        if self.order_ids is not None:
+            order_id = event["data"].get("order_id")
+            # orderers only follow their own drafts; stock events carry no order id
+            if order_id is not None and order_id not in self.order_ids:
+                return False
+        return True
+
+
+def publish(event_type, data):
+    with _lock:
+        seq = next(_seq)
+        event = {"seq": seq, "id": f"{boot_id}-{seq}", "type": event_type, "data": data, "ts": int(time.time() * 1000)}
+        _buffer.append(event)
+        targets = [s for s in _subscribers if s.wants(event)]
+    for sub in targets:
+        try:
+            sub.loop.call_soon_threadsafe(sub.queue.put_nowait, event)
+        except RuntimeError:
+            # loop already closed (server shutting down)
+            unsubscribe(sub)
+    return event
+
+
+def subscribe(sub, last_event_id=None):
+    """
+    Register `sub` and return (backlog, reset): events after `last_event_id`
+    that it missed, and whether the id could not be resumed.
+    """
+    with _lock:
+        _subscribers.add(sub)
+        if not last_event_id:
+            return [], False
+        boot, _, seq = last_event_id.partition("-")
+        try:
+            seq = int(seq)
+        except ValueError:
+            return [], True
+        oldest = _buffer[0]["seq"] if _buffer else None
+        if boot != boot_id or (oldest is not None and seq < oldest - 1):
+            return [], True
+        return [e for e in _buffer if e["seq"] > seq and sub.wants(e)], False
+
+
+def unsubscribe(sub):
+    with _lock:
+        _subscribers.discard(sub)
+
+
+def subscriber_count():
+    with _lock:
+        return len(_subscribers)
@@ -0,0 +1,114 @@
+"""
+Idempotency-Key support for the order endpoints.
+
+A client that timed out retries with the same `Idempotency-Key` header. The
+key row is flushed in the same transaction as the order, so two attempts can
+never both commit: a retry arriving later gets the stored response back
+without running the endpoint again, a concurrent duplicate fails on the
+primary key and is answered from the winner's row. No second order, no
+double debt — clients can use short timeouts and retry freely.
+
+Only successful responses are stored. A request that failed (out of stock,
+409 race, validation) changed nothing and may be retried with the same key.
+A key reused with a different body or on another endpoint is rejected (422).
+Keys older than IDEMPOTENCY_TTL_HOURS are forgotten and purged.
+"""
+import hashlib
+import json
+import os
+import time
+from datetime import datetime, timedelta
+
+from fastapi import HTTPException
+from fastapi.encoders import jsonable_encoder
+
+try:
+    from backend.database import IdempotencyKey
+    from backend.serialization import FastJSONResponse, dumps_json
+except ImportError:
+    from database import IdempotencyKey
+    from serialization import FastJSONResponse, dumps_json
+
+TTL = timedelta(hours=int(os.environ.get("IDEMPOTENCY_TTL_HOURS", "24")))
+PURGE_INTERVAL_SECONDS = 600
+MAX_KEY_LENGTH = 200
+REPLAY_HEADER = "Idempotent-Replayed"
+
+_last_purge = 0.0
+
+
+def create_idempotency_schema(conn):
+    """Migration step: the idempotency_keys table (and its created_at index)."""
+    IdempotencyKey.__table__.create(bind=conn, checkfirst=True)
+
+
+def fingerprint(scope, payload):
+    return hashlib.sha256(scope.encode("utf-8") + b"\n" + dumps_json(jsonable_encoder(payload))).hexdigest()
+
+
+def _replay(db, key, scope, digest):
+    """Stored response for `key`, or None when the key is new (or expired)."""
+    record = db.get(IdempotencyKey, key)
+    if record is None:
+        return None
+    if record.created_at is not None and record.created_at < datetime.now() - TTL:
+        db.delete(record)
+        db.commit()
+        return None
+    if record.scope != scope or record.request_hash != digest:
+        raise HTTPException(status_code=422, detail="Idempotency-Key đã được dùng cho một yêu cầu khác")
+    if record.response is None:
+        # the first attempt committed its order but has not stored the response yet
+        raise HTTPException(status_code=409, detail="Yêu cầu này đang được xử lý, vui lòng thử lại sau")
+    return FastJSONResponse(json.loads(record.response), status_code=record.status_code,
+                            headers={REPLAY_HEADER: "true"})
+
+
+def purge_expired(db, force=False):
+    """Delete expired keys, at most once per PURGE_INTERVAL_SECONDS. Returns the rows deleted."""
+    global _last_purge
+    now = time.monotonic()
+    if not force and now - _last_purge < PURGE_INTERVAL_SECONDS:
+        return 0
+    _last_purge = now
+    deleted = db.query(IdempotencyKey).filter(IdempotencyKey.created_at < datetime.now() - TTL) \
+        .delete(synchronize_session=False)
+    db.commit()
+    return deleted
+
+
+def run(db, key, scope, payload, handler):
+    """
+    Call `handler()` (which commits on `db`) once per `key`.
+    `scope` names the endpoint ("POST /checkout/draft", "PUT /orders/12/confirm"),
+    `payload` is the request body; both must match on a replay.
+    """
+    if key is None:
+        return handler()
+    key = key.strip()
+    if not key or len(key) > MAX_KEY_LENGTH:
+        raise HTTPException(status_code=400, detail=f"Idempotency-Key phải có 1-{MAX_KEY_LENGTH} ký tự")
+
+    digest = fingerprint(scope, payload)
+    replay = _replay(db, key, scope, digest)
+    if replay is not None:
+        return replay
+
+    # pending in the session: flushed with the handler's own commit
+    record = IdempotencyKey(key=key, scope=scope, request_hash=digest, created_at=datetime.now())
+    db.add(record)
+    try:
+        result = handler()
+    except HTTPException:
+        db.rollback()
+        # a duplicate that committed first makes our commit fail on the key: answer with its result
+        replay = _replay(db, key, scope, digest)
+        if replay is not None:
+            return replay
+        raise
+
+    record.status_code = 200
+    record.response = dumps_json(jsonable_encoder(result)).decode("utf-8")
+    db.commit()
+    purge_expired(db)
+    return result
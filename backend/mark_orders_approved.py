@@ -3,8 +3,10 @@ from sqlalchemy import text
 
 try:
     from backend.database import engine, is_sqlite
+    from backend.backfill import Backfill, run_backfill, BATCH_SIZE, SLEEP_SECONDS
 except ImportError:
     from database import engine, is_sqlite
+    from backfill import Backfill, run_backfill, BATCH_SIZE, SLEEP_SECONDS
 
 
 def ensure_is_draft_column(conn):
@@ -27,6 +29,8 @@ def ensure_is_draft_column(conn):
 def main():
     parser = argparse.ArgumentParser(description="Mark pending orders as approved (is_draft=0).")
     parser.add_argument("--allow-sqlite", action="store_true", help="Allow running on local SQLite database")
+    parser.add_argument("--batch-size", type=int, default=BATCH_SIZE, help="Orders per transaction")
+    parser.add_argument("--sleep-ms", type=int, default=int(SLEEP_SECONDS * 1000), help="Pause between batches")
     args = parser.parse_args()
 
     db_target = str(engine.url)
@@ -41,9 +45,15 @@ def main():
         pending = conn.execute(text("SELECT COUNT(*) FROM orders WHERE COALESCE(is_draft, 0) = 1")).scalar() or 0
         print(f"Pending before update: {pending}")
 
-        conn.execute(text("UPDATE orders SET is_draft = 0 WHERE COALESCE(is_draft, 0) = 1"))
-        conn.commit()
+    # chunked so the live shop keeps checking out while this runs; safe to interrupt and re-run
+    run_backfill(
+        engine,
+        Backfill("mark_orders_approved", "orders", "is_draft = 0", "COALESCE(is_draft, 0) = 1"),
+        batch_size=args.batch_size,
+        sleep=args.sleep_ms / 1000,
+    )
 
+    with engine.connect() as conn:
         pending_after = conn.execute(text("SELECT COUNT(*) FROM orders WHERE COALESCE(is_draft, 0) = 1")).scalar() or 0
         print(f"Pending after update: {pending_after}")
         print("Done: all existing orders are marked as approved.")
@@ -0,0 +1,167 @@
+"""
+Versioned schema migrations.
+
+`schema_migrations` lists every step already applied. At startup migrate()
+reads that table once and runs only the missing steps, in order. A step's
+DDL runs in one transaction; data fixes it returns run afterwards as chunked
+backfills (backend/backfill.py), so big tables are not locked for the whole
+UPDATE. The version is recorded once both are done. A boot against an
+up-to-date database therefore costs the same few queries whatever the data
+size — no PRAGMA probes, speculative ALTERs or backfill UPDATEs.
+
+Adding a schema change: append a step to MIGRATIONS with the next version
+number; never edit, renumber or remove one that has shipped. A step gets a
+connection inside a transaction and may return a list of Backfill for its
+data. It must be safe to run on a database that already has the change: a
+new database gets the current models from step 1, and an interrupted step
+(SQLite does not roll back DDL, backfills stop mid-way) simply runs again on
+the next start, its backfills resuming from their saved progress.
+"""
+from datetime import datetime
+
+from sqlalchemy import text
+
+try:
+    from backend.database import Base, SchemaMigration, StockReservation
+    from backend import search, sync, idempotency, reservations
+    from backend.backfill import Backfill, run_backfill, is_unfinished
+except ImportError:
+    from database import Base, SchemaMigration, StockReservation
+    import search
+    import sync
+    import idempotency
+    import reservations
+    from backfill import Backfill, run_backfill, is_unfinished
+
+# pg_advisory_xact_lock key: several workers booting at once apply each step only once
+MIGRATION_LOCK_KEY = 7340021
+
+
+def _columns(conn, table):
+    if conn.dialect.name == "sqlite":
+        return {r[1] for r in conn.execute(text(f"PRAGMA table_info('{table}')")).fetchall()}
+    return {r[0] for r in conn.execute(
+        text("SELECT column_name FROM information_schema.columns WHERE table_name = :t"), {"t": table}
+    )}
+
+
+def _add_column(conn, table, column, ddl):
+    """ALTER TABLE ... ADD COLUMN unless it is there. Returns True if the column was added."""
+    if column in _columns(conn, table):
+        return False
+    conn.execute(text(f"ALTER TABLE {table} ADD COLUMN {column} {ddl}"))
+    return True
+
+
+def initial_schema(conn):
+    # new database: every table in its current shape; old database: only the missing tables
+    Base.metadata.create_all(bind=conn)
+
+
+def created_ts_columns(conn):
+    if conn.dialect.name != "sqlite":
+        return  # PostgreSQL databases were created with the column
+    backfills = []
+    for table in ("orders", "debt_logs"):
+        _add_column(conn, table, "created_ts", "INTEGER")
+        backfills.append(Backfill(
+            f"{table}_created_ts", table,
+            "created_ts = (CAST(strftime('%s', created_at) AS INTEGER) * 1000) + id",
+            "created_ts IS NULL OR created_ts % 1000 == 0",
+        ))
+    return backfills
+
+
+def is_draft_column(conn):
+    _add_column(conn, "orders", "is_draft", "INTEGER DEFAULT 0")
+    return [Backfill("orders_is_draft", "orders", "is_draft = 0", "is_draft IS NULL")]
+
+
+def status_column(conn):
+    """Move orders from is_draft to status ('pending' | 'accepted' | 'completed')."""
+    backfills = []
+    # the DEFAULT fills every existing row with 'completed': drafts have to be put back to pending
+    if _add_column(conn, "orders", "status", "VARCHAR DEFAULT 'completed'") \
+            or is_unfinished(conn, "orders_status_from_is_draft"):
+        backfills.append(Backfill("orders_status_from_is_draft", "orders", "status = 'pending'", "is_draft = 1"))
+    backfills.append(Backfill(
+        "orders_status_nulls", "orders",
+        "status = CASE WHEN is_draft = 1 THEN 'pending' ELSE 'completed' END", "status IS NULL",
+    ))
+    return backfills
+
+
+def history_indexes(conn):
+    # per-customer lookups (history, delete) on the two biggest tables
+    conn.execute(text("CREATE INDEX IF NOT EXISTS ix_orders_customer_ts ON orders (customer_id, created_ts)"))
+    conn.execute(text("CREATE INDEX IF NOT EXISTS ix_debt_logs_customer_ts ON debt_logs (customer_id, created_ts)"))
+
+
+def stock_reservations(conn):
+    """variants.reserved + the stock_reservations ledger, with holds for the orders already open."""
+    _add_column(conn, "variants", "reserved", "INTEGER DEFAULT 0")
+    StockReservation.__table__.create(bind=conn, checkfirst=True)
+    reservations.rebuild(conn)
+
+
+MIGRATIONS = [
+    (1, "initial_schema", initial_schema),
+    (2, "created_ts_columns", created_ts_columns),
+    (3, "is_draft_column", is_draft_column),
+    (4, "status_column", status_column),
+    (5, "history_indexes", history_indexes),
+    (6, "product_search", search.create_search_schema),
+    (7, "sync_change_feed", sync.create_sync_schema),
+    (8, "idempotency_keys", idempotency.create_idempotency_schema),
+    (9, "stock_reservations", stock_reservations),
+    (10, "search_name_missing_index", search.create_missing_name_index),
+    (11, "sync_transaction_ids", sync.use_transaction_ids),
+]
+
+
+def applied_versions(bind):
+    SchemaMigration.__table__.create(bind=bind, checkfirst=True)
+    with bind.connect() as conn:
+        return {v for (v,) in conn.execute(text("SELECT version FROM schema_migrations"))}
+
+
+def _lock_and_check(conn, version):
+    """PostgreSQL: serialize workers booting at once. True if `version` is already recorded."""
+    if conn.dialect.name != "postgresql":
+        return False
+    conn.execute(text("SELECT pg_advisory_xact_lock(:k)"), {"k": MIGRATION_LOCK_KEY})
+    # another worker may have applied it while we waited for the lock
+    return conn.execute(text("SELECT 1 FROM schema_migrations WHERE version = :v"), {"v": version}).first() is not None
+
+
+def migrate(bind):
+    """Apply pending migrations in order. Stops at the first failure (logged); returns the versions applied now."""
+    try:
+        done = applied_versions(bind)
+    except Exception as e:
+        print("Warning: could not read schema_migrations:", e)
+        return []
+
+    applied = []
+    for version, name, step in MIGRATIONS:
+        if version in done:
+            continue
+        try:
+            with bind.begin() as conn:
+                if _lock_and_check(conn, version):
+                    continue
+                backfills = step(conn) or []
+            for backfill in backfills:
+                run_backfill(bind, backfill)
+            with bind.begin() as conn:
+                if _lock_and_check(conn, version):
+                    continue
+                conn.execute(SchemaMigration.__table__.insert().values(
+                    version=version, name=name, applied_at=datetime.now()
+                ))
+        except Exception as e:
+            print(f"Warning: migration {version} ({name}) failed, later migrations not applied:", e)
+            break
+        print(f"Applied migration {version} ({name})")
+        applied.append(version)
+    return applied
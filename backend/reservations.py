@@ -0,0 +1,224 @@
+"""
+Stock reservations for orders that are not completed yet.
+
+A PENDING or ACCEPTED order holds its quantities in `stock_reservations`
+(one row per order and variant) and the running total per variant is kept in
+`variants.reserved`. Available-to-promise is `stock - reserved`, read from the
+variant row itself: the queues flag conflicts from it, /stock/available
+answers it per variant, and checkout, confirm and order edits never take
+stock that is promised to another order.
+
+Holds are granted first come, first served and all-or-nothing per variant: a
+variant whose available stock does not cover the order is not held, and the
+order shows a stock conflict until stock comes in. Accepting an order tries
+those variants again and renews the holds it has. Confirm turns the holds into
+the stock deduction, reject and delete release them, and so does deleting the
+variant. Holds older than RESERVATION_TTL_HOURS (an order nobody handled) no
+longer count: reads leave them out of `reserved`, and every write that moves
+stock or holds first releases them (one DELETE on the expires_at index, which
+finds nothing almost always).
+
+Every change is a guarded UPDATE or a DELETE ... RETURNING on the ledger, so two
+requests cannot grant the same units or release the same hold twice. Nothing
+here commits: the ledger moves in the caller's transaction.
+"""
+import os
+from datetime import datetime, timedelta
+
+from sqlalchemy import select, insert, update, delete, case, func, or_
+
+try:
+    from backend.database import Variant, Order, OrderItem, StockReservation
+except ImportError:
+    from database import Variant, Order, OrderItem, StockReservation
+
+TTL = timedelta(hours=int(os.environ.get("RESERVATION_TTL_HOURS", "24")))
+OPEN_STATUSES = ("pending", "accepted")
+
+
+def _totals(lines):
+    """[(variant_id, quantity)] -> {variant_id: qty}"""
+    totals = {}
+    for variant_id, quantity in lines:
+        if variant_id and quantity:
+            totals[variant_id] = totals.get(variant_id, 0) + quantity
+    return totals
+
+
+def live_reserved(now=None):
+    """
+    Column expression: variants.reserved without the holds that expired and were not
+    released yet (a correlated sum on the expires_at index, empty almost always).
+    """
+    expired = (
+        select(func.coalesce(func.sum(StockReservation.quantity), 0))
+        .where(StockReservation.expires_at < (now or datetime.now()), StockReservation.variant_id == Variant.id)
+        .correlate(Variant)
+        .scalar_subquery()
+    )
+    return func.coalesce(Variant.reserved, 0) - expired
+
+
+def available_stock(db, variant_ids):
+    """{variant_id: stock - live reserved} in one primary-key read. Deleted variants are absent."""
+    if not variant_ids:
+        return {}
+    rows = db.execute(select(Variant.id, Variant.stock, live_reserved()).where(Variant.id.in_(list(variant_ids))))
+    return {vid: (stock or 0) - (reserved or 0) for vid, stock, reserved in rows}
+
+
+def holds(db, order_ids):
+    """{order_id: {variant_id: quantity held}} for `order_ids`, expired holds left out."""
+    held = {}
+    if order_ids:
+        for order_id, variant_id, quantity in db.execute(
+            select(StockReservation.order_id, StockReservation.variant_id, StockReservation.quantity)
+            .where(StockReservation.order_id.in_(list(order_ids)), StockReservation.expires_at >= datetime.now())
+        ):
+            per_order = held.setdefault(order_id, {})
+            per_order[variant_id] = per_order.get(variant_id, 0) + (quantity or 0)
+    return held
+
+
+def reserve(db, lines_by_order, now=None):
+    """
+    Hold stock for `lines_by_order` = {order_id: [(variant_id, quantity)]}, served in that order.
+    Variants an order already holds keep their hold (renewed); the others are held when their
+    available stock covers them. Returns {order_id: [variant ids left without a hold]} for the
+    orders that could not get everything.
+    """
+    if not lines_by_order:
+        return {}
+    now = now or datetime.now()
+    release_expired(db, now=now)
+    order_ids = list(lines_by_order)
+    held = {(o, v) for o, per_order in holds(db, order_ids).items() for v in per_order}
+    if held:
+        db.execute(
+            update(StockReservation)
+            .where(StockReservation.order_id.in_(order_ids))
+            .values(expires_at=now + TTL)
+            .execution_options(synchronize_session=False)
+        )
+
+    wanted = {
+        order_id: {vid: qty for vid, qty in _totals(lines).items() if (order_id, vid) not in held}
+        for order_id, lines in lines_by_order.items()
+    }
+    available = available_stock(db, {vid for per_order in wanted.values() for vid in per_order})
+    grants, totals = [], {}
+    for order_id, per_order in wanted.items():
+        for vid, qty in per_order.items():
+            if available.get(vid, 0) >= qty:
+                available[vid] -= qty
+                grants.append((order_id, vid, qty))
+                totals[vid] = totals.get(vid, 0) + qty
+
+    granted = set()
+    if totals:
+        # guarded like take_stock: a variant another request reserved or sold meanwhile is not held
+        qty = case(totals, value=Variant.id)
+        granted = set(db.execute(
+            update(Variant)
+            .where(Variant.id.in_(totals),
+                   func.coalesce(Variant.stock, 0) - func.coalesce(Variant.reserved, 0) >= qty)
+            .values(reserved=func.coalesce(Variant.reserved, 0) + qty)
+            .returning(Variant.id)
+            .execution_options(synchronize_session=False)
+        ).scalars().all())
+    rows = [
+        {"order_id": order_id, "variant_id": vid, "quantity": qty, "created_at": now, "expires_at": now + TTL}
+        for order_id, vid, qty in grants if vid in granted
+    ]
+    if rows:
+        db.execute(insert(StockReservation), rows)
+
+    short = {}
+    for order_id, per_order in wanted.items():
+        missing = [vid for vid in per_order if vid not in granted]
+        if missing:
+            short[order_id] = missing
+    return short
+
+
+def take(db, order_ids):
+    """
+    Delete the holds of `order_ids` and return {variant_id: quantity} they held.
+    `variants.reserved` is NOT lowered: the caller does it in its stock UPDATE (take_stock)
+    or calls unreserve(). Expired holds are released first, so they are not returned.
+    """
+    taken = {}
+    if order_ids:
+        release_expired(db)
+        for variant_id, quantity in db.execute(
+            delete(StockReservation)
+            .where(StockReservation.order_id.in_(list(order_ids)))
+            .returning(StockReservation.variant_id, StockReservation.quantity)
+            .execution_options(synchronize_session=False)
+        ):
+            taken[variant_id] = taken.get(variant_id, 0) + (quantity or 0)
+    return taken
+
+
+def unreserve(db, taken):
+    """variants.reserved -= quantity for `taken` = {variant_id: quantity}, in one UPDATE."""
+    if not taken:
+        return
+    db.execute(
+        update(Variant)
+        .where(Variant.id.in_(taken))
+        .values(reserved=func.coalesce(Variant.reserved, 0) - case(taken, value=Variant.id))
+        .execution_options(synchronize_session=False)
+    )
+
+
+def release(db, order_ids):
+    """Give back the stock held by `order_ids` (rejected or deleted orders)."""
+    unreserve(db, take(db, order_ids))
+
+
+def drop_variants(db, variant_ids):
+    """Delete the holds on variants that are being deleted (nothing left to lower `reserved` on)."""
+    if variant_ids:
+        db.execute(
+            delete(StockReservation)
+            .where(StockReservation.variant_id.in_(list(variant_ids)))
+            .execution_options(synchronize_session=False)
+        )
+
+
+def release_expired(db, now=None):
+    """Release holds past their expires_at. Returns the units released."""
+    expired = {}
+    for variant_id, quantity in db.execute(
+        delete(StockReservation)
+        .where(StockReservation.expires_at < (now or datetime.now()))
+        .returning(StockReservation.variant_id, StockReservation.quantity)
+        .execution_options(synchronize_session=False)
+    ):
+        expired[variant_id] = expired.get(variant_id, 0) + (quantity or 0)
+    unreserve(db, expired)
+    return sum(expired.values())
+
+
+def rebuild(db):
+    """
+    Recompute every hold from the open orders, oldest first: the migration that
+    introduces the ledger, or a repair after the tables were edited by hand.
+    """
+    db.execute(delete(StockReservation))
+    db.execute(
+        update(Variant)
+        .where(or_(Variant.reserved.is_(None), Variant.reserved != 0))
+        .values(reserved=0)
+        .execution_options(synchronize_session=False)
+    )
+    lines_by_order = {}
+    for order_id, variant_id, quantity in db.execute(
+        select(OrderItem.order_id, OrderItem.variant_id, OrderItem.quantity)
+        .join(Order, Order.id == OrderItem.order_id)
+        .where(Order.status.in_(OPEN_STATUSES))
+        .order_by(Order.created_ts, Order.id, OrderItem.id)
+    ):
+        lines_by_order.setdefault(order_id, []).append((variant_id, quantity))
+    return reserve(db, lines_by_order)
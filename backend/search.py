@@ -0,0 +1,200 @@
+"""
+Product search: accent-insensitive, index-backed name matching.
+
+Every product keeps `search_name` = name lower-cased with Vietnamese diacritics
+removed ("Giày Đỏ" -> "giay do"), so "giay" finds "giày". On top of that column:
+- SQLite: FTS5 table `product_search` with the trigram tokenizer (substring match)
+- PostgreSQL: pg_trgm GIN index on `search_name` (LIKE uses the index, ranked by similarity)
+- Fallback (old SQLite / no pg_trgm): plain LIKE on `search_name`, still accent-insensitive
+"""
+import unicodedata
+
+from sqlalchemy import event, text, Integer, func
+
+try:
+    from backend.database import Product
+except ImportError:
+    from database import Product
+
+# "fts5" | "pg_trgm" | "like" — decided by detect_search_backend() at startup
+search_backend = "like"
+# dialect of the database searched: the LIKE fallback ranks with instr() (SQLite) or strpos() (PostgreSQL)
+search_dialect = "sqlite"
+
+# trigram index needs at least 3 characters per token
+MIN_TRIGRAM_LEN = 3
+
+
+def normalize_text(value):
+    """Lower-case, strip diacritics (đ -> d) and collapse whitespace."""
+    if not value:
+        return ""
+    value = value.replace("đ", "d").replace("Đ", "D")
+    decomposed = unicodedata.normalize("NFD", value)
+    stripped = "".join(ch for ch in decomposed if unicodedata.category(ch) != "Mn")
+    return " ".join(stripped.lower().split())
+
+
+@event.listens_for(Product, "before_insert")
+@event.listens_for(Product, "before_update")
+def _sync_search_name(mapper, connection, target):
+    target.search_name = normalize_text(target.name)
+
+
+def create_search_schema(conn):
+    """Migration step: add/backfill `search_name` and build the trigram index for this database."""
+    if conn.dialect.name == "sqlite":
+        cols = [r[1] for r in conn.execute(text("PRAGMA table_info('products')")).fetchall()]
+        if "search_name" not in cols:
+            conn.execute(text("ALTER TABLE products ADD COLUMN search_name VARCHAR"))
+    else:
+        conn.execute(text("ALTER TABLE products ADD COLUMN IF NOT EXISTS search_name VARCHAR"))
+
+    _fill_search_names(conn)
+
+    if conn.dialect.name == "sqlite":
+        _create_sqlite_fts(conn)
+    else:
+        _create_pg_trgm(conn)
+
+
+def create_missing_name_index(conn):
+    """Migration step: partial index of the products without search_name, so the boot check is one empty lookup."""
+    conn.execute(text(
+        "CREATE INDEX IF NOT EXISTS ix_products_search_name_missing ON products (id) WHERE search_name IS NULL"
+    ))
+
+
+def _fill_search_names(conn):
+    # rows written by older code / external scripts (raw INSERTs skip the ORM hook) have no search_name yet
+    missing = conn.execute(text("SELECT id, name FROM products WHERE search_name IS NULL")).fetchall()
+    if missing:
+        conn.execute(
+            text("UPDATE products SET search_name = :s WHERE id = :id"),
+            [{"s": normalize_text(name), "id": pid} for pid, name in missing],
+        )
+    return len(missing)
+
+
+def fill_search_names(bind):
+    """
+    At every startup: give a search_name to products inserted without the ORM
+    (read_data.py, seed_data.py, migrate_to_cloud.py), otherwise search can never
+    find them. One lookup on an empty partial index when there is nothing to fix.
+    """
+    try:
+        with bind.begin() as conn:
+            filled = _fill_search_names(conn)
+        if filled:
+            print(f"Filled search_name of {filled} products")
+        return filled
+    except Exception as e:
+        print("Warning: fill_search_names failed:", e)
+        return 0
+
+
+def detect_search_backend(bind):
+    """Pick the search strategy from the index the migration managed to build (one catalog lookup)."""
+    global search_backend, search_dialect
+    search_dialect = bind.dialect.name
+    try:
+        with bind.connect() as conn:
+            if conn.dialect.name == "sqlite":
+                found = conn.execute(text(
+                    "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'product_search'"
+                )).first()
+                search_backend = "fts5" if found else "like"
+            else:
+                found = conn.execute(text(
+                    "SELECT 1 FROM pg_indexes WHERE indexname = 'ix_products_search_name_trgm'"
+                )).first()
+                search_backend = "pg_trgm" if found else "like"
+    except Exception as e:
+        print("Warning: detect_search_backend failed, using LIKE search:", e)
+        search_backend = "like"
+    return search_backend
+
+
+def _create_sqlite_fts(conn):
+    exists = conn.execute(text(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'product_search'"
+    )).first()
+    if not exists:
+        try:
+            conn.execute(text(
+                "CREATE VIRTUAL TABLE product_search USING fts5("
+                "search_name, content='products', content_rowid='id', tokenize='trigram')"
+            ))
+        except Exception as e:
+            # SQLite < 3.34 has no trigram tokenizer
+            print("Warning: FTS5 trigram index unavailable, using LIKE search:", e)
+            return
+        conn.execute(text("INSERT INTO product_search(product_search) VALUES ('rebuild')"))
+    conn.execute(text(
+        "CREATE TRIGGER IF NOT EXISTS products_search_ai AFTER INSERT ON products BEGIN "
+        "INSERT INTO product_search(rowid, search_name) VALUES (new.id, new.search_name); END"
+    ))
+    conn.execute(text(
+        "CREATE TRIGGER IF NOT EXISTS products_search_ad AFTER DELETE ON products BEGIN "
+        "INSERT INTO product_search(product_search, rowid, search_name) "
+        "VALUES ('delete', old.id, old.search_name); END"
+    ))
+    conn.execute(text(
+        "CREATE TRIGGER IF NOT EXISTS products_search_au AFTER UPDATE OF search_name ON products BEGIN "
+        "INSERT INTO product_search(product_search, rowid, search_name) "
+        "VALUES ('delete', old.id, old.search_name); "
+        "INSERT INTO product_search(rowid, search_name) VALUES (new.id, new.search_name); END"
+    ))
+
+
+def _create_pg_trgm(conn):
+    # savepoint: without the extension (no permission) the rest of the migration still commits
+    try:
+        with conn.begin_nested():
+            conn.execute(text("CREATE EXTENSION IF NOT EXISTS pg_trgm"))
+            conn.execute(text(
+                "CREATE INDEX IF NOT EXISTS ix_products_search_name_trgm "
+                "ON products USING gin (search_name gin_trgm_ops)"
+            ))
+    except Exception as e:
+        print("Warning: pg_trgm index unavailable, using LIKE search:", e)
+
+
+def _fts_phrase(token):
+    return '"' + token.replace('"', '""') + '"'
+
+
+def search_products(query, search):
+    """
+    Filter a Product query by `search`. Returns (query, rank) where `rank` is a
+    column to ORDER BY ascending (best match first), or None when there is no score.
+    Every word must match somewhere in the name, in any order.
+    """
+    words = normalize_text(search).split()
+    if not words:
+        return query, None
+
+    long_words = [w for w in words if len(w) >= MIN_TRIGRAM_LEN]
+    short_words = [w for w in words if len(w) < MIN_TRIGRAM_LEN]
+
+    if search_backend == "fts5" and long_words:
+        matches = (
+            text("SELECT rowid FROM product_search WHERE product_search MATCH :q")
+            .bindparams(q=" AND ".join(_fts_phrase(w) for w in long_words))
+            .columns(rowid=Integer)
+        )
+        query = query.filter(Product.id.in_(matches))
+    else:
+        short_words = words
+
+    for w in short_words:
+        query = query.filter(Product.search_name.contains(w, autoescape=True))
+
+    if search_backend == "pg_trgm":
+        rank = -func.similarity(Product.search_name, " ".join(words))
+    else:
+        # bm25 over trigrams costs ~10x the match itself on broad queries, so rank cheaply:
+        # names where the first word appears earlier come first, then shorter (closer) names
+        position = func.strpos if search_dialect == "postgresql" else func.instr
+        rank = position(Product.search_name, words[0]) * 10000 + func.length(Product.search_name)
+    return query, rank
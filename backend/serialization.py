@@ -0,0 +1,224 @@
+"""
+Response encoding: fast JSON, optional MessagePack, gzip/brotli compression.
+
+- JSON goes through orjson when installed (falls back to the json module).
+- A client sending `Accept: application/msgpack` (and msgpack installed) gets
+  MessagePack instead of JSON — same structure, smaller and faster to parse.
+- CompressionMiddleware compresses bodies >= COMPRESS_MIN_SIZE with brotli
+  (if installed and accepted) or gzip. SSE streams are passed through untouched.
+- Accept / Accept-Encoding are read with their q-values (`br;q=0` refuses brotli),
+  and every response carries them in `Vary`, merged into what the endpoint set.
+"""
+import contextvars
+import gzip
+import json
+import os
+
+from fastapi.responses import JSONResponse
+from starlette.concurrency import run_in_threadpool
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+JSON_TYPE = "application/json"
+MSGPACK_TYPE = "application/msgpack"
+MSGPACK_ACCEPT = ("application/msgpack", "application/x-msgpack")
+
+COMPRESS_MIN_SIZE = int(os.environ.get("COMPRESS_MIN_SIZE", "1024"))
+GZIP_LEVEL = 5
+BROTLI_QUALITY = 4
+# bigger bodies are compressed in the threadpool so the event loop (SSE, other requests) keeps running
+THREADPOOL_MIN_SIZE = 64 * 1024
+
+# media type and content coding the current request asked for, set by CompressionMiddleware
+_response_type = contextvars.ContextVar("response_type", default=JSON_TYPE)
+_response_encoding = contextvars.ContextVar("response_encoding", default=None)
+
+
+def dumps_json(obj):
+    if orjson is not None:
+        return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS)
+    return json.dumps(obj, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+
+def negotiated_type():
+    return _response_type.get()
+
+
+def negotiated_encoding():
+    """"br", "gzip" or None: what CompressionMiddleware would compress this response with."""
+    return _response_encoding.get()
+
+
+def dumps(obj, media_type=None):
+    """Encode `obj` in the negotiated format. Returns (body bytes, media type)."""
+    media_type = media_type or negotiated_type()
+    if media_type == MSGPACK_TYPE:
+        return msgpack.packb(obj, use_bin_type=True), MSGPACK_TYPE
+    return dumps_json(obj), JSON_TYPE
+
+
+class FastJSONResponse(JSONResponse):
+    """Default response class: orjson-encoded JSON, or MessagePack when the client asked for it."""
+
+    def __init__(self, content, *args, **kwargs):
+        self._media_type = negotiated_type()
+        super().__init__(content, *args, **kwargs)
+        if self._media_type == MSGPACK_TYPE:
+            self.headers["content-type"] = MSGPACK_TYPE
+
+    def render(self, content):
+        body, _ = dumps(content, self._media_type)
+        return body
+
+
+def compress(body, encoding):
+    if encoding == "br":
+        return brotli.compress(body, quality=BROTLI_QUALITY)
+    return gzip.compress(body, compresslevel=GZIP_LEVEL)
+
+
+def encode_body(body, encoding, minimum_size=COMPRESS_MIN_SIZE):
+    """
+    Compress `body` the way CompressionMiddleware would. Returns (body, content coding or None).
+    For an endpoint that caches its bodies: the middleware passes a response that already has a
+    Content-Encoding through untouched, so a cache hit costs no compression and no thread hop.
+    """
+    if encoding is None or len(body) < minimum_size:
+        return body, None
+    return compress(body, encoding), encoding
+
+
+def _qvalues(header):
+    """{token: q} of an Accept / Accept-Encoding header ("gzip;q=0.5, br" -> {"gzip": 0.5, "br": 1.0})."""
+    qs = {}
+    for item in (header or "").lower().split(","):
+        token, *params = [part.strip() for part in item.split(";")]
+        if not token:
+            continue
+        q = 1.0
+        for param in params:
+            name, _, value = param.partition("=")
+            if name.strip() == "q":
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        qs[token] = max(q, qs.get(token, 0.0))
+    return qs
+
+
+def _accepts(header, *values):
+    """Highest q the header gives any of `values` (0 when absent or refused with q=0)."""
+    qs = _qvalues(header)
+    return max((qs.get(v, 0.0) for v in values), default=0.0)
+
+
+def _merge_vary(headers, names):
+    """Raw ASGI headers with `names` added to Vary: merged into an existing Vary, no duplicates."""
+    existing = [v.decode("latin-1") for k, v in headers if k.lower() == b"vary"]
+    tokens = [t.strip() for value in existing for t in value.split(",") if t.strip()]
+    if "*" in tokens:
+        return headers
+    seen = {t.lower() for t in tokens}
+    tokens += [n for n in names if n.lower() not in seen]
+    out = [(k, v) for k, v in headers if k.lower() != b"vary"]
+    out.append((b"vary", ", ".join(tokens).encode("latin-1")))
+    return out
+
+
+class CompressionMiddleware:
+    """Pure ASGI middleware: content negotiation (msgpack) + gzip/brotli for large bodies."""
+
+    def __init__(self, app, minimum_size=COMPRESS_MIN_SIZE):
+        self.app = app
+        self.minimum_size = minimum_size
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        headers = {k.decode("latin-1").lower(): v.decode("latin-1") for k, v in scope["headers"]}
+        # msgpack only when asked for explicitly, and not ranked below JSON
+        msgpack_q = _accepts(headers.get("accept"), *MSGPACK_ACCEPT) if msgpack is not None else 0.0
+        if msgpack_q > 0 and msgpack_q >= _accepts(headers.get("accept"), JSON_TYPE):
+            token = _response_type.set(MSGPACK_TYPE)
+        else:
+            token = _response_type.set(JSON_TYPE)
+        vary = ("Accept", "Accept-Encoding") if msgpack is not None else ("Accept-Encoding",)
+
+        # the best-ranked coding we can produce; brotli wins a tie
+        coding_qs = {"gzip": _accepts(headers.get("accept-encoding"), "gzip")}
+        if brotli is not None:
+            coding_qs["br"] = _accepts(headers.get("accept-encoding"), "br")
+        encoding = max(sorted(coding_qs), key=coding_qs.get)
+        if coding_qs[encoding] <= 0:
+            encoding = None
+
+        async def send_vary(message):
+            if message["type"] == "http.response.start":
+                message = {**message, "headers": _merge_vary(message["headers"], vary)}
+            await send(message)
+
+        encoding_token = _response_encoding.set(encoding)
+        if encoding is None:
+            try:
+                await self.app(scope, receive, send_vary)
+            finally:
+                _response_type.reset(token)
+                _response_encoding.reset(encoding_token)
+            return
+
+        start_message = None
+        chunks = []
+        passthrough = False
+
+        async def send_wrapper(message):
+            nonlocal start_message, passthrough
+            if passthrough:
+                await send(message)
+                return
+            if message["type"] == "http.response.start":
+                start_message = message
+                resp_headers = {k.decode("latin-1").lower(): v.decode("latin-1") for k, v in message["headers"]}
+                if "content-encoding" in resp_headers or resp_headers.get("content-type", "").startswith("text/event-stream"):
+                    passthrough = True
+                    await send_vary(message)
+                return
+            if message["type"] == "http.response.body":
+                chunks.append(message.get("body", b""))
+                if message.get("more_body", False):
+                    return
+                body = b"".join(chunks)
+                out_headers = list(start_message["headers"])
+                if len(body) >= self.minimum_size:
+                    if len(body) >= THREADPOOL_MIN_SIZE:
+                        body = await run_in_threadpool(compress, body, encoding)
+                    else:
+                        body = compress(body, encoding)
+                    out_headers = [(k, v) for k, v in out_headers if k.lower() != b"content-length"]
+                    out_headers.append((b"content-encoding", encoding.encode("latin-1")))
+                    out_headers.append((b"content-length", str(len(body)).encode("latin-1")))
+                await send_vary({**start_message, "headers": out_headers})
+                await send({"type": "http.response.body", "body": body})
+                return
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            _response_type.reset(token)
+            _response_encoding.reset(encoding_token)
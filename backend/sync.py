@@ -0,0 +1,173 @@
+"""
+Change feed for /sync.
+
+Every write transaction takes a version (once, on its first flush) and stamps it
+into `row_version` of each product/variant/customer/order it inserts or modifies.
+Deleted rows leave a Tombstone with that version. Changing a variant also re-stamps
+its product, changing an order item re-stamps its order, so clients can re-fetch
+the parent as a whole.
+
+A /sync token is the first version the client has not seen: the next call returns
+rows with row_version >= token.
+- SQLite (one writer at a time): the version is the `sync_state.version` counter,
+  the token is that counter + 1.
+- PostgreSQL: the version is the writing transaction's own id (txid_current()), so
+  writers share no row and never wait for each other. The token is the xmin of the
+  reader's snapshot: every transaction below it has finished, so nothing that
+  commits later can carry a version the client has already passed. Rows of
+  transactions that were still running are simply sent again next time.
+
+Bulk `query(...).delete()/update()` bypasses the ORM hooks — use record_deletes()
+/ touch() next to those statements.
+"""
+from datetime import datetime, timedelta
+
+from sqlalchemy import event, text
+from sqlalchemy.orm import Session
+
+try:
+    from backend.database import Product, Variant, Customer, Order, OrderItem, SyncState, Tombstone
+except ImportError:
+    from database import Product, Variant, Customer, Order, OrderItem, SyncState, Tombstone
+
+TRACKED = (Product, Variant, Customer, Order)
+# child model -> (parent model, foreign key attribute, relationship attribute)
+PARENTS = {Variant: (Product, "product_id", "product"), OrderItem: (Order, "order_id", "order")}
+
+TOMBSTONE_RETENTION_DAYS = 90
+
+
+def create_sync_schema(conn):
+    """Migration step: row_version columns on pre-existing tables and the counter row."""
+    sqlite = conn.dialect.name == "sqlite"
+    for model in TRACKED:
+        table = model.__tablename__
+        if sqlite:
+            cols = [r[1] for r in conn.execute(text(f"PRAGMA table_info('{table}')")).fetchall()]
+            if "row_version" not in cols:
+                conn.execute(text(f"ALTER TABLE {table} ADD COLUMN row_version BIGINT DEFAULT 0"))
+        else:
+            conn.execute(text(f"ALTER TABLE {table} ADD COLUMN IF NOT EXISTS row_version BIGINT DEFAULT 0"))
+        conn.execute(text(f"CREATE INDEX IF NOT EXISTS ix_{table}_row_version ON {table} (row_version)"))
+    if not conn.execute(text("SELECT 1 FROM sync_state WHERE id = 1")).first():
+        conn.execute(text("INSERT INTO sync_state (id, version, pruned_version) VALUES (1, 0, 0)"))
+
+
+def prune_tombstones(db, days=TOMBSTONE_RETENTION_DAYS):
+    """Drop old tombstones; clients whose token is not past them get a full snapshot."""
+    cutoff = int((datetime.utcnow() - timedelta(days=days)).timestamp() * 1000)
+    newest = db.execute(
+        text("SELECT MAX(row_version) FROM tombstones WHERE created_ts < :c"), {"c": cutoff}
+    ).scalar()
+    if newest is None:
+        return
+    db.query(Tombstone).filter(Tombstone.row_version <= newest).delete(synchronize_session=False)
+    db.query(SyncState).filter(SyncState.id == 1).update({SyncState.pruned_version: newest})
+    db.commit()
+
+
+def _postgres(db):
+    return db.get_bind().dialect.name == "postgresql"
+
+
+def current_version(db):
+    """A value that changes with every committed write (cache keys)."""
+    if _postgres(db):
+        # equal snapshots see exactly the same committed transactions
+        return db.execute(text("SELECT txid_current_snapshot()::text")).scalar()
+    return db.execute(text("SELECT version FROM sync_state WHERE id = 1")).scalar() or 0
+
+
+def current_token(db):
+    """The /sync token for a read starting now: the first version that may not be visible yet."""
+    if _postgres(db):
+        return db.execute(text("SELECT txid_snapshot_xmin(txid_current_snapshot())")).scalar()
+    return (db.execute(text("SELECT version FROM sync_state WHERE id = 1")).scalar() or 0) + 1
+
+
+def pruned_version(db):
+    return db.execute(text("SELECT pruned_version FROM sync_state WHERE id = 1")).scalar() or 0
+
+
+def next_version(session):
+    """The row_version for the current transaction (allocated on first use)."""
+    ver = session.info.get("sync_version")
+    if ver is None:
+        conn = session.connection()
+        if conn.dialect.name == "postgresql":
+            ver = conn.execute(text("SELECT txid_current()")).scalar()
+        else:
+            conn.execute(text("UPDATE sync_state SET version = version + 1 WHERE id = 1"))
+            ver = conn.execute(text("SELECT version FROM sync_state WHERE id = 1")).scalar()
+        session.info["sync_version"] = ver
+    return ver
+
+
+def use_transaction_ids(conn):
+    """
+    Migration step: PostgreSQL versions become transaction ids. They normally are far
+    above the old counter already; if not (database restored into a new cluster), old
+    versions are zeroed and the tombstones dropped, so every client takes a full snapshot.
+    """
+    if conn.dialect.name != "postgresql":
+        return
+    xid = conn.execute(text("SELECT txid_current()")).scalar()
+    if (conn.execute(text("SELECT version FROM sync_state WHERE id = 1")).scalar() or 0) < xid:
+        return
+    for model in TRACKED:
+        conn.execute(text(f"UPDATE {model.__tablename__} SET row_version = 0 WHERE row_version <> 0"))
+    conn.execute(text("DELETE FROM tombstones"))
+    conn.execute(text("UPDATE sync_state SET pruned_version = :x WHERE id = 1"), {"x": xid})
+
+
+def record_deletes(session, model, ids):
+    """Tombstones for rows removed with a bulk delete."""
+    ids = [i for i in ids if i is not None]
+    if not ids:
+        return
+    ver = next_version(session)
+    session.add_all([Tombstone(table_name=model.__tablename__, row_id=i, row_version=ver) for i in ids])
+
+
+def touch(session, model, ids):
+    """Re-stamp rows changed with a bulk update."""
+    ids = list(set(i for i in ids if i is not None))
+    if not ids:
+        return
+    session.query(model).filter(model.id.in_(ids)).update(
+        {model.row_version: next_version(session)}, synchronize_session=False
+    )
+
+
+@event.listens_for(Session, "before_flush")
+def _stamp_changes(session, flush_context, instances):
+    changed = [o for o in session.new if isinstance(o, TRACKED + tuple(PARENTS))]
+    changed += [o for o in session.dirty if isinstance(o, TRACKED + tuple(PARENTS)) and session.is_modified(o)]
+    deleted = [o for o in session.deleted if isinstance(o, TRACKED + tuple(PARENTS))]
+    if not changed and not deleted:
+        return
+
+    ver = next_version(session)
+    for obj in changed:
+        if isinstance(obj, TRACKED):
+            obj.row_version = ver
+    for obj in deleted:
+        if isinstance(obj, TRACKED) and obj.id is not None:
+            session.add(Tombstone(table_name=obj.__tablename__, row_id=obj.id, row_version=ver))
+
+    for obj in changed + deleted:
+        parent_info = PARENTS.get(type(obj))
+        if not parent_info:
+            continue
+        parent_model, fk, rel = parent_info
+        parent_id = getattr(obj, fk)
+        # not flushed yet: the parent may only be attached through the relationship
+        parent = session.get(parent_model, parent_id) if parent_id else obj.__dict__.get(rel)
+        if parent is not None and parent not in session.deleted:
+            parent.row_version = ver
+
+
+@event.listens_for(Session, "after_commit")
+@event.listens_for(Session, "after_rollback")
+def _reset_version(session):
+    session.info.pop("sync_version", None)
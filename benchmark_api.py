@@ -0,0 +1,1013 @@
+"""
+benchmark_api.py
+
+In-process checks and benchmarks for the FastAPI backend. Unlike
+`api_tester.py` this does not need a running server: it points the backend at
+a throw-away SQLite file, seeds it with synthetic data and calls the endpoint
+functions directly so SQL statements and timings can be measured.
+
+Usage:
+    python benchmark_api.py queries        # statement count must stay flat as data grows; /sync snapshot is paged
+    python benchmark_api.py search         # new search engine vs old LIKE '%x%' at 50k products
+    python benchmark_api.py serialize      # encode time and wire size: json vs orjson/msgpack, gzip/br
+    python benchmark_api.py concurrency    # burst of parallel reads; /products cache hits must not wait behind them
+    python benchmark_api.py sqlite         # concurrent read/write on a copy of shop.db: default vs tuned SQLite
+    python benchmark_api.py startup        # schema work at boot must not grow with the data
+    python benchmark_api.py backfill       # writer stalls during one big UPDATE vs a chunked, resumable backfill
+    python benchmark_api.py checkout       # parallel checkouts of one variant: no oversell, orders match the stock taken
+    python benchmark_api.py bulk           # a year of orders through POST /orders/bulk vs /checkout one by one
+    python benchmark_api.py catalog        # 10k-SKU catalog through POST /products/bulk: load, refresh, resend
+    python benchmark_api.py queue          # confirming a delivery run one by one vs POST /orders/batch/confirm
+    python benchmark_api.py reservations   # drafts racing for one variant: holds add up to the stock, the rest is flagged
+    python benchmark_api.py edit           # product edit after a sale / under a hold: stock never below 0 or reserved
+    python benchmark_api.py pool --database-url postgresql://localhost/ssm_bench
+                                           # pool under load + recovery after the server drops every connection
+
+The real `shop.db` is never touched (the sqlite benchmark works on copies).
+`--database-url` points the backend at another (throw-away!) database instead;
+its tables are created and seeded like the temporary SQLite file.
+"""
+
+import argparse
+import os
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+BENCH_DB = os.path.join(tempfile.gettempdir(), "ssm_benchmark.db")
+
+
+def remove_db(db_file):
+    for suffix in ("", "-wal", "-shm", "-journal"):
+        if os.path.exists(db_file + suffix):
+            os.remove(db_file + suffix)
+
+
+def load_backend(db_file=BENCH_DB, database_url=None):
+    """Import backend.api against a fresh SQLite file or `database_url` (must run before any backend import)."""
+    if database_url:
+        os.environ["DATABASE_URL"] = database_url
+    else:
+        remove_db(db_file)
+        os.environ["DATABASE_URL"] = f"sqlite:///{db_file}"
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    from backend import api, database
+    return api, database
+
+
+class StatementCounter:
+    """Counts SQL statements sent through the engine while active."""
+
+    def __init__(self, engine):
+        self.engine = engine
+        self.count = 0
+
+    def _on_execute(self, conn, cursor, statement, parameters, context, executemany):
+        self.count += 1
+
+    def __enter__(self):
+        from sqlalchemy import event
+        self.count = 0
+        event.listen(self.engine, "before_cursor_execute", self._on_execute)
+        return self
+
+    def __exit__(self, *exc):
+        from sqlalchemy import event
+        event.remove(self.engine, "before_cursor_execute", self._on_execute)
+
+
+def seed_products(database, n_products, variants_per_product=6, start=0):
+    db = database.SessionLocal()
+    try:
+        colors = ["Trắng", "Đen", "Xám", "Be", "Đỏ", "Xanh Dương"]
+        for i in range(start, start + n_products):
+            prod = database.Product(name=f"Giày mẫu {i}", description="", image_path="")
+            prod.variants = [
+                database.Variant(color=colors[j % len(colors)], size=str(36 + j), price=100000 + 1000 * j, stock=j * 3)
+                for j in range(variants_per_product)
+            ]
+            db.add(prod)
+        db.commit()
+    finally:
+        db.close()
+
+
+def check_queries(api, database, report):
+    """GET /products, /orders/pending and a one-line order edit must issue the same number of statements as data grows."""
+    print("[+] Counting SQL statements for GET /products ...")
+    counts = {}
+    total = 0
+    for size in (10, 100, 1000):
+        seed_products(database, size - total, start=total)
+        total = size
+        db = database.SessionLocal()
+        try:
+            with StatementCounter(database.engine) as counter:
+                rows = api.query_products(db, "", None, None, "-id")
+            counts[size] = counter.count
+            assert len(rows) == size
+        finally:
+            db.close()
+        print(f"    {size:>5} products -> {counts[size]} statements")
+
+    flat = len(set(counts.values())) == 1
+    report.append(("products_statement_count", flat, counts))
+
+    print("[+] Counting SQL statements for GET /orders/pending ...")
+    queue_counts = {}
+    total = 0
+    for size in (5, 50, 200):
+        seed_orders(database, size - total, status="pending")
+        total = size
+        db = database.SessionLocal()
+        try:
+            with StatementCounter(database.engine) as counter:
+                res = api.load_queue(db, "pending")
+            queue_counts[size] = counter.count
+            assert res["count"] == size
+        finally:
+            db.close()
+        print(f"    {size:>5} orders   -> {queue_counts[size]} statements")
+    queue_flat = len(set(queue_counts.values())) == 1
+    report.append(("pending_orders_statement_count", queue_flat, queue_counts))
+
+    print("[+] Counting SQL statements for PUT /orders/{id} changing one line ...")
+    db = database.SessionLocal()
+    db.query(database.Variant).update({database.Variant.stock: 10 ** 6})
+    db.commit()
+    variant_ids = [vid for (vid,) in db.query(database.Variant.id).order_by(database.Variant.id)]
+    db.close()
+    edit_counts = {}
+    for size in (5, 50, 200):
+        cart = [api.CartItem(variant_id=vid, quantity=1, price=1000, product_name="Giày", color="Trắng", size="40")
+                for vid in variant_ids[:size]]
+        db = database.SessionLocal()
+        try:
+            api.create_order(db, api.CheckoutRequest(customer_name="Khách sửa đơn", cart=cart))
+            order_id = db.query(database.Order.id).order_by(database.Order.id.desc()).limit(1).scalar()
+            cart[size // 2] = cart[size // 2].model_copy(update={"quantity": 3})
+            with StatementCounter(database.engine) as counter:
+                api.update_order(db, order_id, api.CheckoutRequest(customer_name="Khách sửa đơn", cart=cart))
+            edit_counts[size] = counter.count
+        finally:
+            db.close()
+        print(f"    {size:>5} lines    -> {edit_counts[size]} statements")
+    edit_flat = len(set(edit_counts.values())) == 1
+    report.append(("order_edit_statement_count", edit_flat, edit_counts))
+
+    print("[+] Paging the full /sync snapshot ...")
+    db = database.SessionLocal()
+    try:
+        expected = sum(db.query(m).count() for m in (database.Product, database.Customer, database.Order))
+        pages, rows, biggest, cursor = 0, 0, 0, None
+        while True:
+            page = api.changes_since(db, None, cursor, 200)
+            size = len(page["products"]) + len(page["customers"]) + len(page["orders"])
+            pages, rows, biggest = pages + 1, rows + size, max(biggest, size)
+            cursor = page["next_cursor"]
+            if not cursor:
+                break
+    finally:
+        db.close()
+    print(f"    {rows} rows in {pages} pages, largest {biggest}")
+    sync_paged = rows == expected and biggest <= 200
+    report.append(("sync_snapshot_paged", sync_paged, f"{rows}/{expected} rows, {pages} pages of <= {biggest}"))
+    return flat and queue_flat and edit_flat and sync_paged
+
+
+def seed_orders(database, n_orders, status="completed", items_per_order=20, customer_name="Khách bench"):
+    db = database.SessionLocal()
+    try:
+        variant_ids = [vid for (vid,) in db.query(database.Variant.id).limit(items_per_order * 5)]
+        customer = db.query(database.Customer).filter(database.Customer.name == customer_name).first()
+        if not customer:
+            customer = database.Customer(name=customer_name, phone="", debt=0)
+            db.add(customer)
+            db.flush()
+        for n in range(n_orders):
+            order = database.Order(customer_name=customer.name, customer_id=customer.id, total_amount=0,
+                                   is_draft=0 if status == "completed" else 1, status=status)
+            order.items = [
+                database.OrderItem(product_name="bench", variant_id=variant_ids[(n + k) % len(variant_ids)],
+                                   variant_info="Đen-40", quantity=1 + k % 3, price=100000)
+                for k in range(items_per_order)
+            ]
+            order.total_amount = sum(i.quantity * i.price for i in order.items)
+            db.add(order)
+        db.commit()
+    finally:
+        db.close()
+
+
+SEARCH_KINDS = ["Giày", "Dép", "Sandal", "Bốt", "Giày Lười", "Dép Tổ Ong"]
+SEARCH_BRANDS = ["Nike", "Adidas", "Jordan", "Hermes", "Gucci", "Converse", "Vans", "MLB", "Crocs", "Đông Hải"]
+SEARCH_COLORS = ["Trắng", "Đen", "Xám", "Đỏ", "Xanh Dương", "Nâu Đất"]
+SEARCH_QUERIES = ["giay", "giày", "dep to ong", "đông hải", "giay nike trang", "Giày Nike Trắng", "bot crocs 4",
+                  "xanh duong 42", "nâu đất 4999"]
+
+
+def seed_search_catalog(database, n_products):
+    db = database.SessionLocal()
+    try:
+        batch = []
+        for i in range(n_products):
+            name = (f"{SEARCH_KINDS[i % len(SEARCH_KINDS)]} {SEARCH_BRANDS[(i // 7) % len(SEARCH_BRANDS)]} "
+                    f"{SEARCH_COLORS[(i // 3) % len(SEARCH_COLORS)]} {i}")
+            batch.append(database.Product(name=name, description="", image_path=""))
+            if len(batch) == 5000:
+                db.add_all(batch)
+                db.commit()
+                batch = []
+        db.add_all(batch)
+        db.commit()
+    finally:
+        db.close()
+
+
+def bench_search(api, database, report, n_products=50000, repeat=20):
+    """Old `Product.name.contains` scan vs backend.search at catalog scale."""
+    from sqlalchemy import desc
+    from backend import search
+
+    print(f"[+] Seeding {n_products} products ...")
+    seed_search_catalog(database, n_products)
+    print(f"    search backend: {search.search_backend}")
+
+    db = database.SessionLocal()
+    try:
+        print(f"    {'query':<14}{'LIKE ms':>10}{'hits':>8}{'new ms':>10}{'hits':>8}")
+        missed = []
+        for q in SEARCH_QUERIES:
+            legacy = db.query(database.Product.id).filter(database.Product.name.contains(q)).order_by(desc(database.Product.id))
+            start = time.perf_counter()
+            for _ in range(repeat):
+                legacy_hits = len(legacy.all())
+            legacy_ms = (time.perf_counter() - start) * 1000 / repeat
+
+            new_query, rank = search.search_products(db.query(database.Product.id), q)
+            new_query = new_query.order_by(rank, desc(database.Product.id)) if rank is not None else new_query.order_by(desc(database.Product.id))
+            start = time.perf_counter()
+            for _ in range(repeat):
+                new_hits = len(new_query.all())
+            new_ms = (time.perf_counter() - start) * 1000 / repeat
+
+            print(f"    {q:<14}{legacy_ms:>10.2f}{legacy_hits:>8}{new_ms:>10.2f}{new_hits:>8}")
+            if new_hits < legacy_hits:
+                missed.append(q)
+        report.append(("search_finds_at_least_like_hits", not missed, missed or "ok"))
+    finally:
+        db.close()
+
+
+def bench_serialize(api, database, report, n_products=2000, n_customers=500, n_orders=300, repeat=20):
+    """Encode cost and bytes on the wire for the big list endpoints, old json.dumps vs backend.serialization."""
+    import gzip
+    import json
+    from fastapi.encoders import jsonable_encoder
+    from backend import serialization
+
+    print(f"[+] Seeding {n_products} products, {n_customers} customers, {n_orders} pending orders ...")
+    seed_products(database, n_products)
+    db = database.SessionLocal()
+    try:
+        db.add_all([database.Customer(name=f"Khách {i}", phone=f"09{i:08d}", debt=i * 1000) for i in range(n_customers)])
+        db.commit()
+    finally:
+        db.close()
+    seed_orders(database, n_orders, status="pending")
+
+    db = database.SessionLocal()
+    try:
+        payloads = {
+            "/products": api.query_products(db, "", None, None, "-id"),
+            "/customers": api.list_customers(db),
+            "/orders/pending": api.load_queue(db, "pending"),
+        }
+    finally:
+        db.close()
+    payloads = {path: jsonable_encoder(body) for path, body in payloads.items()}
+
+    def timed(fn):
+        start = time.perf_counter()
+        for _ in range(repeat):
+            out = fn()
+        return out, (time.perf_counter() - start) * 1000 / repeat
+
+    print(f"    orjson: {serialization.orjson is not None}, msgpack: {serialization.msgpack is not None}, "
+          f"brotli: {serialization.brotli is not None}")
+    print(f"    {'endpoint':<16}{'json ms':>9}{'json KB':>9}{'fast ms':>9}{'gzip KB':>9}{'gzip ms':>9}"
+          f"{'br KB':>8}{'br ms':>8}{'mpack KB':>10}")
+    slower = []
+    for path, body in payloads.items():
+        legacy, legacy_ms = timed(lambda: json.dumps(body, ensure_ascii=False, separators=(",", ":")).encode("utf-8"))
+        fast, fast_ms = timed(lambda: serialization.dumps_json(body))
+        gz, gz_ms = timed(lambda: serialization.compress(fast, "gzip"))
+        row = f"    {path:<16}{legacy_ms:>9.2f}{len(legacy) / 1024:>9.1f}{fast_ms:>9.2f}{len(gz) / 1024:>9.1f}{gz_ms:>9.2f}"
+        if serialization.brotli is not None:
+            br, br_ms = timed(lambda: serialization.compress(fast, "br"))
+            row += f"{len(br) / 1024:>8.1f}{br_ms:>8.2f}"
+        else:
+            row += f"{'-':>8}{'-':>8}"
+        if serialization.msgpack is not None:
+            packed, _ = serialization.dumps(body, serialization.MSGPACK_TYPE)
+            row += f"{len(packed) / 1024:>10.1f}"
+        print(row)
+        # same document either way, and the fast path must not lose to the stdlib
+        assert json.loads(fast) == json.loads(legacy) == json.loads(gzip.decompress(gz))
+        if serialization.orjson is not None and fast_ms > legacy_ms:
+            slower.append(path)
+    report.append(("fast_json_not_slower", not slower, slower or "ok"))
+
+
+def bench_concurrency(api, database, report, n_requests=400, concurrency=100):
+    """
+    A burst of parallel read requests through the ASGI app, with /products cache hits sent
+    alongside: the reads run in the threadpool, so a cache hit must not wait behind them.
+    """
+    import asyncio
+    import threading
+    import httpx
+
+    print("[+] Seeding 500 products, 50 pending + 300 completed orders ...")
+    seed_products(database, 500)
+    seed_orders(database, 50, status="pending", items_per_order=5)
+    seed_orders(database, 300, items_per_order=5)
+    urls = [
+        "/orders/pending", "/stats/summary", "/orders?page=3&limit=20", "/orders/status?ids=" + ",".join(map(str, range(1, 60))),
+        "/customers/1/history?limit=50", "/customers", "/orders/1/status",
+    ]
+
+    async def burst():
+        samples = []
+        stop = asyncio.Event()
+
+        async def sample_threads():
+            while not stop.is_set():
+                samples.append(threading.active_count())
+                await asyncio.sleep(0.005)
+
+        sem = asyncio.Semaphore(concurrency)
+        latencies, cache_latencies, failed = [], [], []
+        transport = httpx.ASGITransport(app=api.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+            await client.get("/products")  # warm the catalog cache
+
+            async def one(n):
+                url = urls[n % len(urls)]
+                async with sem:
+                    start = time.perf_counter()
+                    r = await client.get(url)
+                    latencies.append(time.perf_counter() - start)
+                if r.status_code != 200:
+                    failed.append((url, r.status_code))
+
+            async def cache_hits():
+                while not stop.is_set():
+                    start = time.perf_counter()
+                    r = await client.get("/products")
+                    cache_latencies.append(time.perf_counter() - start)
+                    if r.status_code != 200:
+                        failed.append(("/products", r.status_code))
+                    await asyncio.sleep(0.01)
+
+            sampler = asyncio.create_task(sample_threads())
+            hits = asyncio.create_task(cache_hits())
+            start = time.perf_counter()
+            await asyncio.gather(*(one(n) for n in range(n_requests)))
+            elapsed = time.perf_counter() - start
+            stop.set()
+            await sampler
+            await hits
+        latencies.sort()
+        cache_latencies.sort()
+        return {
+            "rps": n_requests / elapsed,
+            "p50": latencies[len(latencies) // 2] * 1000,
+            "p95": latencies[int(len(latencies) * 0.95)] * 1000,
+            "cache_p95": cache_latencies[int(len(cache_latencies) * 0.95)] * 1000,
+            "threads": max(samples),
+            "failed": failed,
+        }
+
+    async def run():
+        await burst()
+        return await burst()
+
+    r = asyncio.run(run())
+    print(f"    {n_requests} requests, {concurrency} in flight, {len(urls)} endpoints")
+    print(f"    {r['rps']:.0f} req/s, p50 {r['p50']:.1f} ms, p95 {r['p95']:.1f} ms, peak threads {r['threads']}; "
+          f"/products cache hits during the burst: p95 {r['cache_p95']:.1f} ms")
+    report.append(("concurrency_no_errors", not r["failed"], r["failed"][:3] or "ok"))
+    report.append(("concurrency_cache_hits_not_blocked", r["cache_p95"] * 5 < r["p50"],
+                   f"cache hit p95 {r['cache_p95']:.1f} ms vs read p50 {r['p50']:.1f} ms"))
+
+
+SHOP_DB = os.path.join(os.path.dirname(os.path.abspath(__file__)), "shop.db")
+
+
+def bench_sqlite(api, database, report, writers=4, readers=8, seconds=5):
+    """Readers and writers hammering a copy of shop.db: old engine settings vs SQLITE_PRAGMAS."""
+    import shutil
+    import threading
+    from sqlalchemy import create_engine, event, text
+    from sqlalchemy.exc import OperationalError
+
+    if not os.path.exists(SHOP_DB):
+        report.append(("shop_db_present", False, SHOP_DB))
+        return
+
+    def run(tuned):
+        path = os.path.join(tempfile.gettempdir(), f"ssm_bench_shop_{'tuned' if tuned else 'default'}.db")
+        remove_db(path)
+        shutil.copyfile(SHOP_DB, path)
+        bench_engine = create_engine(f"sqlite:///{path}", connect_args={"check_same_thread": False},
+                                     pool_size=writers + readers)
+        if tuned:
+            event.listen(bench_engine, "connect", database.apply_sqlite_pragmas)
+            database.optimize_sqlite(bench_engine)
+        variant_ids = [r[0] for r in bench_engine.connect().execute(text("SELECT id FROM variants")).fetchall()] or [0]
+        counts = {"reads": 0, "writes": 0, "locked": 0}
+        lock = threading.Lock()
+        deadline = time.perf_counter() + seconds
+
+        def writer(n):
+            k = 0
+            while time.perf_counter() < deadline:
+                k += 1
+                try:
+                    # checkout-shaped transaction: stock update + order row + debt log row
+                    with bench_engine.begin() as conn:
+                        vid = variant_ids[(n * 7919 + k) % len(variant_ids)]
+                        conn.execute(text("UPDATE variants SET stock = stock WHERE id = :v"), {"v": vid})
+                        conn.execute(text("INSERT INTO orders (customer_name, total_amount) VALUES ('bench', 0)"))
+                        conn.execute(text("INSERT INTO debt_logs (customer_id, change_amount, new_balance, note) VALUES (NULL, 0, 0, 'bench')"))
+                    key = "writes"
+                except OperationalError as e:
+                    if "locked" not in str(e) and "busy" not in str(e):
+                        raise
+                    key = "locked"
+                with lock:
+                    counts[key] += 1
+
+        def reader():
+            while time.perf_counter() < deadline:
+                try:
+                    with bench_engine.connect() as conn:
+                        conn.execute(text(
+                            "SELECT p.id, v.id, v.stock FROM products p JOIN variants v ON v.product_id = p.id"
+                        )).fetchall()
+                        conn.execute(text("SELECT id, total_amount FROM orders ORDER BY id DESC LIMIT 20")).fetchall()
+                    key = "reads"
+                except OperationalError as e:
+                    if "locked" not in str(e) and "busy" not in str(e):
+                        raise
+                    key = "locked"
+                with lock:
+                    counts[key] += 1
+
+        threads = [threading.Thread(target=writer, args=(n,)) for n in range(writers)]
+        threads += [threading.Thread(target=reader) for _ in range(readers)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        mode = bench_engine.connect().execute(text("PRAGMA journal_mode")).scalar()
+        bench_engine.dispose()
+        remove_db(path)
+        return {**counts, "journal": mode}
+
+    print(f"[+] {writers} writer + {readers} reader threads for {seconds}s on a copy of shop.db ...")
+    results = {"default": run(False), "tuned": run(True)}
+    print(f"    {'profile':<9}{'journal':>9}{'writes/s':>10}{'reads/s':>10}{'locked':>8}")
+    for name, r in results.items():
+        print(f"    {name:<9}{r['journal']:>9}{r['writes'] / seconds:>10.0f}{r['reads'] / seconds:>10.0f}{r['locked']:>8}")
+    report.append(("tuned_sqlite_no_lock_errors", results["tuned"]["locked"] == 0, results["tuned"]["locked"]))
+
+
+def check_startup(api, database, report, sizes=(1000, 100000)):
+    """The schema step of a restart (migrations, search_name fill, search detection) on an up-to-date DB, as the data grows."""
+    from sqlalchemy import text
+    from backend import migrations, search
+
+    def boot():
+        with StatementCounter(database.engine) as counter:
+            start = time.perf_counter()
+            applied = migrations.migrate(database.engine)
+            search.fill_search_names(database.engine)
+            search.detect_search_backend(database.engine)
+            elapsed = (time.perf_counter() - start) * 1000
+        return counter.count, elapsed, applied
+
+    print("[+] Restart cost of the schema step ...")
+    counts = {}
+    total = 0
+    for size in sizes:
+        with database.engine.begin() as conn:
+            conn.execute(
+                text("INSERT INTO orders (customer_name, total_amount, status, is_draft, created_at, created_ts) "
+                     "VALUES ('bench', 0, 'completed', 0, '2024-01-01 10:00:00', :ts)"),
+                [{"ts": 1704103200000 + n} for n in range(total, size)],
+            )
+            conn.execute(
+                text("INSERT INTO debt_logs (customer_id, change_amount, new_balance, note, created_at, created_ts) "
+                     "VALUES (NULL, 0, 0, 'bench', '2024-01-01 10:00:00', :ts)"),
+                [{"ts": 1704103200000 + n} for n in range(total, size)],
+            )
+        total = size
+        count, ms, applied = boot()
+        counts[size] = count
+        print(f"    {size:>7} orders + debt logs -> {count} statements, {ms:.1f} ms, applied now: {applied or 'none'}")
+    report.append(("startup_statement_count_flat", len(set(counts.values())) == 1, counts))
+
+
+def bench_backfill(api, database, report, n_rows=300000):
+    """Checkout-sized write transactions running next to a backfill: one UPDATE vs backend.backfill chunks."""
+    import threading
+    from sqlalchemy import text
+    from backend.backfill import Backfill, run_backfill
+
+    print(f"[+] Seeding {n_rows} orders ...")
+    with database.engine.begin() as conn:
+        conn.execute(
+            text("INSERT INTO orders (customer_name, total_amount, status, is_draft) VALUES ('bench', 0, 'completed', NULL)"),
+            [{} for _ in range(n_rows)],
+        )
+
+    def reset():
+        with database.engine.begin() as conn:
+            conn.execute(text("UPDATE orders SET is_draft = NULL"))
+
+    def with_writer(fn):
+        """Run `fn` while a thread keeps committing small writes; returns (fn result, max write ms, writes)."""
+        stop = threading.Event()
+        latencies = []
+
+        def writer():
+            while not stop.is_set():
+                start = time.perf_counter()
+                with database.engine.begin() as conn:
+                    conn.execute(text("INSERT INTO debt_logs (change_amount, new_balance, note) VALUES (0, 0, 'bench')"))
+                latencies.append((time.perf_counter() - start) * 1000)
+                time.sleep(0.005)
+
+        t = threading.Thread(target=writer)
+        t.start()
+        time.sleep(0.05)
+        start = time.perf_counter()
+        result = fn()
+        elapsed = time.perf_counter() - start
+        stop.set()
+        t.join()
+        return result, elapsed, max(latencies), len(latencies)
+
+    def single_update():
+        with database.engine.begin() as conn:
+            return conn.execute(text("UPDATE orders SET is_draft = 0 WHERE is_draft IS NULL")).rowcount
+
+    fix = Backfill("bench_is_draft", "orders", "is_draft = 0", "is_draft IS NULL")
+    quiet = lambda *a: None
+    print(f"    {'method':<22}{'seconds':>9}{'rows':>9}{'max write ms':>14}{'writes':>8}")
+    rows, elapsed, worst, writes = with_writer(single_update)
+    print(f"    {'single UPDATE':<22}{elapsed:>9.2f}{rows:>9}{worst:>14.1f}{writes:>8}")
+    reset()
+    stats, elapsed, worst_chunked, writes = with_writer(lambda: run_backfill(database.engine, fix, log=quiet))
+    print(f"    {'chunked backfill':<22}{elapsed:>9.2f}{stats['updated']:>9}{worst_chunked:>14.1f}{writes:>8}")
+    report.append(("backfill_updates_every_row", stats["updated"] == n_rows, stats["updated"]))
+    report.append(("backfill_shorter_write_stalls", worst_chunked < worst, f"{worst_chunked:.1f} ms < {worst:.1f} ms"))
+
+    print("[+] Interrupted run resumes ...")
+    reset()
+    first = run_backfill(database.engine, fix, max_chunks=50, log=quiet)
+    second = run_backfill(database.engine, fix, log=print)
+    with database.engine.connect() as conn:
+        left = conn.execute(text("SELECT COUNT(*) FROM orders WHERE is_draft IS NULL")).scalar()
+        saved = conn.execute(text("SELECT rows_updated FROM backfill_progress WHERE name = 'bench_is_draft'")).scalar()
+    resumed = not first["finished"] and second["finished"] and left == 0 and first["updated"] + second["updated"] == n_rows
+    report.append(("backfill_resumes", resumed, f"{first['updated']} + {second['updated']} rows, {saved} recorded, {left} left"))
+
+
+def bench_pool(api, database, report, threads=30, per_thread=20):
+    """Hot reads from more threads than the pool has connections, then again after every connection was killed."""
+    import threading
+    from sqlalchemy import text
+
+    if database.engine.dialect.name != "postgresql":
+        print("    (SQLite: only the load part runs, the disconnect check needs PostgreSQL: pass --database-url)")
+    seed_products(database, 200)
+    seed_orders(database, 50, status="pending", items_per_order=5)
+    pool = database.engine.pool
+    size = pool.size() + pool._max_overflow
+
+    def burst():
+        errors = []
+        peak = [0]
+
+        def work():
+            for _ in range(per_thread):
+                db = database.SessionLocal()
+                try:
+                    api.stats_summary(db)
+                    api.order_statuses(db, list(range(1, 40)))
+                    peak[0] = max(peak[0], database.engine.pool.checkedout())
+                except Exception as e:
+                    errors.append(repr(e))
+                finally:
+                    db.close()
+
+        start = time.perf_counter()
+        workers = [threading.Thread(target=work) for _ in range(threads)]
+        for t in workers:
+            t.start()
+        for t in workers:
+            t.join()
+        return time.perf_counter() - start, peak[0], errors
+
+    print(f"[+] {threads} threads x {per_thread} requests, pool {pool.size()} + {pool._max_overflow} overflow ...")
+    elapsed, peak, errors = burst()
+    print(f"    {threads * per_thread / elapsed:.0f} req/s, peak checked out {peak}, errors {len(errors)}")
+    print(f"    {database.pool_stats(database.engine)}")
+    report.append(("pool_burst_no_errors", not errors, errors[:3] or "ok"))
+    if database.engine.dialect.name == "sqlite":
+        report.append(("pool_within_limit", peak <= size, f"peak {peak} <= {size}"))
+        return
+
+    print("[+] Terminating every other server connection (simulates the proxy dropping idle ones) ...")
+    with database.engine.connect() as conn:
+        killed = conn.execute(text(
+            "SELECT count(pg_terminate_backend(pid)) FROM pg_stat_activity "
+            "WHERE datname = current_database() AND pid <> pg_backend_pid()"
+        )).scalar()
+    print(f"    terminated {killed} connections")
+    before = database.pool_stats(database.engine)["invalidated"]
+    elapsed, peak, errors = burst()
+    after = database.pool_stats(database.engine)
+    print(f"    {threads * per_thread / elapsed:.0f} req/s, errors {len(errors)}, invalidated by pre-ping {after['invalidated'] - before}")
+    print(f"    {after}")
+    report.append(("pool_recovers_after_disconnect", not errors, errors[:3] or "ok"))
+    report.append(("pool_within_limit", peak <= size, f"peak {peak} <= {size}"))
+
+
+def bench_checkout(api, database, report, threads=16, per_thread=20, stock=100):
+    """Many buyers on the same variant: sold quantity must equal the stock taken, never below zero."""
+    import threading
+    from fastapi import HTTPException
+    from sqlalchemy import func
+
+    seed_products(database, 1)
+    db = database.SessionLocal()
+    variant = db.query(database.Variant).first()
+    variant.stock = stock
+    db.commit()
+    variant_id = variant.id
+    db.close()
+
+    outcomes = {"ok": 0, "short": 0, "conflict": 0, "error": []}
+    lock = threading.Lock()
+    barrier = threading.Barrier(threads)
+
+    def buyer(n):
+        barrier.wait()
+        for _ in range(per_thread):
+            req = api.CheckoutRequest(customer_name=f"Khách {n % 4}", cart=[api.CartItem(
+                variant_id=variant_id, quantity=1, price=1000, product_name="Giày", color="Trắng", size="36",
+            )])
+            db = database.SessionLocal()
+            try:
+                api.create_order(db, req)
+                key = "ok"
+            except HTTPException as e:
+                key = {400: "short", 409: "conflict"}.get(e.status_code)
+                if key is None:
+                    with lock:
+                        outcomes["error"].append(e.detail)
+                    continue
+            except Exception as e:
+                with lock:
+                    outcomes["error"].append(repr(e))
+                continue
+            finally:
+                db.close()
+            with lock:
+                outcomes[key] += 1
+
+    print(f"[+] {threads} threads x {per_thread} checkouts of 1 unit, stock {stock} ...")
+    start = time.perf_counter()
+    workers = [threading.Thread(target=buyer, args=(n,)) for n in range(threads)]
+    for t in workers:
+        t.start()
+    for t in workers:
+        t.join()
+    elapsed = time.perf_counter() - start
+
+    db = database.SessionLocal()
+    final = db.query(database.Variant.stock).filter(database.Variant.id == variant_id).scalar()
+    sold = db.query(func.coalesce(func.sum(database.OrderItem.quantity), 0)).scalar()
+    debt = db.query(func.coalesce(func.sum(database.Customer.debt), 0)).scalar()
+    db.close()
+    print(f"    {threads * per_thread / elapsed:.0f} checkouts/s: {outcomes['ok']} sold, {outcomes['short']} out of stock, "
+          f"{outcomes['conflict']} retry, {len(outcomes['error'])} errors; stock left {final}")
+    report.append(("checkout_no_oversell", final >= 0 and sold == stock - final,
+                   f"sold {sold} = {stock} - {final} left"))
+    report.append(("checkout_orders_match_stock", outcomes["ok"] == sold and debt == sold * 1000,
+                   f"{outcomes['ok']} orders, debt {debt}"))
+    report.append(("checkout_no_errors", not outcomes["error"], outcomes["error"][:3] or "ok"))
+
+
+def bench_bulk(api, database, report, n_orders=20000, items_per_order=3, n_customers=300, sample=300):
+    """POST /orders/bulk for a year of orders vs the same orders through /checkout one by one."""
+    import random
+    from fastapi.testclient import TestClient
+
+    seed_products(database, 200)
+    db = database.SessionLocal()
+    db.query(database.Variant).update({database.Variant.stock: 10 ** 6})  # /checkout takes stock
+    db.commit()
+    variant_ids = [vid for (vid,) in db.query(database.Variant.id)]
+    db.close()
+    rng = random.Random(42)
+    start_day = datetime(2025, 1, 1)
+
+    def order(n):
+        return {
+            "customer_name": f"Khách nhập {n % n_customers}",
+            "created_at": (start_day + timedelta(minutes=n * 26)).isoformat(),
+            "cart": [
+                {"variant_id": rng.choice(variant_ids), "quantity": rng.randint(1, 5), "price": 100000,
+                 "product_name": "Giày", "color": "Trắng", "size": "40"}
+                for _ in range(items_per_order)
+            ],
+        }
+
+    client = TestClient(api.app)
+    print(f"[+] {sample} orders through POST /checkout one by one ...")
+    t = time.perf_counter()
+    for n in range(sample):
+        assert client.post("/checkout", json=order(n)).status_code == 200
+    per_order = (time.perf_counter() - t) / sample
+    print(f"    {per_order * 1000:.1f} ms/order -> {n_orders} orders would take ~{per_order * n_orders:.0f}s")
+
+    orders = [order(n) for n in range(n_orders)]
+    print(f"[+] POST /orders/bulk with {n_orders} orders x {items_per_order} items ...")
+    t = time.perf_counter()
+    resp = client.post("/orders/bulk", json={"orders": orders})
+    elapsed = time.perf_counter() - t
+    body = resp.json()
+    print(f"    {elapsed:.2f}s ({n_orders / elapsed:.0f} orders/s), created {body['created']}, failed {body['failed']}")
+
+    db = database.SessionLocal()
+    count = db.query(database.Order).count()
+    items = db.query(database.OrderItem).count()
+    db.close()
+    report.append(("bulk_all_created", resp.status_code == 200 and body["created"] == n_orders,
+                   f"{body['created']}/{n_orders}, {count} orders / {items} items in db"))
+    report.append(("bulk_faster_than_checkout", elapsed < per_order * n_orders / 10,
+                   f"{elapsed:.2f}s vs ~{per_order * n_orders:.0f}s one by one"))
+
+
+def bench_catalog(api, database, report, n_products=2000, variants_per_product=5):
+    """10k-SKU catalog through POST /products/bulk: first load, a refresh with changes, an identical resend."""
+    from fastapi.testclient import TestClient
+
+    colors = ["Trắng", "Đen", "Xám", "Be", "Đỏ", "Xanh Dương"]
+
+    def catalog(price_bump=0, extra=0):
+        return [
+            {"name": f"Mẫu NCC {i}", "image_path": f"assets/images/{i}.jpg", "variants": [
+                {"color": colors[j % len(colors)], "size": str(36 + j),
+                 "price": 100000 + 1000 * j + (price_bump if i % 10 == 0 else 0), "stock": 10 + j}
+                # every 7th product drops its last variant on refresh, every 5th gets a new one
+                for j in range(variants_per_product + (extra if i % 5 == 0 else 0) - (1 if extra and i % 7 == 0 else 0))
+            ]}
+            for i in range(n_products)
+        ]
+
+    client = TestClient(api.app)
+    skus = n_products * variants_per_product
+    timings = {}
+    for label, products in (("load", catalog()), ("refresh", catalog(price_bump=500, extra=1)), ("resend", catalog(price_bump=500, extra=1))):
+        t = time.perf_counter()
+        resp = client.post("/products/bulk", json={"products": products})
+        timings[label] = time.perf_counter() - t
+        body = resp.json()
+        print(f"[+] {label}: {timings[label]:.2f}s, created {body['created']}, updated {body['updated']}, "
+              f"unchanged {body['unchanged']}, failed {body['failed']}, variants {body['variants']}")
+        report.append((f"catalog_{label}_ok", resp.status_code == 200 and body["failed"] == 0, body["variants"]))
+
+    db = database.SessionLocal()
+    variants = db.query(database.Variant).count()
+    db.close()
+    both = len(range(0, n_products, 35))
+    expected = skus + (len(range(0, n_products, 5)) - both) - (len(range(0, n_products, 7)) - both)
+    report.append(("catalog_variant_count", variants == expected, f"{variants} == {expected}"))
+    report.append(("catalog_10k_skus_in_seconds", max(timings.values()) < 10,
+                   ", ".join(f"{k} {v:.2f}s" for k, v in timings.items())))
+
+
+def bench_queue(api, database, report, n_orders=40, items_per_order=10):
+    """A picker's delivery run: confirming 40 accepted orders one by one vs one POST /orders/batch/confirm."""
+    from fastapi.testclient import TestClient
+
+    seed_products(database, 100)
+    db = database.SessionLocal()
+    db.query(database.Variant).update({database.Variant.stock: 10 ** 6})
+    db.commit()
+    db.close()
+    client = TestClient(api.app)
+
+    def accepted_orders():
+        seed_orders(database, n_orders, status="accepted", items_per_order=items_per_order)
+        db = database.SessionLocal()
+        ids = [oid for (oid,) in db.query(database.Order.id).filter(database.Order.status == "accepted").order_by(database.Order.id)]
+        db.close()
+        return ids
+
+    ids = accepted_orders()
+    with StatementCounter(database.engine) as counter:
+        t = time.perf_counter()
+        ok = all(client.put(f"/orders/{oid}/confirm").status_code == 200 for oid in ids)
+        single = time.perf_counter() - t
+    single_count = counter.count
+    print(f"[+] {n_orders} x PUT /orders/{{id}}/confirm: {single * 1000:.0f} ms, {single_count} statements")
+
+    ids = accepted_orders()
+    with StatementCounter(database.engine) as counter:
+        t = time.perf_counter()
+        body = client.post("/orders/batch/confirm", json={"ids": ids}).json()
+        batch = time.perf_counter() - t
+    print(f"[+] 1 x POST /orders/batch/confirm: {batch * 1000:.0f} ms, {counter.count} statements, "
+          f"{body['succeeded']} confirmed, {body['failed']} failed")
+    report.append(("queue_batch_confirms_all", ok and body["succeeded"] == n_orders, body["failed"]))
+    report.append(("queue_batch_fewer_statements", counter.count * 10 < single_count,
+                   f"{counter.count} vs {single_count} statements, {batch * 1000:.0f} vs {single * 1000:.0f} ms"))
+
+
+def bench_reservations(api, database, report, threads=8, per_thread=25, stock=50):
+    """Drafts racing for one variant: exactly `stock` units are held, the queue flags the rest and the ledger adds up."""
+    import threading
+    from sqlalchemy import func
+
+    seed_products(database, 1)
+    db = database.SessionLocal()
+    variant = db.query(database.Variant).first()
+    variant.stock = stock
+    db.commit()
+    variant_id = variant.id
+    db.close()
+
+    outcomes = {"held": 0, "short": 0, "error": []}
+    lock = threading.Lock()
+    barrier = threading.Barrier(threads)
+
+    def orderer(n):
+        barrier.wait()
+        for _ in range(per_thread):
+            req = api.CheckoutRequest(customer_name="", cart=[api.CartItem(
+                variant_id=variant_id, quantity=1, price=1000, product_name="Giày", color="Trắng", size="36",
+            )])
+            db = database.SessionLocal()
+            try:
+                key = "short" if api.create_draft(db, req)["has_stock_conflict"] else "held"
+            except Exception as e:
+                with lock:
+                    outcomes["error"].append(repr(e))
+                continue
+            finally:
+                db.close()
+            with lock:
+                outcomes[key] += 1
+
+    print(f"[+] {threads} threads x {per_thread} drafts of 1 unit, stock {stock} ...")
+    workers = [threading.Thread(target=orderer, args=(n,)) for n in range(threads)]
+    for t in workers:
+        t.start()
+    for t in workers:
+        t.join()
+
+    db = database.SessionLocal()
+    try:
+        reserved = db.query(database.Variant.reserved).filter(database.Variant.id == variant_id).scalar()
+        ledger = db.query(func.coalesce(func.sum(database.StockReservation.quantity), 0)).scalar()
+        queue = api.load_queue(db, "pending")
+        conflicts = sum(1 for o in queue["data"] if o["has_stock_conflict"])
+        with StatementCounter(database.engine) as counter:
+            atp = api.stock_availability(db, [variant_id])
+    finally:
+        db.close()
+    print(f"    {outcomes['held']} held, {outcomes['short']} short, {len(outcomes['error'])} errors; "
+          f"reserved {reserved}, ledger {ledger}, {conflicts} flagged in the queue")
+    report.append(("reservations_exactly_stock", outcomes["held"] == stock == reserved and not outcomes["error"],
+                   f"{outcomes['held']} held of {stock}, {outcomes['error'][:1]}"))
+    report.append(("reservations_ledger_matches", ledger == reserved, f"ledger {ledger} = reserved {reserved}"))
+    report.append(("reservations_queue_flags", conflicts == outcomes["short"], f"{conflicts} flagged, {outcomes['short']} short"))
+    report.append(("reservations_atp_one_read", counter.count == 1 and atp[0]["available"] == 0,
+                   f"{counter.count} statement(s), {atp}"))
+
+
+def check_product_edit(api, database, report, stock=10):
+    """PUT /products/{id} after sales made while the editor was open: stock never below 0 or below what orders hold."""
+    seed_products(database, 1, variants_per_product=1)
+    db = database.SessionLocal()
+    variant = db.query(database.Variant).first()
+    variant.stock = stock
+    db.commit()
+    product_id, variant_id = variant.product_id, variant.id
+    db.close()
+
+    def current():
+        db = database.SessionLocal()
+        try:
+            return db.query(database.Variant.stock, database.Variant.reserved).filter(database.Variant.id == variant_id).one()
+        finally:
+            db.close()
+
+    def edit(new_stock, stock_before):
+        db = database.SessionLocal()
+        try:
+            return api.update_product(product_id, api.ProductUpdate(name="Giày mẫu 0", image_path="", variants=[
+                api.VariantUpdate(id=variant_id, color="Trắng", size="36", price=100000, stock=new_stock, stock_before=stock_before),
+            ]), db)
+        finally:
+            db.close()
+
+    def sell(quantity, draft=False):
+        req = api.CheckoutRequest(customer_name="", cart=[api.CartItem(
+            variant_id=variant_id, quantity=quantity, price=1000, product_name="Giày", color="Trắng", size="36",
+        )])
+        db = database.SessionLocal()
+        try:
+            (api.create_draft if draft else api.create_order)(db, req)
+        finally:
+            db.close()
+
+    print(f"[+] Editor loads stock {stock}, a checkout sells 3, the editor saves 0 ...")
+    sell(3)
+    result = edit(0, stock)
+    after_sale = current()
+    print(f"    {result} -> stock {after_sale.stock}")
+    report.append(("edit_after_sale_not_negative", after_sale.stock == stock - 3 and result.get("stock_kept") == [variant_id],
+                   f"stock {after_sale.stock}, {result}"))
+
+    print("[+] A pending order holds 4, the editor lowers stock below / above the hold ...")
+    sell(4, draft=True)
+    below = edit(2, after_sale.stock)
+    held = current()
+    above = edit(5, after_sale.stock)
+    final = current()
+    print(f"    to 2: {below} -> stock {held.stock}; to 5: {above} -> stock {final.stock}, reserved {final.reserved}")
+    report.append(("edit_keeps_reserved_stock", held.stock == after_sale.stock and below.get("stock_kept") == [variant_id]
+                   and final.stock == 5 and "stock_kept" not in above and final.reserved == 4,
+                   f"kept {held.stock}, then {final.stock} >= reserved {final.reserved}"))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="In-process backend checks and benchmarks.")
+    parser.add_argument("check", choices=["queries", "search", "serialize", "concurrency", "sqlite", "startup", "backfill", "pool", "checkout", "bulk", "catalog", "queue", "reservations", "edit"], help="which check/benchmark to run")
+    parser.add_argument("--database-url", help="run against this throw-away database instead of a temp SQLite file")
+    args = parser.parse_args()
+
+    api, database = load_backend(database_url=args.database_url)
+    report = []
+    start = time.perf_counter()
+    if args.check == "queries":
+        check_queries(api, database, report)
+    elif args.check == "search":
+        bench_search(api, database, report)
+    elif args.check == "serialize":
+        bench_serialize(api, database, report)
+    elif args.check == "concurrency":
+        bench_concurrency(api, database, report)
+    elif args.check == "sqlite":
+        bench_sqlite(api, database, report)
+    elif args.check == "startup":
+        check_startup(api, database, report)
+    elif args.check == "backfill":
+        bench_backfill(api, database, report)
+    elif args.check == "pool":
+        bench_pool(api, database, report)
+    elif args.check == "checkout":
+        bench_checkout(api, database, report)
+    elif args.check == "bulk":
+        bench_bulk(api, database, report)
+    elif args.check == "catalog":
+        bench_catalog(api, database, report)
+    elif args.check == "queue":
+        bench_queue(api, database, report)
+    elif args.check == "reservations":
+        bench_reservations(api, database, report)
+    elif args.check == "edit":
+        check_product_edit(api, database, report)
+
+    print(f'\n=== REPORT ({time.perf_counter() - start:.1f}s) ===')
+    failed = False
+    for name, ok, info in report:
+        print(f"[{'OK' if ok else 'FAIL'}] {name}: {info}")
+        failed = failed or not ok
+    database.engine.dispose()
+    if not args.database_url:
+        remove_db(BENCH_DB)
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
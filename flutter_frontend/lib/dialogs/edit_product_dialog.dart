@@ -26,7 +26,7 @@ class _EditProductDialogState extends State<EditProductDialog> {
     for (final v in widget.product.variants) {
       byColor.putIfAbsent(v.color, () => []).add(v);
     }
-    _groups = byColor.entries.map((e) => _ColorGroup(color: e.key, rows: e.value.map((v) => _SizeRow(id: v.id, size: v.size, price: v.price, stock: v.stock)).toList())).toList();
+    _groups = byColor.entries.map((e) => _ColorGroup(color: e.key, rows: e.value.map((v) => _SizeRow(id: v.id, size: v.size, price: v.price, stock: v.stock, stockBefore: v.stock)).toList())).toList();
     if (_groups.isEmpty) _groups.add(_ColorGroup(color: '', rows: [_SizeRow()]));
   }
 
@@ -44,6 +44,8 @@ class _EditProductDialogState extends State<EditProductDialog> {
         if (r.size.trim().isEmpty) continue;
         final m = <String, dynamic>{'color': g.color.trim(), 'size': r.size.trim(), 'price': r.price, 'stock': r.stock};
         if (r.id != null) m['id'] = r.id;
+        // server applies only the change, so sales made while editing are kept
+        if (r.stockBefore != null) m['stock_before'] = r.stockBefore;
         variants.add(m);
       }
     }
@@ -278,5 +280,6 @@ class _SizeRow {
   String size;
   int price;
   int stock;
-  _SizeRow({this.id, this.size = '', this.price = 0, this.stock = 0});
+  final int? stockBefore;
+  _SizeRow({this.id, this.size = '', this.price = 0, this.stock = 0, this.stockBefore});
 }
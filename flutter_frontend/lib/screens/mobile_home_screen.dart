@@ -205,32 +205,36 @@ class _OrdererScreenState extends State<_OrdererScreen> with _NotificationMixin
   Future<void> _pollOrderStatuses() async {
     if (_trackedOrders.isEmpty) return;
     final ids = List<int>.from(_trackedOrders.keys);
+    final Map<int, String?> statuses;
+    try {
+      statuses = await ApiService.getOrderStatuses(ids);
+    } catch (_) {
+      return;
+    }
     for (final id in ids) {
-      try {
-        final result = await ApiService.getOrderStatus(id);
-        if (result == null) {
-          final miss = (_statusMissCount[id] ?? 0) + 1;
-          _statusMissCount[id] = miss;
-          final lastStatus = _trackedOrders[id];
-          if (lastStatus == 'pending' && miss >= 2) {
-            _trackedOrders.remove(id);
-            _statusMissCount.remove(id);
-            addNotice('❌ Đơn #$id đã bị từ chối');
-          }
-        } else {
-          _statusMissCount[id] = 0;
-          final newStatus = result['status'] as String;
-          final lastStatus = _trackedOrders[id];
-          if (newStatus == 'accepted' && lastStatus == 'pending') {
-            _trackedOrders[id] = 'accepted';
-            addNotice('✅ Đơn #$id đã được tiếp nhận, đang soạn hàng');
-          } else if (newStatus == 'completed') {
-            _trackedOrders.remove(id);
-            _statusMissCount.remove(id);
-            addNotice('🎉 Đơn #$id đã hoàn thành thành công');
-          }
+      if (!statuses.containsKey(id)) continue;
+      final newStatus = statuses[id];
+      if (newStatus == null) {
+        final miss = (_statusMissCount[id] ?? 0) + 1;
+        _statusMissCount[id] = miss;
+        final lastStatus = _trackedOrders[id];
+        if (lastStatus == 'pending' && miss >= 2) {
+          _trackedOrders.remove(id);
+          _statusMissCount.remove(id);
+          addNotice('❌ Đơn #$id đã bị từ chối');
         }
-      } catch (_) {}
+      } else {
+        _statusMissCount[id] = 0;
+        final lastStatus = _trackedOrders[id];
+        if (newStatus == 'accepted' && lastStatus == 'pending') {
+          _trackedOrders[id] = 'accepted';
+          addNotice('✅ Đơn #$id đã được tiếp nhận, đang soạn hàng');
+        } else if (newStatus == 'completed') {
+          _trackedOrders.remove(id);
+          _statusMissCount.remove(id);
+          addNotice('🎉 Đơn #$id đã hoàn thành thành công');
+        }
+      }
     }
   }
 
@@ -1,4 +1,6 @@
+import 'dart:async';
 import 'dart:convert';
+import 'dart:math';
 import 'package:http/http.dart' as http;
 import '../config.dart';
 import '../models/product.dart';
@@ -10,6 +12,31 @@ class ApiService {
   static const _timeout = Duration(seconds: 15);
   static final _headers = {'Content-Type': 'application/json'};
 
+  // Order writes carry an Idempotency-Key: a retry after a timeout gets the first
+  // response back from the server instead of creating the order twice.
+  static const _writeTimeout = Duration(seconds: 6);
+  static const _writeAttempts = 3;
+  static final _random = Random.secure();
+
+  static String _newIdempotencyKey() =>
+      List.generate(16, (_) => _random.nextInt(256).toRadixString(16).padLeft(2, '0')).join();
+
+  static Future<http.Response> _sendIdempotent(Future<http.Response> Function(Map<String, String> headers) send) async {
+    final headers = {..._headers, 'Idempotency-Key': _newIdempotencyKey()};
+    for (var attempt = 1;; attempt++) {
+      try {
+        final r = await send(headers).timeout(_writeTimeout);
+        // 409: first attempt still running, or lost a stock race — safe to resend with the same key
+        if (r.statusCode != 409 || attempt >= _writeAttempts) return r;
+      } on TimeoutException {
+        if (attempt >= _writeAttempts) rethrow;
+      } on http.ClientException {
+        if (attempt >= _writeAttempts) rethrow;
+      }
+      await Future.delayed(Duration(milliseconds: 300 * attempt));
+    }
+  }
+
   // ── Products ──
   static Future<List<Product>> getProducts({String search = ''}) async {
     final uri = search.isEmpty ? Uri.parse('$_b/products') : Uri.parse('$_b/products?search=${Uri.encodeComponent(search)}');
@@ -123,6 +150,19 @@ class ApiService {
 
   // ── Dashboard Stats ──
   static Future<Map<String, dynamic>> getDashboardStats() async {
+    final r = await http.get(Uri.parse('$_b/stats/summary?recent=5')).timeout(_timeout);
+    if (r.statusCode == 200) {
+      final j = jsonDecode(utf8.decode(r.bodyBytes)) as Map<String, dynamic>;
+      return {
+        'totalProducts': j['total_products'] as int,
+        'totalCustomers': j['total_customers'] as int,
+        'totalDebt': j['total_debt'] as int,
+        'totalOrders': j['total_orders'] as int,
+        'recentOrders': (j['recent_orders'] as List).map((e) => Order.fromJson(e)).toList(),
+      };
+    }
+    if (r.statusCode != 404) throw Exception('Lỗi tải thống kê');
+    // Server cũ chưa có /stats/summary → tính từ danh sách đầy đủ
     final results = await Future.wait([
       getProducts(),
       getCustomers(),
@@ -148,15 +188,16 @@ class ApiService {
     String customerPhone = '',
     required List<CartItem> cart,
   }) async {
-    final r = await http.post(
+    final body = jsonEncode({
+      'customer_name': customerName,
+      'customer_phone': customerPhone,
+      'cart': cart.map((e) => e.toJson()).toList(),
+    });
+    final r = await _sendIdempotent((headers) => http.post(
       Uri.parse('$_b/checkout/draft'),
-      headers: _headers,
-      body: jsonEncode({
-        'customer_name': customerName,
-        'customer_phone': customerPhone,
-        'cart': cart.map((e) => e.toJson()).toList(),
-      }),
-    );
+      headers: headers,
+      body: body,
+    ));
     if (r.statusCode == 200) {
       return jsonDecode(utf8.decode(r.bodyBytes));
     }
@@ -181,10 +222,10 @@ class ApiService {
 
   /// Approve a draft order
   static Future<Map<String, dynamic>> approveOrder(int orderId) async {
-    final r = await http.put(
+    final r = await _sendIdempotent((headers) => http.put(
       Uri.parse('$_b/orders/$orderId/approve'),
-      headers: _headers,
-    );
+      headers: headers,
+    ));
     if (r.statusCode == 200) {
       return jsonDecode(utf8.decode(r.bodyBytes));
     }
@@ -193,7 +234,7 @@ class ApiService {
 
   /// Reject (delete) a pending order
   static Future<Map<String, dynamic>> rejectOrder(int orderId) async {
-    final r = await http.delete(Uri.parse('$_b/orders/$orderId/reject'));
+    final r = await _sendIdempotent((headers) => http.delete(Uri.parse('$_b/orders/$orderId/reject'), headers: headers));
     if (r.statusCode == 200) {
       return jsonDecode(utf8.decode(r.bodyBytes));
     }
@@ -213,11 +254,32 @@ class ApiService {
 
   /// Picker confirms delivery — deducts stock + records debt
   static Future<Map<String, dynamic>> confirmOrder(int orderId) async {
-    final r = await http.put(Uri.parse('$_b/orders/$orderId/confirm'), headers: _headers);
+    final r = await _sendIdempotent((headers) => http.put(Uri.parse('$_b/orders/$orderId/confirm'), headers: headers));
     if (r.statusCode == 200) return jsonDecode(utf8.decode(r.bodyBytes));
     throw Exception(jsonDecode(utf8.decode(r.bodyBytes))['detail'] ?? 'Lỗi xác nhận đơn hàng');
   }
 
+  /// Status of many orders in one request: id → status, null if rejected/deleted.
+  /// Falls back to one request per order on servers without /orders/status.
+  static Future<Map<int, String?>> getOrderStatuses(List<int> orderIds) async {
+    if (orderIds.isEmpty) return {};
+    final r = await http.get(Uri.parse('$_b/orders/status?ids=${orderIds.join(',')}')).timeout(_timeout);
+    if (r.statusCode == 200) {
+      final statuses = jsonDecode(utf8.decode(r.bodyBytes))['statuses'] as Map<String, dynamic>;
+      return {
+        for (final e in statuses.entries)
+          int.parse(e.key): (e.value == 'deleted' || e.value == 'not_found') ? null : e.value as String,
+      };
+    }
+    if (r.statusCode != 404 && r.statusCode != 405) throw Exception('Status check failed: ${r.statusCode}');
+    final result = <int, String?>{};
+    for (final id in orderIds) {
+      final s = await getOrderStatus(id);
+      result[id] = s == null ? null : s['status'] as String;
+    }
+    return result;
+  }
+
   /// Lightweight status check for orderer polling
   static Future<Map<String, dynamic>?> getOrderStatus(int orderId) async {
     final r = await http.get(Uri.parse('$_b/orders/$orderId/status')).timeout(_timeout);
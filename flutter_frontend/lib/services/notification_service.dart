@@ -1,11 +1,16 @@
 import 'dart:async';
 import 'dart:convert';
+import 'package:flutter/foundation.dart' show kIsWeb;
 import 'package:http/http.dart' as http;
 import '../config.dart';
 import '../models/order.dart';
 
 class NotificationService {
   static Timer? _pollingTimer;
+  static Timer? _retryTimer;
+  static http.Client? _eventsClient;
+  static StreamSubscription<String>? _eventsSub;
+  static String? _lastEventId;
   static int _pendingOrderCount = 0;
   
   // Callback when new pending orders detected
@@ -13,20 +18,81 @@ class NotificationService {
   
   static int get pendingOrderCount => _pendingOrderCount;
   
-  /// Start polling for pending orders (default 10 seconds)
+  /// Listen for order changes via the /events stream (SSE).
+  /// Falls back to polling every [intervalSeconds] while the stream is unavailable
+  /// (old server, network error) and on web, where http cannot stream responses.
   static void startPolling({int intervalSeconds = 10}) {
-    stopPolling();  // Stop any existing timer
-    
-    _pollingTimer = Timer.periodic(
-      Duration(seconds: intervalSeconds),
-      (_) => _checkPendingOrders(),
-    );
+    stopPolling();  // Stop any existing timer / stream
+    _checkPendingOrders();
+    if (kIsWeb) {
+      _startTimer(intervalSeconds);
+    } else {
+      _connectEvents(intervalSeconds);
+    }
   }
   
   /// Stop polling
   static void stopPolling() {
     _pollingTimer?.cancel();
     _pollingTimer = null;
+    _retryTimer?.cancel();
+    _retryTimer = null;
+    _eventsSub?.cancel();
+    _eventsSub = null;
+    _eventsClient?.close();
+    _eventsClient = null;
+  }
+
+  static void _startTimer(int intervalSeconds) {
+    _pollingTimer ??= Timer.periodic(
+      Duration(seconds: intervalSeconds),
+      (_) => _checkPendingOrders(),
+    );
+  }
+
+  static Future<void> _connectEvents(int intervalSeconds) async {
+    final client = http.Client();
+    _eventsClient = client;
+    try {
+      final req = http.Request('GET', Uri.parse('${AppConfig.apiUrl}/events?types=order.created,order.approved,order.confirmed,order.rejected'));
+      req.headers['Accept'] = 'text/event-stream';
+      if (_lastEventId != null) req.headers['Last-Event-ID'] = _lastEventId!;
+      final resp = await client.send(req).timeout(const Duration(seconds: 15));
+      if (resp.statusCode != 200) throw Exception('events: ${resp.statusCode}');
+      if (_eventsClient != client) return;  // stopped while connecting
+
+      // Stream is live: no need to poll any more
+      _pollingTimer?.cancel();
+      _pollingTimer = null;
+      _eventsSub = resp.stream
+          .transform(utf8.decoder)
+          .transform(const LineSplitter())
+          .listen(
+            (line) {
+              if (line.startsWith('id:')) {
+                _lastEventId = line.substring(3).trim();
+              } else if (line.startsWith('event:')) {
+                // order event or "reset" → refresh the pending count once
+                _checkPendingOrders();
+              }
+            },
+            onDone: () => _fallbackToPolling(client, intervalSeconds),
+            onError: (_) => _fallbackToPolling(client, intervalSeconds),
+            cancelOnError: true,
+          );
+    } catch (e) {
+      _fallbackToPolling(client, intervalSeconds);
+    }
+  }
+
+  static void _fallbackToPolling(http.Client client, int intervalSeconds) {
+    if (_eventsClient != client) return;  // stopped or replaced
+    _eventsSub = null;
+    _eventsClient = null;
+    client.close();
+    _startTimer(intervalSeconds);
+    _retryTimer?.cancel();
+    _retryTimer = Timer(const Duration(seconds: 30), () => _connectEvents(intervalSeconds));
   }
   
   /// Check pending orders from backend
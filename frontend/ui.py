@@ -304,7 +304,8 @@ class ColorGroupWidget(QFrame):
             new_group = ColorGroupWidget(self.color_inp.text() + " (Copy)", not (self.palette().window().color() == QColor('#ffffff')))
             parent_layout.insertWidget(parent_layout.indexOf(self) + 1, new_group)
             for data in current_data:
-                new_group.add_size_row(data)
+                # the copy is a new variant, not the one it was copied from
+                new_group.add_size_row({k: v for k, v in data.items() if k not in ("id", "stock_before")})
             
             new_group.color_inp.setFocus()
             new_group.color_inp.selectAll()
@@ -346,6 +347,9 @@ class ColorGroupWidget(QFrame):
             s_inp.setText(str(data['size']))
             p_inp.setText(str(data['price']))
             st_inp.setText(str(data['stock']))
+            # server applies only the stock change, so sales made while editing are kept
+            row.variant_id = data.get('id')
+            row.stock_before = data.get('stock')
             
         l.addWidget(s_inp)
         l.addWidget(p_inp)
@@ -384,7 +388,11 @@ class ColorGroupWidget(QFrame):
                     price = row.findChild(PriceInput).get_value()
                     stock = int(inps[2].text() or 0)
                     if size:
-                        vars.append({"color": c_name, "size": size, "price": price, "stock": stock})
+                        v = {"color": c_name, "size": size, "price": price, "stock": stock}
+                        if getattr(row, 'variant_id', None) is not None:
+                            v["id"] = row.variant_id
+                            v["stock_before"] = row.stock_before
+                        vars.append(v)
         return vars
 
 class AddCustomerPanel(QWidget):
@@ -1606,10 +1614,14 @@ class MainWindow(QMainWindow):
                 QMessageBox.warning(self, "Lỗi kết nối", str(e))
             return
 
-        # New desktop staff flow: create draft then auto-approve to picker.
+        # New desktop staff flow: create the order already approved for the picker (one call).
         # Stock/debt are updated only when picker confirms (/orders/{id}/confirm).
         try:
-            draft_resp = requests.post(f"{API_URL}/checkout/draft", json=payload)
+            draft_resp = requests.post(f"{API_URL}/checkout/draft/approve", json=payload)
+            approved = draft_resp.status_code not in (404, 405)
+            if not approved:
+                # older server: draft then approve
+                draft_resp = requests.post(f"{API_URL}/checkout/draft", json=payload)
             if draft_resp.status_code != 200:
                 QMessageBox.warning(self, "Lỗi", f"Thất bại:\n{draft_resp.json().get('detail', 'Lỗi tạo đơn chờ soạn')}")
                 return
@@ -1620,10 +1632,11 @@ class MainWindow(QMainWindow):
                 QMessageBox.warning(self, "Lỗi", "Không nhận được mã đơn hàng từ server")
                 return
 
-            approve_resp = requests.put(f"{API_URL}/orders/{order_id}/approve")
-            if approve_resp.status_code != 200:
-                QMessageBox.warning(self, "Lỗi", f"Đã tạo đơn #{order_id} nhưng không thể chuyển cho picker:\n{approve_resp.json().get('detail', 'Lỗi tiếp nhận đơn')}")
-                return
+            if not approved:
+                approve_resp = requests.put(f"{API_URL}/orders/{order_id}/approve")
+                if approve_resp.status_code != 200:
+                    QMessageBox.warning(self, "Lỗi", f"Đã tạo đơn #{order_id} nhưng không thể chuyển cho picker:\n{approve_resp.json().get('detail', 'Lỗi tiếp nhận đơn')}")
+                    return
 
             QMessageBox.information(self, "Thành công", f"Đã gửi đơn #{order_id} cho picker xác nhận!")
             self.cart = []
@@ -17,6 +17,8 @@ DATABASE_URL = f"sqlite:///{DB_PATH}"
 Base = declarative_base()
 engine = create_engine(DATABASE_URL, connect_args={"check_same_thread": False})
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+# result.xlsx: số nhóm (khách, ngày) mỗi transaction
+COMMIT_EVERY = 500
 
 # --- 2. ĐỊNH NGHĨA MODELS ---
 class Product(Base):
@@ -123,6 +125,7 @@ def import_inventory(db):
     try:
         df = pd.read_excel(file_path, sheet_name="MÃ HÀNG")
         count = 0
+        existing = {name for (name,) in db.query(Product.name)}
         for _, row in df.iterrows():
             # Cột MH là Tên/Mã, ĐG là Giá
             p_name = str(row.get('MH', '')).strip()
@@ -130,24 +133,13 @@ def import_inventory(db):
             
             if not p_name or p_name.lower() == 'nan': continue
             
-            # Tạo Product nếu chưa có
-            if not db.query(Product).filter(Product.name == p_name).first():
-                prod = Product(name=p_name)
-                db.add(prod)
-                db.commit()
-                db.refresh(prod)
-                
-                # Tạo Variant mặc định: Đen, 40, Stock 20
-                var = Variant(
-                    product_id=prod.id,
-                    color="Đen",
-                    size="40",
-                    stock=20,
-                    price=price
-                )
-                db.add(var)
-                db.commit()
+            # Tạo Product nếu chưa có, Variant mặc định: Đen, 40, Stock 20
+            if p_name not in existing:
+                existing.add(p_name)
+                db.add(Product(name=p_name, variants=[Variant(color="Đen", size="40", stock=20, price=price)]))
                 count += 1
+        # 1 transaction cho cả sheet (commit từng dòng = 1 lần ghi đĩa mỗi sản phẩm)
+        db.commit()
         print(f"✅ Đã nhập {count} mẫu sản phẩm vào kho.")
     except Exception as e:
         print(f"❌ Lỗi nhập kho: {e}")
@@ -167,19 +159,26 @@ def import_from_result(db):
         # Group by (KHÁCH HÀNG, NGÀY) để gom các đơn cùng ngày
         grouped = df.groupby(['KHÁCH HÀNG', 'NGÀY'])
 
-        for (customer_name, date_str), group in grouped:
+        # Tra cứu 1 lần: khách theo tên, variant đầu tiên của từng mã hàng
+        customers = {c.name: c for c in db.query(Customer)}
+        first_variant = {}
+        for name, var in db.query(Product.name, Variant).join(Variant, Variant.product_id == Product.id).order_by(Variant.id):
+            first_variant.setdefault(name, var)
+        product_names = {name for (name,) in db.query(Product.name)}
+
+        for group_no, ((customer_name, date_str), group) in enumerate(grouped, 1):
             customer_name = str(customer_name).strip()
             date_str = str(date_str).strip()
 
             print(f"   -> Xử lý: {customer_name} ({date_str})")
 
             # Tạo khách nếu chưa có
-            cust = db.query(Customer).filter(Customer.name == customer_name).first()
+            cust = customers.get(customer_name)
             if not cust:
                 cust = Customer(name=customer_name, phone="", debt=0)
                 db.add(cust)
-                db.commit()
-                db.refresh(cust)
+                db.flush()
+                customers[customer_name] = cust
 
             # Parse ngày
             order_date = parse_date(date_str)
@@ -249,13 +248,12 @@ def import_from_result(db):
                         continue
 
                     # Tìm mã hàng trong database
-                    prod = db.query(Product).filter(Product.name == ma_hang).first()
-                    if not prod:
+                    if ma_hang not in product_names:
                         print(f"   ⚠️ LỖI: Không tìm thấy mã hàng '{ma_hang}' trong kho (khách: {customer_name}, ngày: {date_str})")
                         continue
 
                     # Lấy variant đầu tiên (Đen, 40)
-                    var = prod.variants[0] if prod.variants else None
+                    var = first_variant.get(ma_hang)
                     if not var:
                         print(f"   ⚠️ LỖI: Sản phẩm '{ma_hang}' không có variant (khách: {customer_name})")
                         continue
@@ -276,11 +274,16 @@ def import_from_result(db):
             if pending_items:
                 save_order(db, cust, pending_items)
 
+            if group_no % COMMIT_EVERY == 0:
+                db.commit()
+
+        db.commit()
         print(f"✅ Đã nhập hóa đơn công nợ từ result.xlsx")
     except Exception as e:
         print(f"❌ Lỗi nhập result.xlsx: {e}")
 
 def save_order(db, customer, items):
+    """Thêm đơn vào session; caller commit theo lô (COMMIT_EVERY nhóm), không commit từng đơn."""
     if not items: return
 
     # Lấy thời gian từ item đầu tiên
@@ -295,24 +298,21 @@ def save_order(db, customer, items):
         customer_name=customer.name,
         total_amount=total,
         created_at=order_date,
-        created_ts=order_ts
+        created_ts=order_ts,
+        items=[
+            OrderItem(
+                product_name=i['product_name'],
+                variant_id=i['variant_id'],
+                variant_info=i['variant_info'],
+                quantity=i['quantity'],
+                price=i['price']
+            )
+            for i in items
+        ]
     )
     db.add(order)
-    db.flush()
-
-    for i in items:
-        item = OrderItem(
-            order_id=order.id,
-            product_name=i['product_name'],
-            variant_id=i['variant_id'],
-            variant_info=i['variant_info'],
-            quantity=i['quantity'],
-            price=i['price']
-        )
-        db.add(item)
 
     customer.debt += total
-    db.commit()
 
 if __name__ == "__main__":
     if os.path.exists(DB_PATH):